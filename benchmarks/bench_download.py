@@ -0,0 +1,75 @@
+'''
+Benchmarks the download throughput of CaseLoader against a local stand-in server
+
+    python -m benchmarks.bench_download --n-cases 500 --latency 0.05 --error-rate 0.01
+
+Every mode queries the index of the stand-in server and downloads all cases into a fresh
+directory, and reports the amount of cases per second and the latency per case
+(including retries, waiting for the rate limit and the section label precheck).
+'''
+import time
+import tempfile
+from pathlib import Path
+from argparse import ArgumentParser
+
+import numpy as np
+
+from src.caseloader import CaseLoader
+from src.http_client import HttpClient
+from src.standin_server import StandinServer
+
+
+def timed(request_case, latencies):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return request_case(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def run(server, out_dir, max_workers, stream, args):
+    http = HttpClient(backoff=0.1, max_backoff=1, requests_per_second=args.requests_per_second,
+                      pool_size=max_workers)
+    caseloader = CaseLoader(out_dir, max_workers=max_workers, http=http, base_url=server.base_url)
+
+    latencies = []
+    caseloader._request_case = timed(caseloader._request_case, latencies)
+
+    caseloader.query_ECLI_index('type=uitspraak&max=1000', retrieve_all=True)
+    start = time.perf_counter()
+    if stream:
+        n_cases = sum(1 for _ in caseloader.stream_cases_from_feed(queue_size=args.queue_size))
+    else:
+        caseloader.request_cases_from_feed()
+        n_cases = len(caseloader.store)
+    elapsed = time.perf_counter() - start
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    label = f"{'stream' if stream else 'request'}, {max_workers} workers"
+    print(f"{label:<24} {n_cases:>6} cases in {elapsed:7.2f} s | {n_cases / elapsed:8.1f} cases/s | "
+          f"p50 {p50:7.1f} ms | p95 {p95:7.1f} ms | p99 {p99:7.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n-cases", dest="n_cases", type=int, default=500)
+    parser.add_argument("--case-dir", dest="case_dir", default=None, help="serve these case xmls instead of synthetic ones")
+    parser.add_argument("--feed-dir", dest="feed_dir", default=None, help="serve these feeds instead of a synthetic index")
+    parser.add_argument("--latency", dest="latency", type=float, default=0.05, help="mean server latency in seconds")
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", dest="rate_limit", type=float, default=None, help="server side requests per second")
+    parser.add_argument("--requests-per-second", dest="requests_per_second", type=float, default=None,
+                        help="client side rate limit")
+    parser.add_argument("--workers", dest="workers", type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument("--queue-size", dest="queue_size", type=int, default=64)
+    args = parser.parse_args()
+
+    with StandinServer(feed_dir=args.feed_dir, case_dir=args.case_dir, n_cases=args.n_cases, latency=args.latency,
+                       error_rate=args.error_rate, rate_limit=args.rate_limit) as server:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for max_workers in args.workers:
+                run(server, Path(tmp_dir) / f'request_{max_workers}', max_workers, False, args)
+            run(server, Path(tmp_dir) / 'stream', max(args.workers), True, args)
+        print(f"Server responses: {dict(sorted(server.counts.items()))}")
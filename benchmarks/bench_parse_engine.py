@@ -0,0 +1,68 @@
+'''
+Benchmarks the lxml parse engine of CaseParser against the BeautifulSoup engine
+
+    python -m benchmarks.bench_parse_engine --case-dir data/query/cases
+
+By default the fixture cases of the test suite are used, both as they are and inflated
+to the size of a long verdict by repeating the paragraphs of their sections.
+Both engines must return the same results for every case.
+'''
+import time
+import glob
+from argparse import ArgumentParser
+
+from src.caseparser import CaseParser
+from benchmarks.bench_section_labels import inflate
+
+
+def parse(parser, case):
+    try:
+        return parser.parse_case(case)
+    except AttributeError:
+        # Cases with a section without a title are not supported by either engine
+        return None
+
+
+def time_per_case(parser, cases, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for case in cases:
+            parse(parser, case)
+    return (time.perf_counter() - start) / (repeat * len(cases))
+
+
+def run(cases, repeat, include_procedures, label):
+    soup = CaseParser(include_procedures=include_procedures)
+    lxml = CaseParser(include_procedures=include_procedures, engine='lxml')
+
+    texts = [case.decode('utf-8') for case in cases]
+    for case, text in zip(cases, texts):
+        assert parse(soup, text) == parse(lxml, case), "The engines disagree"
+
+    soup_time = time_per_case(soup, texts, repeat)
+    lxml_time = time_per_case(lxml, cases, repeat)
+    size = sum(len(case) for case in cases) / len(cases)
+    print(f"{label:<30} {len(cases):>6} cases, {size / 1024:8.1f} KB avg | "
+          f"bs4 {soup_time * 1000:8.3f} ms | lxml {lxml_time * 1000:8.3f} ms | {soup_time / lxml_time:5.1f}x")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--case-dir", dest="case_dir", default='tests/fixtures/cases')
+    parser.add_argument("--repeat", dest="repeat", type=int, default=10)
+    parser.add_argument("--inflate", dest="inflate", type=int, default=50)
+    args = parser.parse_args()
+
+    cases = []
+    for source in sorted(glob.glob(f'{args.case_dir}/*.xml')):
+        with open(source, 'rb') as f:
+            cases.append(f.read())
+
+    # Parse every case, whatever its procedure
+    include_procedures = ['Eerste aanleg - meervoudig', 'Eerste aanleg - enkelvoudig', 'Op tegenspraak',
+                          'Hoger beroep', 'Cassatie']
+
+    run(cases, args.repeat, include_procedures, 'as is')
+    if args.inflate > 1:
+        run([inflate(case, args.inflate) for case in cases], max(1, args.repeat // 10), include_procedures,
+            f'inflated x{args.inflate}')
@@ -0,0 +1,95 @@
+'''
+Benchmarks building the dataframe of parsed cases from lists per column against
+the earlier approach of a one-row dataframe per section
+
+    python -m benchmarks.bench_parse_frame --n-cases 10000
+
+The corpus repeats the fixture cases of the test suite under new ECLIs. The cases are parsed once;
+the report shows the time and the peak memory (tracemalloc) of turning the parse results into
+the dataframe of `CaseParser.parse_cases`, and checks that both approaches give the same csv.
+'''
+import time
+import glob
+import logging
+import tracemalloc
+from argparse import ArgumentParser
+
+import regex
+import numpy as np
+import pandas as pd
+
+from src.caseparser import CaseParser
+
+
+def frame_per_section(parser, results):
+    # The dataframe assembly of CaseParser._parse_documents before it collected columns
+    dataframes = []
+    for ECLI, section_data in results:
+        frames = [pd.DataFrame.from_dict(section_dict, orient='index').T for section_dict in section_data]
+        dataframes.append(pd.concat(frames))
+    df = pd.concat(dataframes, axis=0)
+    df[parser.data_key] = [regex.sub(r'\p{C}', ' ', dp[parser.data_key]) for _, dp in df.iterrows()]
+    df["id"] = list(range(len(df)))
+    df.set_index("id", inplace=True)
+    df[parser.data_key] = df[parser.data_key].replace('', np.nan)
+    return df.dropna(subset=[parser.data_key])
+
+
+def frame_from_columns(parser, results):
+    columns = {column: [] for column in parser.columns}
+    cases = []
+    for ECLI, section_data in results:
+        start = len(columns['ECLI'])
+        for section_dict in section_data:
+            for column, values in columns.items():
+                values.append(section_dict[column])
+        cases.append((ECLI, start, len(columns['ECLI'])))
+    return parser._frame_from_columns(columns, cases)
+
+
+def measure(build, parser, results):
+    start = time.perf_counter()
+    df = build(parser, results)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    build(parser, results)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return df, elapsed, peak
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--case-dir", dest="case_dir", default='tests/fixtures/cases')
+    arg_parser.add_argument("--n-cases", dest="n_cases", type=int, default=10000)
+    arg_parser.add_argument("--level", dest="level", default='section', help="section or paragraph")
+    args = arg_parser.parse_args()
+
+    # Per-case logging would dominate the parse time
+    logging.disable(logging.INFO)
+
+    # Cases with an untitled section are not supported by parse_case, and the PHR conclusion has no sections
+    fixtures = [open(source, 'rb').read() for source in sorted(glob.glob(f'{args.case_dir}/*.xml'))
+                if 'RBROT' not in source and 'PHR' not in source]
+    parser = CaseParser(level=args.level, engine='lxml',
+                        include_procedures=['Eerste aanleg - meervoudig', 'Eerste aanleg - enkelvoudig',
+                                            'Op tegenspraak', 'Hoger beroep'])
+
+    start = time.perf_counter()
+    results = []
+    for i in range(args.n_cases):
+        case = regex.sub(rb'(<dcterms:identifier>)[^<]*', rb'\g<1>ECLI:NL:BENCH:2021:%d' % i,
+                         fixtures[i % len(fixtures)], count=1)
+        ECLI, _, _, section_data = parser.parse_case(case)
+        if ECLI is not None:
+            results.append((ECLI, section_data))
+    print(f"Parsed {len(results)} cases in {time.perf_counter() - start:.1f} s")
+
+    before = measure(frame_per_section, parser, results)
+    after = measure(frame_from_columns, parser, results)
+    for label, (df, elapsed, peak) in [('frame per section', before), ('columns', after)]:
+        print(f"{label:<20} {len(df):>8} rows | {elapsed:7.2f} s | peak {peak / 1024 / 1024:8.1f} MB")
+
+    assert before[0].to_csv() == after[0].to_csv(), "The dataframes differ"
+    print(f"{before[1] / after[1]:.0f}x faster, {before[2] / after[2]:.1f}x less peak memory")
@@ -0,0 +1,59 @@
+'''
+Benchmarks the streaming section label precheck against the BeautifulSoup implementation
+
+    python -m benchmarks.bench_section_labels --case-dir data/query/cases
+
+By default the fixture cases of the test suite are used, both as they are and inflated
+to the size of a long verdict by repeating the paragraphs of their sections.
+'''
+import time
+import glob
+from argparse import ArgumentParser
+
+import regex
+
+from src.caseparser import CaseParser
+
+
+def inflate(case, factor):
+    # Repeat every parablock, which keeps the section structure of the case intact
+    return regex.sub(rb'<parablock>.*?</parablock>', lambda m: m.group(0) * factor, case, flags=regex.DOTALL)
+
+
+def time_per_case(check, cases, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for case in cases:
+            check(case)
+    return (time.perf_counter() - start) / (repeat * len(cases))
+
+
+def run(cases, repeat, label):
+    parser = CaseParser()
+
+    # Both implementations must reach the same decision
+    for case in cases:
+        assert parser.section_label_reason(case) == parser._section_label_reason_soup(case)
+
+    soup = time_per_case(parser._section_label_reason_soup, cases, repeat)
+    streaming = time_per_case(parser.section_label_reason, cases, repeat)
+    size = sum(len(case) for case in cases) / len(cases)
+    print(f"{label:<30} {len(cases):>6} cases, {size / 1024:8.1f} KB avg | "
+          f"soup {soup * 1000:8.3f} ms | streaming {streaming * 1000:8.3f} ms | {soup / streaming:5.1f}x")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--case-dir", dest="case_dir", default='tests/fixtures/cases')
+    parser.add_argument("--repeat", dest="repeat", type=int, default=20)
+    parser.add_argument("--inflate", dest="inflate", type=int, default=200)
+    args = parser.parse_args()
+
+    cases = []
+    for source in sorted(glob.glob(f'{args.case_dir}/*.xml')):
+        with open(source, 'rb') as f:
+            cases.append(f.read())
+
+    run(cases, args.repeat, 'as is')
+    if args.inflate > 1:
+        run([inflate(case, args.inflate) for case in cases], max(1, args.repeat // 10), f'inflated x{args.inflate}')
@@ -0,0 +1,74 @@
+'''
+Benchmarks the two-phase fetch of CaseLoader against downloading all cases, using a local stand-in server
+
+    python -m benchmarks.bench_two_phase --n-cases 500 --excluded 0.5 --latency 0.05
+
+The stand-in server assigns excluded procedures to a fraction of its synthetic cases.
+Both modes query the index, download into a fresh directory and parse the stored cases
+with the same CaseParser; the report shows the bytes sent by the server, the download and parse
+times, and checks that both modes produce the same parsed data.
+'''
+import time
+import tempfile
+from pathlib import Path
+from argparse import ArgumentParser
+
+from src.caseloader import CaseLoader
+from src.caseparser import CaseParser
+from src.http_client import HttpClient
+from src.metadata_filter import MetadataFilter
+from src.standin_server import StandinServer
+
+
+INCLUDED = 'Eerste aanleg - meervoudig'
+EXCLUDED = 'Hoger beroep'
+
+
+def run(server, out_dir, parser, two_phase, args):
+    http = HttpClient(backoff=0.1, max_backoff=1, requests_per_second=None, pool_size=args.workers)
+    metadata_filter = MetadataFilter(include_procedures=parser.include_procedures) if two_phase else None
+    caseloader = CaseLoader(out_dir, max_workers=args.workers, http=http, base_url=server.base_url,
+                            metadata_filter=metadata_filter)
+    caseloader.query_ECLI_index('type=uitspraak&max=1000', retrieve_all=True)
+
+    bytes_sent = server.bytes_sent
+    start = time.perf_counter()
+    caseloader.request_cases_from_feed()
+    download = time.perf_counter() - start
+    n_bytes = server.bytes_sent - bytes_sent
+
+    start = time.perf_counter()
+    df = parser.parse_store(caseloader.store, write_to_csv=False)
+    parse = time.perf_counter() - start
+
+    label = 'two-phase' if two_phase else 'single phase'
+    print(f"{label:<14} {len(caseloader.store):>6} cases stored | {n_bytes / 1024 / 1024:8.2f} MB sent | "
+          f"download {download:7.2f} s | parse {parse:6.2f} s")
+    return df, n_bytes, download, parse
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--n-cases", dest="n_cases", type=int, default=500)
+    arg_parser.add_argument("--excluded", dest="excluded", type=float, default=0.5,
+                            help="fraction of the cases of an excluded procedure, in steps of 0.1")
+    arg_parser.add_argument("--paragraphs", dest="paragraphs", type=int, default=20,
+                            help="paragraphs per section, which sets the size of a case")
+    arg_parser.add_argument("--latency", dest="latency", type=float, default=0.0, help="mean server latency in seconds")
+    arg_parser.add_argument("--workers", dest="workers", type=int, default=8)
+    args = arg_parser.parse_args()
+
+    n_excluded = round(args.excluded * 10)
+    procedures = [EXCLUDED] * n_excluded + [INCLUDED] * (10 - n_excluded)
+    parser = CaseParser(include_procedures=[INCLUDED])
+
+    with StandinServer(n_cases=args.n_cases, case_paragraphs=args.paragraphs, latency=args.latency,
+                       procedures=procedures) as server:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            full = run(server, Path(tmp_dir) / 'single_phase', parser, False, args)
+            two_phase = run(server, Path(tmp_dir) / 'two_phase', parser, True, args)
+
+    assert two_phase[0].equals(full[0]), "The two-phase fetch changed the parsed data"
+    print(f"Saved {(full[1] - two_phase[1]) / 1024 / 1024:.2f} MB ({1 - two_phase[1] / full[1]:.0%}) of downloads "
+          f"and {full[3] - two_phase[3]:.2f} s ({1 - two_phase[3] / full[3]:.0%}) of parsing; "
+          f"download time {full[2]:.2f} s -> {two_phase[2]:.2f} s")
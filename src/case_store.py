@@ -0,0 +1,464 @@
+import os
+import gzip
+import time
+import hashlib
+import tempfile
+import sqlite3
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+class CaseStore:
+    '''
+    Interface of the stores that hold the downloaded case xmls, keyed by ECLI
+    Used by CaseLoader to save cases and by CaseParser to read them
+    '''
+
+    def __contains__(self, ECLI):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def put(self, ECLI, content):
+        '''
+        Stores the case xml (bytes) of an ECLI, replacing an earlier version
+        '''
+        raise NotImplementedError
+
+    def put_file(self, ECLI, path):
+        '''
+        Stores the case xml in the file at `path`, which is moved into the store or removed
+        '''
+        with open(path, 'rb') as f:
+            self.put(ECLI, f.read())
+        os.remove(path)
+
+    def temp_file(self):
+        '''
+        Returns an open temporary file for `put_file`, on the same file system as the store
+        Temporary files end with '.part' and are never mistaken for stored cases
+        '''
+        return tempfile.NamedTemporaryFile(dir=self.root, suffix='.part', delete=False)
+
+    def get(self, ECLI):
+        '''
+        Returns the case xml of an ECLI as bytes; raises a KeyError if it is not stored
+        '''
+        raise NotImplementedError
+
+    def remove(self, ECLI):
+        raise NotImplementedError
+
+    def link(self, ECLI):
+        '''
+        Adds a case that is already held for another query to this store, without downloading it
+        Returns the sha256 of the case, or None if the store holds no other copy of it
+        Only a GlobalCaseStore shares cases between queries.
+        '''
+        return None
+
+    def keys(self):
+        raise NotImplementedError
+
+    def items(self, ECLIds=None):
+        '''
+        Yields (ECLI, case xml) pairs of all stored cases, or only of `ECLIds`
+        '''
+        for ECLI in (self.keys() if ECLIds is None else ECLIds):
+            yield ECLI, self.get(ECLI)
+
+    def update(self, other):
+        '''
+        Copies all cases of another store into this one
+        '''
+        for ECLI, content in other.items():
+            self.put(ECLI, content)
+
+
+class DirectoryCaseStore(CaseStore):
+    '''
+    Stores each case as a separate xml file in a directory
+
+    Files are written to a temporary file first and then renamed,
+    so an interrupted write never leaves a truncated case behind
+    '''
+
+    def __init__(self, case_dir):
+        self.root = Path(case_dir)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, ECLI):
+        # Paths cannot contain colons
+        return self.root / (ECLI.replace(':', '-') + '.xml')
+
+    def __contains__(self, ECLI):
+        return self.path(ECLI).exists()
+
+    def __len__(self):
+        return sum(1 for _ in self.root.glob('*.xml'))
+
+    def put(self, ECLI, content):
+        with self.temp_file() as f:
+            f.write(content)
+        self.put_file(ECLI, f.name)
+
+    def put_file(self, ECLI, path):
+        os.replace(path, self.path(ECLI))
+
+    def get(self, ECLI):
+        try:
+            with open(self.path(ECLI), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(ECLI)
+
+    def remove(self, ECLI):
+        os.remove(self.path(ECLI))
+
+    def keys(self):
+        return [path.stem.replace('-', ':') for path in self.root.glob('*.xml')]
+
+
+class ShardedCaseStore(CaseStore):
+    '''
+    Appends compressed cases to size-bounded shard files, instead of keeping one file per case
+
+    Each case is compressed separately, so it can be read on its own from its
+    (shard, offset, length) in the index. The index is a sqlite database next to the shards.
+    Iterating over the store reads the shards sequentially.
+
+    A case that is stored again is appended anew; the earlier version is no longer indexed.
+    '''
+
+    def __init__(self, root, compression='gzip', max_shard_size=256):
+        '''
+        root            directory holding the shards and the index
+        compression     'gzip' or 'zstd'; the latter requires the zstandard package
+        max_shard_size  size in MB after which a new shard is started
+        '''
+        self.root = Path(root)
+        os.makedirs(self.root, exist_ok=True)
+
+        self.max_shard_bytes = int(max_shard_size * 1024 * 1024)
+        self.compression = compression
+        if compression == 'gzip':
+            self.extension = 'gz'
+            self._compress = lambda content: gzip.compress(content, compresslevel=6)
+            self._decompress = gzip.decompress
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError("The 'zstd' compression of the case store requires the zstandard package")
+            self.extension = 'zst'
+            # (De)compressor objects are not thread-safe; these calls create one per call
+            self._compress = lambda content: zstandard.ZstdCompressor(level=10).compress(content)
+            self._decompress = lambda content: zstandard.ZstdDecompressor().decompress(content)
+        else:
+            raise ValueError(f"Unknown compression: {compression}")
+
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(str(self.root / 'index.sqlite'), check_same_thread=False)
+        with self.lock, self.index:
+            self.index.execute("PRAGMA journal_mode=WAL")
+            self.index.execute("""
+                CREATE TABLE IF NOT EXISTS cases (
+                    ECLI TEXT PRIMARY KEY,
+                    shard INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL
+                )""")
+            row = self.index.execute("SELECT MAX(shard) FROM cases").fetchone()
+        self.shard = row[0] if row[0] is not None else 0
+
+    def shard_path(self, shard):
+        return self.root / f'shard-{shard:05d}.{self.extension}'
+
+    def _locate(self, ECLI):
+        with self.lock:
+            return self.index.execute("SELECT shard, offset, length FROM cases WHERE ECLI = ?", (ECLI,)).fetchone()
+
+    def __contains__(self, ECLI):
+        return self._locate(ECLI) is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.index.execute("SELECT COUNT(*) FROM cases").fetchone()[0]
+
+    def put(self, ECLI, content):
+        compressed = self._compress(content)
+        with self.lock:
+            path = self.shard_path(self.shard)
+            if path.exists() and path.stat().st_size + len(compressed) > self.max_shard_bytes:
+                self.shard += 1
+                path = self.shard_path(self.shard)
+                log.info(f"Starting case store shard {path.name}")
+
+            with open(path, 'ab') as f:
+                offset = f.tell()
+                f.write(compressed)
+
+            # The case is only indexed once it is completely written
+            with self.index:
+                self.index.execute("INSERT OR REPLACE INTO cases (ECLI, shard, offset, length) VALUES (?, ?, ?, ?)",
+                                   (ECLI, self.shard, offset, len(compressed)))
+
+    def get(self, ECLI):
+        location = self._locate(ECLI)
+        if location is None:
+            raise KeyError(ECLI)
+        shard, offset, length = location
+        with open(self.shard_path(shard), 'rb') as f:
+            f.seek(offset)
+            return self._decompress(f.read(length))
+
+    def remove(self, ECLI):
+        with self.lock, self.index:
+            self.index.execute("DELETE FROM cases WHERE ECLI = ?", (ECLI,))
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.index.execute("SELECT ECLI FROM cases ORDER BY shard, offset")]
+
+    def items(self, ECLIds=None):
+        if ECLIds is not None:
+            yield from super().items(ECLIds)
+            return
+
+        # Read the shards sequentially in the order the cases were written
+        with self.lock:
+            locations = self.index.execute("SELECT ECLI, shard, offset, length FROM cases ORDER BY shard, offset").fetchall()
+
+        f, current = None, None
+        try:
+            for ECLI, shard, offset, length in locations:
+                if shard != current:
+                    if f is not None:
+                        f.close()
+                    f, current = open(self.shard_path(shard), 'rb'), shard
+                f.seek(offset)
+                yield ECLI, self._decompress(f.read(length))
+        finally:
+            if f is not None:
+                f.close()
+
+
+class GlobalCaseStore(CaseStore):
+    '''
+    A single store of cases shared by all query directories, so overlapping queries
+    do not download and store the same cases twice
+
+    Cases are stored once per distinct content, as 'objects/{sha256[:2]}/{sha256}.xml'.
+    Every query directory is a namespace holding references from its ECLIs to these objects;
+    an object is deleted when the last reference to it is removed or replaced.
+    The references and reference counts are kept in a sqlite database next to the objects,
+    which may be shared by several processes.
+
+    An instance gives access to the cases of one namespace; `link` adds a case
+    that another namespace already holds.
+    '''
+
+    def __init__(self, root, namespace):
+        '''
+        root        directory of the shared store, e.g. 'data/store'
+        namespace   name of the query directory using the store, e.g. its absolute path
+        '''
+        self.root = Path(root)
+        self.namespace = str(namespace)
+        os.makedirs(self.root / 'objects', exist_ok=True)
+
+        self.lock = threading.Lock()
+        # Transactions are started explicitly, see `_transaction`
+        self.index = sqlite3.connect(str(self.root / 'index.sqlite'), timeout=60, isolation_level=None,
+                                     check_same_thread=False)
+        self.index.execute("PRAGMA journal_mode=WAL")
+        with self._transaction():
+            self.index.execute("""
+                CREATE TABLE IF NOT EXISTS objects (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL
+                )""")
+            self.index.execute("""
+                CREATE TABLE IF NOT EXISTS refs (
+                    namespace TEXT NOT NULL,
+                    ECLI TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, ECLI)
+                )""")
+            self.index.execute("CREATE INDEX IF NOT EXISTS refs_by_ECLI ON refs (ECLI, stored_at)")
+
+    @contextmanager
+    def _transaction(self):
+        '''
+        Holds the write lock of the database, so objects are added and deleted
+        consistently with their reference counts, also by other processes
+        '''
+        with self.lock:
+            self.index.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.index.execute("ROLLBACK")
+                raise
+            self.index.execute("COMMIT")
+
+    def namespaced(self, namespace):
+        '''
+        Returns the store of another namespace in the same shared store
+        '''
+        return GlobalCaseStore(self.root, namespace)
+
+    def object_path(self, sha256):
+        return self.root / 'objects' / sha256[:2] / (sha256 + '.xml')
+
+    def _ref(self, ECLI):
+        with self.lock:
+            row = self.index.execute("SELECT sha256 FROM refs WHERE namespace = ? AND ECLI = ?",
+                                     (self.namespace, ECLI)).fetchone()
+        return row[0] if row is not None else None
+
+    def __contains__(self, ECLI):
+        return self._ref(ECLI) is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.index.execute("SELECT COUNT(*) FROM refs WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+
+    def put(self, ECLI, content):
+        with self.temp_file() as f:
+            f.write(content)
+        self.put_file(ECLI, f.name)
+
+    def put_file(self, ECLI, path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                sha256.update(chunk)
+        sha256 = sha256.hexdigest()
+
+        with self._transaction():
+            old = self._select_ref(ECLI)
+            if old == sha256:
+                os.remove(path)
+                return
+
+            row = self.index.execute("SELECT refcount FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+            if row is not None:
+                # The same content is already stored, e.g. by another query
+                os.remove(path)
+                self.index.execute("UPDATE objects SET refcount = refcount + 1 WHERE sha256 = ?", (sha256,))
+            else:
+                size = os.path.getsize(path)
+                os.makedirs(self.object_path(sha256).parent, exist_ok=True)
+                os.replace(path, self.object_path(sha256))
+                self.index.execute("INSERT INTO objects (sha256, size, refcount) VALUES (?, ?, 1)", (sha256, size))
+
+            self.index.execute("INSERT OR REPLACE INTO refs (namespace, ECLI, sha256, stored_at) VALUES (?, ?, ?, ?)",
+                               (self.namespace, ECLI, sha256, time.time()))
+            if old is not None:
+                self._release(old)
+
+    def _select_ref(self, ECLI):
+        # Only within a transaction
+        row = self.index.execute("SELECT sha256 FROM refs WHERE namespace = ? AND ECLI = ?",
+                                 (self.namespace, ECLI)).fetchone()
+        return row[0] if row is not None else None
+
+    def _release(self, sha256):
+        # Only within a transaction; deletes the object when nothing refers to it anymore
+        self.index.execute("UPDATE objects SET refcount = refcount - 1 WHERE sha256 = ?", (sha256,))
+        row = self.index.execute("SELECT refcount FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is not None and row[0] <= 0:
+            self.index.execute("DELETE FROM objects WHERE sha256 = ?", (sha256,))
+            try:
+                os.remove(self.object_path(sha256))
+            except FileNotFoundError:
+                pass
+
+    def get(self, ECLI):
+        sha256 = self._ref(ECLI)
+        if sha256 is None:
+            raise KeyError(ECLI)
+        with open(self.object_path(sha256), 'rb') as f:
+            return f.read()
+
+    def remove(self, ECLI):
+        with self._transaction():
+            sha256 = self._select_ref(ECLI)
+            if sha256 is None:
+                raise KeyError(ECLI)
+            self.index.execute("DELETE FROM refs WHERE namespace = ? AND ECLI = ?", (self.namespace, ECLI))
+            self._release(sha256)
+
+    def link(self, ECLI):
+        with self._transaction():
+            sha256 = self._select_ref(ECLI)
+            if sha256 is not None:
+                return sha256
+
+            # The most recently stored version of the case in any namespace
+            row = self.index.execute("SELECT sha256 FROM refs WHERE ECLI = ? ORDER BY stored_at DESC LIMIT 1",
+                                     (ECLI,)).fetchone()
+            if row is None:
+                return None
+            sha256 = row[0]
+            self.index.execute("INSERT INTO refs (namespace, ECLI, sha256, stored_at) VALUES (?, ?, ?, ?)",
+                               (self.namespace, ECLI, sha256, time.time()))
+            self.index.execute("UPDATE objects SET refcount = refcount + 1 WHERE sha256 = ?", (sha256,))
+            return sha256
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.index.execute("SELECT ECLI FROM refs WHERE namespace = ? ORDER BY ECLI",
+                                                         (self.namespace,))]
+
+    def stats(self):
+        '''
+        Returns the amount of references and of stored objects and their total size in bytes
+        '''
+        with self.lock:
+            n_refs = self.index.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+            n_objects, n_bytes = self.index.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects").fetchone()
+        return {'references': n_refs, 'objects': n_objects, 'bytes': n_bytes}
+
+
+def open_case_store(store, case_dir, compression='gzip', max_shard_size=256, global_dir=None, namespace=None):
+    '''
+    Opens a case store by type:
+    'directory' keeps one xml file per case in `case_dir`,
+    'sharded' appends compressed cases to shard files in `case_dir`,
+    'global' references the cases of `namespace` in the store shared by all queries in `global_dir`
+    '''
+    if store == 'directory':
+        return DirectoryCaseStore(case_dir)
+    if store == 'sharded':
+        return ShardedCaseStore(case_dir, compression=compression, max_shard_size=max_shard_size)
+    if store == 'global':
+        if global_dir is None or namespace is None:
+            raise ValueError("The global case store requires a directory and a namespace")
+        return GlobalCaseStore(global_dir, namespace)
+    raise ValueError(f"Unknown case store: {store}")
+
+
+if __name__ == '__main__':
+    # Converts a directory of loose case xmls into a sharded case store
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="Copies the case xmls of a directory into a sharded case store")
+    arg_parser.add_argument('case_dir', help="directory holding the case xmls, e.g. data/query/cases")
+    arg_parser.add_argument('archive_dir', help="directory of the sharded case store, e.g. data/query/archive")
+    arg_parser.add_argument('--compression', default='gzip', choices=['gzip', 'zstd'])
+    arg_parser.add_argument('--max-shard-size', type=float, default=256, help="shard size in MB")
+    args = arg_parser.parse_args()
+
+    store = ShardedCaseStore(args.archive_dir, compression=args.compression, max_shard_size=args.max_shard_size)
+    store.update(DirectoryCaseStore(args.case_dir))
+    log.info(f"{len(store)} cases in {args.archive_dir}")
@@ -1,12 +1,26 @@
 import requests
+import time
+import hashlib
 import os
 import regex
-import feedparser as fp
-import glob
 from pathlib import Path
-from datetime import datetime
+import json
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from collections import Counter
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from src.caseparser import CaseParser
-from src.utils import get_logger, construct_ECLI_query
+from src.http_client import HttpClient
+from src.ledger import DownloadLedger
+from src.case_store import CaseStore, DirectoryCaseStore, GlobalCaseStore
+from src.feed_index import FeedIndex, feed_metadata, result_feeds
+from src.shards import select_shard
+from src.sampling import stratified_order, log_coverage
+from src.feed_filter import FeedFilter
+from src.metadata_filter import MetadataFilter, read_metadata
+from src.telemetry import DownloadMetrics
+from src.utils import get_logger, construct_ECLI_query, query_fingerprint
 
 log = get_logger(__name__)
 
@@ -16,15 +30,59 @@ class CaseLoader:
     Class for querying the ECLI index of Open Data van de Rechtspraak
     '''
 
-    def __init__(self, out_dir='./data'):
+    # Case downloads are streamed to disk in chunks of this many bytes
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, out_dir='./data', max_workers=1, http=None, store=None,
+                 base_url='https://data.rechtspraak.nl/uitspraken', revalidate=False, shard_index=0, num_shards=1,
+                 feed_filter=None, metrics=None, metadata_filter=None):
         '''
         out_dir     optionally specify data subfolder to store query results in
+        max_workers number of threads used to download cases; 1 downloads them one by one
+        http        HttpClient shared by all requests; by default one with a connection per thread
+        store       CaseStore to save the cases in; by default one xml file per case under 'cases'
+        base_url    URL of the open data API, e.g. of a local stand-in server (see src.standin_server)
+        revalidate  check with conditional requests whether feeds and cases on disk are still current,
+                    and only download them again if they changed
+        shard_index only request the ECLIs of this shard out of `num_shards`, see src.shards
+        feed_filter FeedFilter that skips ECLIs of the feeds before they are requested, e.g. by court
+        metrics     DownloadMetrics that records latencies, sizes, status codes and outcomes of the requests;
+                    by default these are only logged, see src.telemetry
+        metadata_filter MetadataFilter for a two-phase fetch: the metadata of each case is requested first,
+                    and only cases it keeps (e.g. of the procedures the parser includes) are downloaded
         '''
         super().__init__()
 
         self.out_dir = Path(out_dir)
         os.makedirs(self.out_dir, exist_ok=True)
 
+        self.max_workers = max(1, int(max_workers))
+
+        # The ECLI index is queried at '{base_url}/zoeken', cases are requested at '{base_url}/content'
+        self.base_url = base_url.rstrip('/')
+        self.revalidate = revalidate
+
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"Shard index {shard_index} out of range for {num_shards} shards")
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+
+        # By default all ECLIs of the feeds are requested
+        self.feed_filter = feed_filter if feed_filter is not None else FeedFilter()
+        self.metadata_filter = metadata_filter if metadata_filter is not None else MetadataFilter()
+
+        self.metrics = metrics if metrics is not None else DownloadMetrics()
+
+        # Takes care of connection pooling, retries, rate limiting and circuit breaking
+        self.http = http if http is not None else HttpClient(pool_size=self.max_workers, metrics=self.metrics)
+
+        # Where the downloaded cases are saved
+        self.store = store if store is not None else DirectoryCaseStore(self.out_dir / 'cases')
+
+        # Records the outcome of every case request, such that reruns do not
+        # download cases again that were rejected before
+        self.ledger = DownloadLedger(self.out_dir / "ledger.sqlite")
+
         # TODO params to constructor required?
         self.parser = CaseParser()
 
@@ -34,157 +92,672 @@ class CaseLoader:
         # File where information on the query is stored
         self.query_info = self.out_dir / "query.info"
 
-        # Simple regex for parsing the amount of cases returned by query
-        # i.e. not taking into account the provided value for the field 'max'
-        self.match_nr = regex.compile(r'\d+')
+        # Name of the cached ECLIs of the result feeds, next to 'query_ECLIds.txt'
+        self.feed_index = "query_ECLIds.json"
 
-    def query_ECLI_index(self, query, idx_from=1, retrieve_all = False, already_retrieved=0):
+        # Where the feeds of the last query are stored, see `feed_dir_of`
+        self.feed_dir = self.out_dir
+
+    def feed_dir_of(self, query):
+        '''
+        Returns the directory of the result feeds of a query: 'feeds/{fingerprint}' in `out_dir`,
+        so the feeds of different queries are cached side by side (see utils.query_fingerprint)
+
+        Feeds stored directly in `out_dir` by earlier versions are still used
+        if their 'query.info' shows they are the results of the same query.
+        '''
+        legacy_info = self.out_dir / self.query_info.name
+        if legacy_info.is_file():
+            url = legacy_info.read_text().partition('Query: ')[2].strip()
+            if query_fingerprint(url.partition('?')[2]) == query_fingerprint(query):
+                return self.out_dir
+        return self.out_dir / 'feeds' / query_fingerprint(query)
+
+    def query_ECLI_index(self, query, idx_from=1, retrieve_all=False, feed_dir=None):
         '''
         This function queries the ECLI index and saves the response to disk
         You can use utils.construct_ECLI_query() for composing the query parameter
+
+        With `retrieve_all`, all pages of results are retrieved: once the first page reports
+        the total amount of hits, the offsets of the remaining pages are known
+        and these are requested concurrently. Pages already on disk are not requested again.
+
+        feed_dir    where to store the result feeds; defaults to the directory of the query, see `feed_dir_of`
         '''
-        url = 'http://data.rechtspraak.nl/uitspraken/zoeken?' + query
+        if feed_dir is None:
+            feed_dir = self.feed_dir = self.feed_dir_of(query)
+            log.info(f"Result feeds of the query are cached in {feed_dir}")
+        feed_dir = Path(feed_dir)
+        os.makedirs(feed_dir, exist_ok=True)
+
+        url = f'{self.base_url}/zoeken?' + query
 
         # Record information on the query
-        if not self.query_info.is_file():
-            with open(self.query_info, "w") as f:
+        query_info = feed_dir / self.query_info.name
+        if not query_info.is_file():
+            with open(query_info, "w") as f:
                 f.write(f"Query: {url}")
 
+        # Pages on disk are read from the cached index unless the feed changed
+        index = FeedIndex(feed_dir / self.feed_index)
+        try:
+            self._query_pages(query, idx_from, retrieve_all, feed_dir, index)
+        finally:
+            index.save()
+
+    def _query_pages(self, query, idx_from, retrieve_all, feed_dir, index):
+        # The first page tells how many ECLIs match the query
+        n_hits, n_retrieved = self._query_page(query, idx_from, feed_dir, index)
+        log.info(f"Retrieved {n_retrieved} cases from total of {n_hits}")
+
+        if not retrieve_all or n_retrieved == 0:
+            return
+
+        # Without a 'from' parameter the index returns results from the start,
+        # but by convention that first page is stored as 'results_from_1'
+        first_offset = 0 if idx_from == 1 else idx_from
+        page_size = n_retrieved
+        offsets = list(range(first_offset + page_size, n_hits, page_size))
+        if len(offsets) == 0:
+            return
+
+        log.info(f"Retrieving {len(offsets)} more pages of {page_size} results")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pages = executor.map(partial(self._query_page, query, feed_dir=feed_dir, index=index), offsets)
+            already_retrieved = n_retrieved + sum(n for _, n in pages)
+
+        # Progress
+        log.info(f"Retrieved {already_retrieved} cases from total of {n_hits}")
+        if already_retrieved < n_hits:
+            log.warning(f"{n_hits - already_retrieved} matching ECLIs are missing from the results; "
+                        "the index may have changed while querying")
+
+    @staticmethod
+    def _with_offset(query, idx_from):
+        '''
+        Sets the 'from' parameter of the query
+        '''
+        if regex.search(r'(^|&)from=\d+', query):
+            return regex.sub(r'(^|&)from=\d+', f"\\g<1>from={idx_from}", query)
+        return query + f'&from={idx_from}'
+
+    def _query_page(self, query, idx_from, feed_dir, index):
+        '''
+        Retrieves the page of query results starting from `idx_from`, unless it is already on disk
+        In revalidate mode a page on disk is requested again, but only rewritten if it changed
+        Returns the total amount of hits and the amount of ECLIs in the page
+        '''
         # Modify result feed name with 'from' index
-        results = self.out_dir / Path( self.results.stem + f"_from_{idx_from}" + self.results.suffix)
+        results = feed_dir / Path( self.results.stem + f"_from_{idx_from}" + self.results.suffix)
 
         # If result already exists, do nothing; otherwise query and download the results
-        if not results.is_file():
-            #log.info("Query:", url)
+        on_disk = results.is_file()
+        if not on_disk or self.revalidate:
+            if idx_from != 1:
+                query = self._with_offset(query, idx_from)
+            url = f'{self.base_url}/zoeken?' + query
             log.info(f"Query: {url}")
-            r = requests.get(url, allow_redirects=True)
+            headers = self._conditional_headers(self.ledger.feed(results)) if on_disk else {}
+            start = time.perf_counter()
+            try:
+                r = self.http.get(url, headers=headers)
+            except requests.RequestException:
+                self.metrics.record_request('feed', time.perf_counter() - start)
+                raise
+            self.metrics.record_request('feed', time.perf_counter() - start, r.status_code, len(r.content))
+            r.raise_for_status()
             log.info(f"Retrieving cases starting from index {idx_from}")
 
-            # Parse the returned atom feed to check how many ECLIs match the query
-            # and also how many are returned in the feed itself
-            d = fp.parse(r.content)
-            n_hits = int(self.match_nr.search(d.feed.subtitle).group(0))
-            ECLIds = [ entry.id for entry in d.entries ]
-            n_retrieved = len(ECLIds)
-            already_retrieved += n_retrieved
-
-            with open(results, 'wb') as f:
-                f.write(r.content)
-            log.info(f"Query results starting from index {idx_from} saved on disk")
+            if r.status_code == 304:
+                log.info(f"Query results starting from index {idx_from} on disk are unchanged")
+            else:
+                with open(results, 'wb') as f:
+                    f.write(r.content)
+                self.ledger.record_feed(results, etag=r.headers.get('ETag'),
+                                        last_modified=r.headers.get('Last-Modified'))
+                log.info(f"Query results starting from index {idx_from} saved on disk")
         else:
-            log.info("Query results already present on disk")
-            # This case I ALSO need to increment with the amount of ECLIds
-            # in the feed that's already on disk. This allows correct querying
-            # if some results are present while others are not.
-            d = fp.parse(results)
-            ECLIds = [ entry.id for entry in d.entries ]
-            n_retrieved = len(ECLIds)
-            already_retrieved += n_retrieved
-            n_hits = int(self.match_nr.search(d.feed.subtitle).group(0))
+            log.info(f"Query results starting from index {idx_from} already present on disk")
 
-        # Progress
-        log.info(f"Retrieved {already_retrieved} cases from total of {n_hits}")
+        # Check how many ECLIs match the query and how many are returned in the feed itself
+        n_hits, ECLIds, _ = index.read(results)
+        return n_hits, len(ECLIds)
 
-        # If we want to retrieve all cases returned by the query,
-        # we need to repeat the query with the 'from' parameter
-        if retrieve_all and n_hits > already_retrieved:
-            new_idx_from = already_retrieved
-            # Repeat the query but now from the first not-returned ECLI
-            if 'from' in query:
-                new_query = regex.sub(r'from=\d+', f"from={new_idx_from}", query)
-            else:
-                new_query = query + f'&from={new_idx_from}'
+    @staticmethod
+    def _conditional_headers(validators):
+        '''
+        Headers that make the server respond with 304 Not Modified if our copy is still current
+        validators  ledger entry with the 'etag' and 'last_modified' of our copy, or None
+        '''
+        headers = {}
+        if validators is not None:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def _as_store(self, out_dir):
+        '''
+        Cases are saved in the store of the loader, unless another store or directory is given
+        '''
+        if out_dir is None:
+            return self.store
+        if isinstance(out_dir, CaseStore):
+            return out_dir
+        if isinstance(self.store, GlobalCaseStore):
+            # Another directory is another namespace in the shared store
+            return self.store.namespaced(Path(out_dir).resolve())
+        return DirectoryCaseStore(out_dir)
+
+    def _request_case(self, ECLI, out_dir=None, check_section_labels=True, verbose=False, overwrite=False):
+        '''
+        ECLI        case identifier string
+        out_dir     CaseStore or directory to save the case in; defaults to the store of the loader
+        overwrite   download the case again even if it is on disk or was rejected before
+
+        Returns the status of the request:
+        'saved' if the case is downloaded and written to disk,
+        'updated' if the case is downloaded again and overwrites the case on disk,
+        'exists' if the case was already on disk (and in revalidate mode, is unchanged),
+        'linked' if the case was not downloaded because a shared store already holds it for another query,
+        'rejected' if the case lacks section labels and is not saved,
+        'excluded' if the metadata filter excludes the case, which is therefore not downloaded and
+        'failed' if the case could not be downloaded
+        '''
+        status, reason = self._fetch_case(ECLI, out_dir, check_section_labels, verbose, overwrite)
+        self.metrics.record_outcome(status, reason)
+        return status
 
-            # Recurse
-            self.query_ECLI_index(new_query,
-                    idx_from=new_idx_from,
-                    retrieve_all=True,
-                    already_retrieved=already_retrieved)
+    def _fetch_case(self, ECLI, out_dir, check_section_labels, verbose, overwrite):
+        '''
+        Does the work of `_request_case`; returns its status and why a case is rejected
+        '''
 
-    def _request_case(self, ECLI, out_dir=None, check_section_labels=True, verbose=False):
+        store = self._as_store(out_dir)
+
+        url = f'{self.base_url}/content?id={ECLI}'
+        existed = ECLI in store
+        revalidate = existed and self.revalidate and not overwrite
+        if existed and not overwrite and not revalidate:
+            if verbose: log.info(f"Case already exists: {ECLI}")
+            return 'exists', None
+
+        # Cases that were rejected on an earlier run are not requested again
+        if check_section_labels and not overwrite and self.ledger.status(ECLI) == 'rejected':
+            if verbose: log.info(f"{ECLI} was rejected before")
+            return 'rejected', self.ledger.get(ECLI)['reason']
+
+        # Likewise for cases whose metadata excluded them on an earlier run of a two-phase fetch,
+        # as long as the current metadata filter still excludes the recorded metadata
+        metadata = None
+        if self.metadata_filter and not overwrite and self.ledger.status(ECLI) == 'excluded':
+            metadata = self.ledger.metadata(ECLI)
+            reason = self.metadata_filter.reason_for(*metadata) if metadata is not None else None
+            if reason is not None:
+                if verbose: log.info(f"{ECLI} was excluded before")
+                return 'excluded', reason
+
+        # A case stored for another query is referenced instead of downloaded again
+        sha256 = store.link(ECLI) if not existed and not overwrite else None
+        if sha256 is not None:
+            reason = self.parser.section_label_reason(store.get(ECLI)) if check_section_labels else None
+            if reason is not None:
+                store.remove(ECLI)
+                self.ledger.record(ECLI, 'rejected', reason=reason, sha256=sha256)
+                return 'rejected', reason
+            if verbose: log.info(f"{ECLI} linked from the shared case store")
+            self.ledger.record(ECLI, 'saved', sha256=sha256)
+            return 'linked', None
+
+        # In a two-phase fetch the small metadata of a new case decides whether it is downloaded at all
+        if self.metadata_filter and not existed and metadata is None:
+            try:
+                metadata = self._request_metadata(ECLI)
+            except requests.RequestException as e:
+                log.error(f"Requesting the metadata of {ECLI} failed: {e}")
+                self.ledger.record(ECLI, 'failed', reason=str(e))
+                return 'failed', None
+            reason = self.metadata_filter.reason_for(*metadata)
+            if reason is not None:
+                if verbose: log.info(f"{ECLI} NOT DOWNLOADED ({reason})")
+                self.ledger.record(ECLI, 'excluded', reason=reason, metadata=metadata)
+                return 'excluded', reason
+
+        # Only download the case again if it changed since we stored it
+        entry = self.ledger.get(ECLI) if revalidate else None
+        headers = self._conditional_headers(entry)
+
+        # Download content; the response is streamed to a temporary file and hashed on the way,
+        # and requested again if it breaks off
+        if verbose: log.info(f"URL: {url}")
+        start = time.perf_counter()
+        try:
+            r, (tmp, n_bytes, sha256) = self.http.download(url, partial(self._download, store=store), headers=headers)
+        except requests.RequestException as e:
+            # Do not abort the whole crawl; the case is requested again on the next run
+            log.error(f"Requesting {url} failed: {e}")
+            self.metrics.record_request('case', time.perf_counter() - start)
+            self.ledger.record(ECLI, 'failed', reason=str(e))
+            return 'failed', None
+        self.metrics.record_request('case', time.perf_counter() - start, r.status_code, n_bytes)
+
+        if r.status_code == 304:
+            if verbose: log.info(f"Case unchanged: {ECLI}")
+            self.ledger.record(ECLI, 'saved', http_status=r.status_code, n_bytes=entry['n_bytes'],
+                               etag=r.headers.get('ETag', entry['etag']),
+                               last_modified=r.headers.get('Last-Modified', entry['last_modified']),
+                               sha256=entry['sha256'])
+            return 'exists', None
+
+        if r.status_code != 200:
+            log.error(f"Requesting {url} failed with status code {r.status_code}")
+            self.ledger.record(ECLI, 'failed', http_status=r.status_code, n_bytes=n_bytes)
+            return 'failed', None
+
+        try:
+            if check_section_labels:
+                with open(tmp, 'rb') as f:
+                    reason = self.parser.section_label_reason(f)
+                if reason is not None:
+                    if verbose: log.info(f"{ECLI} NOT SAVED due to missing section labels ({reason})")
+                    if existed:
+                        # The case no longer has section labels; do not keep the outdated version
+                        store.remove(ECLI)
+                    self.ledger.record(ECLI, 'rejected', http_status=r.status_code, n_bytes=n_bytes, reason=reason,
+                                       etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'),
+                                       sha256=sha256)
+                    return 'rejected', reason
+
+            # Moves the complete download into place, so a case in the store is never truncated
+            store.put_file(ECLI, tmp)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        if verbose: log.info(f"Saving {ECLI}")
+        self.ledger.record(ECLI, 'saved', http_status=r.status_code, n_bytes=n_bytes,
+                           etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'), sha256=sha256)
+
+        return ('updated' if existed else 'saved'), None
+
+    def _request_metadata(self, ECLI):
+        '''
+        Requests only the metadata of a case (return=META) and returns its procedure and subjects
+        (see metadata_filter.read_metadata)
+        '''
+        url = f'{self.base_url}/content?id={ECLI}&return=META'
+        start = time.perf_counter()
+        try:
+            r = self.http.get(url)
+        except requests.RequestException:
+            self.metrics.record_request('meta', time.perf_counter() - start)
+            raise
+        self.metrics.record_request('meta', time.perf_counter() - start, r.status_code, len(r.content))
+        r.raise_for_status()
+        return read_metadata(r.content)
+
+    def _download(self, r, store):
+        '''
+        Streams the body of a 200 response to a temporary file of the store while hashing it
+        Returns the path of the file, the amount of bytes and their sha256 hash;
+        the file and the hash are None for other responses
         '''
-        ECLI    case identifier string
+        if r.status_code != 200:
+            return None, len(r.content), None
+
+        sha256 = hashlib.sha256()
+        n_bytes = 0
+        f = store.temp_file()
+        try:
+            with f:
+                for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    n_bytes += len(chunk)
+        except BaseException:
+            # e.g. the connection broke off; do not leave the partial download behind
+            os.remove(f.name)
+            raise
+        return f.name, n_bytes, sha256.hexdigest()
+
+    def _request_cases(self, ECLIds, out_dir=None, check_section_labels=True, overwrite=False):
         '''
+        Requests a list of cases, concurrently if `max_workers` > 1
+        The stored cases are the same whether or not the cases are downloaded concurrently
 
-        # Make output_dir if it doesn't exist yet
-        os.makedirs(out_dir, exist_ok=True)
+        Returns a Counter with the amount of cases per request status (see `_request_case`)
+        '''
+        out_dir = self._as_store(out_dir)
 
-        if out_dir == None:
-            out_dir = self.out_dir
+        # A duplicate ECLI could otherwise be written to the same file by two threads
+        ECLIds = list(dict.fromkeys(ECLIds))
 
-        url = f'https://data.rechtspraak.nl/uitspraken/content?id={ECLI}'
-        # Paths cannot contain colons
-        ECLI = ECLI.replace(':','-') + '.xml'
-        outfile = out_dir / ECLI
-        if not outfile.exists():
-            # Download content
-            if verbose: log.info(f"URL: {url}")
-            r = requests.get(url, allow_redirects=True)
-            if check_section_labels:
-                if self.parser.check_section_labels(r.content):
-                    with open(outfile, 'wb') as f:
-                        f.write(r.content)
-                        if verbose: log.info(f"SAVING {ECLI}") # to {outfile}")
-                else:
-                    if verbose: log.info(f"{ECLI} NOT SAVED due to missing section labels")
-                    return False
-            else:
-                with open(outfile, 'wb') as f:
-                    f.write(r.content)
-                    if verbose: log.info(f"Saving {ECLI}")  # to {outfile}")
-        else:
-            if verbose: log.info(f"File already exists: {outfile}")
+        request = partial(self._request_case, out_dir=out_dir, check_section_labels=check_section_labels,
+                          overwrite=overwrite)
 
-        return True
+        executor = None
+        futures = []
+        if self.max_workers > 1:
+            log.info(f"Downloading {len(ECLIds)} cases with {self.max_workers} threads")
+            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            futures = [executor.submit(request, ECLI) for ECLI in ECLIds]
+            statuses = (future.result() for future in futures)
+        else:
+            statuses = map(request, ECLIds)
+
+        counts = Counter()
+        try:
+            for i, status in enumerate(statuses, start=1):
+                counts[status] += 1
+                if i % 1000 == 0:
+                    log.info(f"{counts['saved'] + counts['updated'] + counts['exists'] + counts['linked']} ECLIs on disk "
+                             f"({i}/{len(ECLIds)} requested)")
+        finally:
+            if executor is not None:
+                # Do not start pending downloads if one of the requests failed
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
+
+        return counts
+
+    def _log_request_counts(self, counts):
+        self.metrics.report()
+        log.info(f"{counts['saved']} cases saved, {counts['exists'] + counts['rejected']} skipped "
+                 f"({counts['exists']} already on disk, {counts['rejected']} without section labels)")
+        if counts['excluded']:
+            self._log_bandwidth_saved(counts['excluded'])
+        if counts['linked']:
+            log.info(f"{counts['linked']} cases taken from the shared case store without downloading them")
+        if counts['updated']:
+            log.info(f"{counts['updated']} cases on disk updated")
+        if counts['failed']:
+            log.warning(f"{counts['failed']} cases failed to download; rerun to request them again")
+
+    def _log_bandwidth_saved(self, n_excluded):
+        '''
+        Estimates the bandwidth saved by a two-phase fetch from the mean size of the downloaded cases
+        '''
+        size = self.metrics.summary()['size_kb']
+        case, meta = size.get('case'), size.get('meta')
+        log.info(f"{n_excluded} cases excluded by their metadata were not downloaded")
+        if case and case['n'] and meta and meta['n']:
+            saved = n_excluded * case['mean'] - meta['n'] * meta['mean']
+            log.info(f"The two-phase fetch saved about {saved / 1024:.1f} MB: {n_excluded} cases of "
+                     f"{case['mean']:.1f} KB on average, for {meta['n']} metadata requests of {meta['mean']:.1f} KB")
+
+    def stream_cases(self, ECLIds, out_dir=None, check_section_labels=True, queue_size=64):
+        '''
+        Generator that requests a list of cases and yields the ECLI of each case in the store
+        as soon as its download is finished, so that the consumer (e.g. CaseParser.parse_store)
+        can process cases while the remaining ones are still downloading
 
-    def request_cases_from_feed(self, check_section_labels=True):
+        queue_size      maximum amount of cases that are downloading or waiting to be consumed;
+                        if the consumer is slower than the downloads, new downloads wait for it
         '''
-        This function requests cases from the returned atom feeds
-        from rechtspraak.nl; it saves them to disk if they pass
-        a test that checks if they have labelled sections
+        out_dir = self._as_store(out_dir)
+
+        # A duplicate ECLI could otherwise be written to the same file by two threads
+        ECLIds = list(dict.fromkeys(ECLIds))
+        queue_size = max(queue_size, 1)
+
+        def request(ECLI):
+            return ECLI, self._request_case(ECLI, out_dir, check_section_labels)
+
+        pending = iter(ECLIds)
+        in_flight = set()
+        counts = Counter()
+        log.info(f"Streaming {len(ECLIds)} cases with {self.max_workers} download threads")
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while True:
+                # Finished cases that are not yet consumed were taken from `in_flight`,
+                # so together they never exceed `queue_size`
+                for ECLI in islice(pending, queue_size - len(in_flight)):
+                    in_flight.add(executor.submit(request, ECLI))
+                if not in_flight:
+                    break
+
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    ECLI, status = future.result()
+                    counts[status] += 1
+                    if status in ('saved', 'updated', 'exists', 'linked'):
+                        yield ECLI
+        finally:
+            # Stop downloading if the consumer stops early or a request failed
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown()
+
+        self._log_request_counts(counts)
+
+    def _ECLIds_from_feeds(self, feed_dir=None):
+        '''
+        Reads the ECLIs from the atom feeds on disk and writes them to an index
+        Feeds that did not change since they were last read are not parsed again
+        Returns the ECLIs that pass the feed filter, or None if no feeds are available
+        feed_dir    defaults to the feeds of the last query
         '''
+        feed_dir = self.feed_dir if feed_dir is None else Path(feed_dir)
 
-        # Result feeds have the format 'results_from_{x}.atom'
-        results = list(glob.iglob(str(self.out_dir / 'results_from*atom'), recursive=False))
+        # Result feeds have the format 'results_from_{x}.atom'; keep the order of the results
+        results = result_feeds(feed_dir)
 
         if len(results) == 0:
             log.info("Submit a query first. Results not available.")
             return
 
-        # Where to store the case xmls
-        case_dir = self.out_dir / 'cases'
-
-        counter = 0
+        index = FeedIndex(feed_dir / self.feed_index)
         all_ECLIds = []
+        all_titles = []
         for result in results:
 
             # Retrieve a list of ECLI from the result feed stored on disk
-            d = fp.parse(result)
-
-            # Retrieve case numbers in the current feed
-            ECLIds = [entry.id for entry in d.entries]
-            # log.info(f"Queried ECLIs: {len(ECLIds)}")
+            _, ECLIds, titles = index.read(result)
 
             # Keep track of all ECLIds
             all_ECLIds.append(ECLIds)
-
-            # Retrieve each ECLId and store under 'cases'
-            for ECLI in ECLIds:
-                success = self._request_case(ECLI, case_dir, check_section_labels)
-                if success:
-                    counter += 1
-
-            log.info(f"{counter} ECLIs on disk")
+            all_titles.append(titles)
+        index.save()
 
         # flatten list
         ECLIds = [ECLI for ECLI_list in all_ECLIds for ECLI in ECLI_list]
+        titles = [title for title_list in all_titles for title in title_list]
 
-        with open(self.out_dir / 'query_ECLIds.txt', 'w') as f:
+        with open(feed_dir / 'query_ECLIds.txt', 'w') as f:
             f.writelines(f"{ECLI}\n" for ECLI in ECLIds)
             log.info("All query ECLI written to index")
 
-        # Return the location of the returned cases
-        return case_dir
+        if self.feed_filter:
+            ECLIds = self._apply_feed_filter(ECLIds, titles, feed_dir)
+
+        return ECLIds
+
+    def feed_metadata(self, feed_dir=None, out_fn='feed_metadata.parquet'):
+        '''
+        Builds a table of the metadata in the result feeds (court, date, case numbers, summary, update time)
+        without downloading any case, see feed_index.feed_metadata
+        The table is written as Parquet in the feed directory; this requires the pyarrow package
+
+        feed_dir    defaults to the feeds of the last query
+        out_fn      None only returns the table
+        Returns the table, or None if no feeds are available
+        '''
+        feed_dir = self.feed_dir if feed_dir is None else Path(feed_dir)
+        results = result_feeds(feed_dir)
+        if len(results) == 0:
+            log.info("Submit a query first. Results not available.")
+            return None
+
+        df = feed_metadata(results)
+        log.info(f"Feed metadata of {len(df)} ECLIs of {df['court_code'].nunique()} courts")
+        dates = df['date'].dropna()
+        if len(dates):
+            log.info(f"Decided between {dates.min():%Y-%m-%d} and {dates.max():%Y-%m-%d}")
+        if out_fn is not None:
+            df.to_parquet(feed_dir / out_fn, index=False)
+            log.info(f"Feed metadata written to {feed_dir / out_fn}")
+        return df
+
+    def _apply_feed_filter(self, ECLIds, titles, feed_dir):
+        '''
+        Skips the ECLIs excluded by the feed filter; these are listed in 'filtered_ECLIds.txt'
+        '''
+        kept, excluded = self.feed_filter.apply(ECLIds, titles)
+        with open(feed_dir / 'filtered_ECLIds.txt', 'w') as f:
+            f.writelines(f"{ECLI}\t{reason}\n" for ECLI, reason in excluded)
+
+        # Excluded cases that are on disk or were rejected before would not have been downloaded anyway
+        saved = sum(1 for ECLI, _ in excluded if ECLI not in self.store and self.ledger.status(ECLI) is None)
+        log.info(f"Feed filter saved {saved} downloads; {len(kept)} of {len(ECLIds)} ECLIs are requested")
+        return kept
+
+    def _own_shard(self, ECLIds):
+        '''
+        Keeps the ECLIs of the shard of this loader
+        '''
+        if self.num_shards == 1:
+            return ECLIds
+        own = select_shard(ECLIds, self.shard_index, self.num_shards)
+        log.info(f"Shard {self.shard_index} of {self.num_shards}: {len(own)} of {len(ECLIds)} ECLIs")
+        return own
+
+    def request_cases_from_feed(self, check_section_labels=True):
+        '''
+        This function requests cases from the returned atom feeds
+        from rechtspraak.nl; it saves them to disk if they pass
+        a test that checks if they have labelled sections
+        '''
+        ECLIds = self._ECLIds_from_feeds()
+        if ECLIds is None:
+            return
+
+        # Retrieve each ECLId and save it in the case store
+        counts = self._request_cases(self._own_shard(ECLIds), self.store, check_section_labels)
+        log.info(f"{counts['saved'] + counts['exists'] + counts['linked']} ECLIs on disk")
+        self._log_request_counts(counts)
+
+        # Return the store holding the returned cases
+        return self.store
+
+    def request_sample_from_feed(self, size=None, time_budget=None, seed=2021, check_section_labels=True):
+        '''
+        Requests a sample of the cases of the feeds instead of all of them, see src.sampling
+
+        The ECLIs are requested in a seeded order that is stratified by court and month,
+        until `size` cases are in the store or `time_budget` seconds have passed, whichever comes first.
+        Cases rejected for missing section labels do not count towards the size.
+        A later call with a larger budget extends the sample with the cases that follow in the same order;
+        the cases already in the store are not downloaded again.
+
+        Returns the ECLIs of the sample in the store, in the order of sampling, or None if no feeds are available
+        '''
+        ECLIds = self._ECLIds_from_feeds()
+        if ECLIds is None:
+            return
+
+        metadata = self.feed_metadata(out_fn=None)
+        metadata = metadata[metadata['ECLI'].isin(set(self._own_shard(ECLIds)))]
+        order = stratified_order(metadata, seed=seed)
+
+        deadline = time.monotonic() + time_budget if time_budget is not None else None
+        size = len(order) if size is None else size
+        # With a time budget, request small batches to stop close to the deadline
+        batch_size = self.max_workers * 4 if deadline is not None else len(order)
+
+        sample = []
+        counts = Counter()
+        pending = iter(order)
+        while len(sample) < size and (deadline is None or time.monotonic() < deadline):
+            batch = list(islice(pending, min(size - len(sample), batch_size)))
+            if len(batch) == 0:
+                break
+            counts.update(self._request_cases(batch, self.store, check_section_labels))
+            sample += [ECLI for ECLI in batch if ECLI in self.store]
+
+        if deadline is not None and time.monotonic() >= deadline:
+            log.info(f"Time budget of {time_budget} s used up")
+        self._log_request_counts(counts)
+        log_coverage(metadata, sample)
+
+        with open(self.out_dir / 'sample_ECLIds.txt', 'w') as f:
+            f.writelines(f"{ECLI}\n" for ECLI in sample)
+        return sample
+
+    def stream_cases_from_feed(self, check_section_labels=True, queue_size=64):
+        '''
+        Streaming variant of `request_cases_from_feed`
+        Yields the ECLI of each case as soon as it is in the case store, see `stream_cases`
+        '''
+        ECLIds = self._ECLIds_from_feeds()
+        if ECLIds is None:
+            return
+
+        yield from self.stream_cases(self._own_shard(ECLIds), self.store, check_section_labels, queue_size)
+
+    def sync(self, query, check_section_labels=True, overlap=timedelta(hours=1)):
+        '''
+        Brings the cases in the case store up to date with the ECLI index
+
+        The first sync retrieves all results of the query. Later syncs only query the index
+        for documents modified since the previous successful sync and download just those,
+        replacing outdated versions on disk. The time of the sync is only recorded when it succeeds.
+
+        The new and updated ECLIs are flagged in 'delta_ECLIds.txt', such that later stages
+        can process just the delta.
+
+        overlap     margin subtracted from the time of the previous sync,
+                    such that documents modified during that sync are not missed
+
+        Returns a list of (ECLI, flag) pairs, where the flag is 'new', 'updated' or 'removed'
+        '''
+        state_file = self.out_dir / 'sync.json'
+        state = json.loads(state_file.read_text()) if state_file.is_file() else {}
+        started_at = datetime.now(timezone.utc)
+
+        if 'last_sync' not in state:
+            log.info("No earlier sync found; retrieving all results of the query")
+            self.query_ECLI_index(query, retrieve_all=True)
+            ECLIds = self._ECLIds_from_feeds() or []
+            overwrite = False
+        else:
+            modified = datetime.fromisoformat(state['last_sync']) - overlap
+            log.info(f"Retrieving documents modified since {modified.isoformat(timespec='seconds')}")
+            # Each sync stores its feeds separately, so that they do not mix with the full query results
+            feed_dir = self.out_dir / 'sync' / started_at.strftime('%Y%m%dT%H%M%S')
+            delta_query = f"{query}&modified={modified.strftime('%Y-%m-%dT%H:%M:%S')}"
+            self.query_ECLI_index(delta_query, retrieve_all=True, feed_dir=feed_dir)
+            ECLIds = self._ECLIds_from_feeds(feed_dir) or []
+            overwrite = True
+
+        # Cases on disk that lost their section labels are removed by the update
+        ECLIds = self._own_shard(list(dict.fromkeys(ECLIds)))
+        on_disk = {ECLI for ECLI in ECLIds if ECLI in self.store}
+
+        # Keep the status per ECLI, to know which ECLIs are new and which ones are updated
+        request = partial(self._request_case, out_dir=self.store, check_section_labels=check_section_labels,
+                          overwrite=overwrite)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            statuses = list(executor.map(request, ECLIds))
+        counts = Counter(statuses)
+        self._log_request_counts(counts)
+        if counts['failed']:
+            raise RuntimeError(f"Sync incomplete: {counts['failed']} cases failed to download; sync again to retry")
+
+        flags = {'saved': 'new', 'linked': 'new', 'updated': 'updated'}
+        delta = [(ECLI, flags[status]) for ECLI, status in zip(ECLIds, statuses) if status in flags]
+        delta += [(ECLI, 'removed') for ECLI, status in zip(ECLIds, statuses)
+                  if status == 'rejected' and ECLI in on_disk]
+        with open(self.out_dir / 'delta_ECLIds.txt', 'w') as f:
+            f.writelines(f"{ECLI}\t{flag}\n" for ECLI, flag in delta)
+        log.info(f"Sync found {len(delta)} new, updated or removed cases; flagged in delta_ECLIds.txt")
+
+        state['last_sync'] = started_at.isoformat(timespec='seconds')
+        state_file.write_text(json.dumps(state))
+
+        return delta
 
     def request_cases_from_list(self, ECLIds, out_dir=None, check_section_labels=True):
         '''
@@ -192,13 +765,9 @@ class CaseLoader:
         '''
         if out_dir is None:
             out_dir = self.out_dir.parents[0] / datetime.now().strftime("%Y-%H-%M-%S")
-        else:
-            out_dir = self.out_dir
-
-        os.makedirs(out_dir, exist_ok=True)
 
-        for ECLI in ECLIds:
-            self._request_case(ECLI, out_dir, check_section_labels)
+        counts = self._request_cases(ECLIds, out_dir, check_section_labels)
+        self._log_request_counts(counts)
 
 
 if __name__ == '__main__':
@@ -223,9 +792,9 @@ if __name__ == '__main__':
     caseloader = CaseLoader(out_dir)
 
     # Submit query that returns an atom feed with results
-    # retrieve_all flag recurses the request if there are more than `max` results
+    # retrieve_all flag requests all pages of results if there are more than `max` results
     caseloader.query_ECLI_index(query, retrieve_all=True)
 
     # Request the returned cases from the atom feed
-    # For convenience this function also returns the path where the cases are stored
-    case_dir = caseloader.request_cases_from_feed(check_section_labels=True)
+    # For convenience this function also returns the store holding the cases
+    store = caseloader.request_cases_from_feed(check_section_labels=True)
@@ -1,15 +1,45 @@
+import io
+import json
 import glob
+import hashlib
+import itertools
+import multiprocessing
 import regex
 import pandas as pd
 import numpy as np
 from pathlib import Path
 from bs4 import BeautifulSoup
-from collections import defaultdict
+from lxml import etree
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from src.utils import get_logger
 
 log = get_logger(__name__)
 
 
+# Parser of a worker process, see CaseParser._parse_in_processes
+_worker_parser = None
+
+
+def _init_parse_worker(parser):
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _parse_chunk(cases, keep_text):
+    results = []
+    for case in cases:
+        if case is None:
+            # Cached case, see CaseParser._parse_documents
+            results.append((None, None, None, None))
+            continue
+        ECLI, case_raw, inhoudsindicatie, section_data = _worker_parser.parse_case(case)
+        if not keep_text:
+            case_raw, inhoudsindicatie = None, None
+        results.append((ECLI, case_raw, inhoudsindicatie, section_data))
+    return results
+
+
 class CaseParser:
     '''
     Parses case xml from Open Data van de Rechtspraak
@@ -17,13 +47,15 @@ class CaseParser:
     '''
 
     def __init__(self, data_key='data', level='section',
-                 include_section_titles=True, include_procedures=[]):
+                 include_section_titles=True, include_procedures=[], engine='bs4'):
         '''
         params:
 
         data_key:       preferred column name to store the parsed text data under
         level:          whether to store data on section or paragraph level
         include_section_titles:     one may want to exclude these for ML applications, since they are used for labelling
+        engine:         'bs4' parses cases with BeautifulSoup, 'lxml' with the faster lxml.etree;
+                        both give the same results, see `_parse_case_lxml`
         '''
         super().__init__()
 
@@ -41,6 +73,28 @@ class CaseParser:
         self.include_section_titles = include_section_titles
         self.level = level
         self.include_procedures = include_procedures
+        if engine not in ('bs4', 'lxml'):
+            raise ValueError(f"Unknown parse engine: {engine}")
+        self.engine = engine
+        # Columns of the parsed data, i.e. the keys of the section records
+        self.columns = ['ECLI', 'section_id', 'title', 'type', data_key, 'articles', 'subject', 'procedure', 'date']
+
+    # Increase when a change to the parser changes its results, which invalidates the parse caches
+    version = 1
+
+    def fingerprint(self):
+        '''
+        Returns a short hash of the settings that determine the section records of a case,
+        which keys the records in a ParseCache (see src.parse_cache); the engine does not change them
+        '''
+        settings = {
+            'version': self.version,
+            'level': self.level,
+            'include_section_titles': self.include_section_titles,
+            'include_procedures': list(self.include_procedures),
+            'data_key': self.data_key,
+        }
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
 
     def get_raw_text(self, results):
         '''
@@ -57,6 +111,13 @@ class CaseParser:
         return ' '.join(raw_text)
 
     def parse_case(self, case):
+        '''
+        Parses a case xml (str, or bytes with the lxml engine)
+        Returns its ECLI, raw text, inhoudsindicatie and a list of section records,
+        or four times None if the procedure of the case is not included
+        '''
+        if self.engine == 'lxml':
+            return self._parse_case_lxml(case)
 
         # Parse the xml of the case text
         soup = BeautifulSoup(case, features='xml')
@@ -152,23 +213,150 @@ class CaseParser:
         Oordeel van de rechtbank
         '''
 
-        # Maintain a separate idx for paragraphs
-        par_id = 0
-
         # uitspraak.info
         info = soup.find_all('uitspraak.info')
         _ = self.get_raw_text(info)
 
-        section_data = []
         # In the CaseLoader class, there is an additional check to not retrieve xmls
         # without section tags; if check is not done, this may be an empty list
         sections = soup.find_all('section')
 
+        # Title, role and paragraph texts of each section
+        sections = ((section.title.get_text(strip=False).strip(),  # Do not use the bs4 strip, breaks!
+                     section.get('role') if section.has_attr('role') else None,
+                     [par.get_text() for par in section.find_all('para')])
+                    for section in sections)
+        section_data = self._section_data(ECLI, sections, subject, procedure, date)
+
+        # TODO maybe include inhoudsindicatie as a separate section with type='inhoudsindicatie'
+        return ECLI, case_raw, inhoudsindicatie, section_data
+
+    # Control characters, including newlines, are replaced by a space in the text data
+    control_chars = regex.compile(r'\p{C}')
+
+    # Whitespace-only strings are collapsed by BeautifulSoup, see `_collapse_whitespace`
+    ascii_spaces = regex.compile(r'[ \n\t\x0c\r]+')
+
+    @classmethod
+    def _collapse_whitespace(cls, text):
+        '''
+        Like BeautifulSoup, replaces a string of only whitespace by a newline if it contains one, else a space
+        '''
+        if text and cls.ascii_spaces.fullmatch(text):
+            return '\n' if '\n' in text else ' '
+        return text
+
+    @staticmethod
+    def _string(element):
+        '''
+        The text of an element with a single child, as `.string` in BeautifulSoup; None otherwise
+        '''
+        children = [child for child in element]
+        n_strings = bool(element.text) + sum(bool(child.tail) for child in children)
+        if n_strings + len(children) != 1:
+            return None
+        if element.text:
+            return element.text
+        child = children[0]
+        if not isinstance(child.tag, str):
+            # Comments and processing instructions are strings in BeautifulSoup
+            return child.text
+        return CaseParser._string(child)
+
+    @staticmethod
+    def _find(element, name):
+        '''
+        First descendant with the local name, as `element.name` in BeautifulSoup;
+        raises an AttributeError if there is none, like an attribute lookup on None would
+        '''
+        found = element.find(f'.//{{*}}{name}')
+        if found is None:
+            raise AttributeError(f"No <{name}> element found")
+        return found
+
+    @staticmethod
+    def _text(element):
+        return ''.join(element.itertext())
+
+    def _parse_case_lxml(self, case):
+        '''
+        `parse_case` with lxml.etree instead of BeautifulSoup, which is several times faster
+        (see benchmarks/bench_parse_engine.py)
+
+        The differences between the two in text handling are replicated,
+        so that both engines return identical results:
+        whitespace-only strings are collapsed, elements are found by their local name
+        and the <nr> fix only applies when BeautifulSoup would find a `.string`
+        '''
+        if isinstance(case, str):
+            case = case.encode('utf-8')
+        # Parsers are not thread-safe, so create one per case
+        root = etree.fromstring(case, etree.XMLParser(recover=True, huge_tree=True, encoding='utf-8'))
+
+        for node in root.iter():
+            if isinstance(node.tag, str):
+                node.text = self._collapse_whitespace(node.text)
+            node.tail = self._collapse_whitespace(node.tail)
+
+        # See parse_case for the <nr> fix
+        for nr in list(root.iter('{*}nr')):
+            string = self._string(nr)
+            if isinstance(string, str):
+                nr[:] = []
+                nr.text = string + ' '
+            else:
+                log.info(f"Warning: <nr> {string} in {etree.tostring(nr, encoding='unicode', with_tail=False)} "
+                         f"is of type {type(string)} ")
+
+        # Metadata
+        description = self._find(root, 'Description')
+        ECLI = self._text(self._find(description, 'identifier'))
+        procedure = self._text(self._find(description, 'procedure')).strip()
+
+        if procedure not in self.include_procedures:
+            log.info("Skipping %s ECLI (%s)", ECLI, procedure)
+            return None, None, None, None
+
+        date = self._text(self._find(description, 'date')).strip()
+        subject = [x.strip() for x in regex.split(';|,', self._text(self._find(description, 'subject')))]
+
+        try:
+            inhoudsindicatie = self._text(self._find(root, 'inhoudsindicatie'))
+        except AttributeError as e:
+            log.info("Parsing <inhoudsindicatie> failed")
+            log.error(e)
+            inhoudsindicatie = ''
+
+        log.info("Parsing case %s", ECLI)
+
+        try:
+            case_raw = self._text(self._find(root, 'uitspraak'))
+        except AttributeError as e:
+            log.error(e)
+            case_raw = self._text(root).replace(inhoudsindicatie, '')
+
+        sections = ((self._text(self._find(section, 'title')).strip(),
+                     section.get('role'),
+                     [self._text(par) for par in section.iter('{*}para')])
+                    for section in root.iter('{*}section'))
+        section_data = self._section_data(ECLI, sections, subject, procedure, date)
+
+        return ECLI, case_raw, inhoudsindicatie, section_data
+
+    def _section_data(self, ECLI, sections, subject, procedure, date):
+        '''
+        Turns the (title, role, paragraph texts) of each section of a case into the records of the parsed data
+        Shared by the parse engines; the role is None if the section has no role attribute
+        '''
+        # Maintain a separate idx for paragraphs
+        par_id = 0
+
+        section_data = []
+
         # Label sections
-        for section_id, section in enumerate(sections):
-            title = section.title.get_text(strip=False).strip()  # Do not use the bs4 strip, breaks!
-            if section.has_attr('role'):
-                label = section.get('role')  # overweging, beslissing, procesverloop
+        for section_id, (title, role, pars) in enumerate(sections):
+            if role is not None:
+                label = role  # overweging, beslissing, procesverloop
             else:
                 label = self.label_based_on_title(title)
 
@@ -180,11 +368,9 @@ class CaseParser:
                 section_text = ''
                 par_texts = []
 
-            pars = section.find_all('para')
-            for par in pars:
+            for par_text in pars:
                 # There are empty paragraphs, e.g. <par></par>
-                if par:
-                    par_text = par.get_text()
+                if par_text:
                     # Only keep paragraphs with sensible text
                     # E.g. filter out '======================'
                     # if any(char.isalnum() for char in par_text): # keeps paragraphs with only digits, e.g. '1'
@@ -215,7 +401,7 @@ class CaseParser:
                         'section_id': par_id,  # Still store under section_id to keep structure simple
                         'title': title,
                         'type': label,
-                        self.data_key: par_text,
+                        self.data_key: self.control_chars.sub(' ', par_text),
                         'articles': articles,
                         'subject': subject,
                         'procedure': procedure,
@@ -231,15 +417,14 @@ class CaseParser:
                     'section_id': section_id,
                     'title': title,
                     'type': label,
-                    self.data_key: section_text,
+                    self.data_key: self.control_chars.sub(' ', section_text),
                     'articles': articles,
                     'subject': subject,
                     'procedure': procedure,
                     'date': date
                     })
 
-        # TODO maybe include inhoudsindicatie as a separate section with type='inhoudsindicatie'
-        return ECLI, case_raw, inhoudsindicatie, section_data
+        return section_data
 
     def label_based_on_title(self, title):
         '''
@@ -642,61 +827,126 @@ class CaseParser:
 
         return label
 
-    def parse_all_cases(self, data_dir, write_to_csv=True, write_case_text=False, include_inhoudsindicatie=True):
+    def parse_all_cases(self, data_dir, write_to_csv=True, write_case_text=False, include_inhoudsindicatie=True,
+                        workers=None, cache=None):
+        '''
+        Parses all case xmls in `data_dir`
+        The cases are ordered by ECLI, so the result does not depend on the order of the files on disk
+
+        workers     number of processes to parse the cases with; None or 1 parses them in this process
+        cache       ParseCache (see src.parse_cache) to take the records of unchanged cases from
+        '''
+        sources = glob.glob(f'{data_dir}/*.xml')
+        return self._parse_documents(self._read_sources(sources), data_dir, write_to_csv=write_to_csv,
+                                     write_case_text=write_case_text, include_inhoudsindicatie=include_inhoudsindicatie,
+                                     sort=True, workers=workers, cache=cache)
+
+    def _read_sources(self, sources):
+        '''
+        Yields the (text path, case xml) of each case xml file in `sources`
+        '''
+        for source in sources:
+            source = str(source)
+            if self.engine == 'lxml':
+                # Skip decoding, the lxml engine parses the bytes as utf-8 itself
+                with open(source, mode='rb') as f:
+                    yield source.replace('.xml', '.txt'), f.read()
+            else:
+                with open(source, mode='r', encoding='utf-8') as f:
+                    yield source.replace('.xml', '.txt'), f.read()
+
+    def parse_store(self, store, ECLIds=None, data_dir=None, write_to_csv=True, write_case_text=False,
+                    include_inhoudsindicatie=True, workers=None, cache=None, sort=None):
+        '''
+        Parses the cases in a CaseStore (see src.case_store), or only those in `ECLIds`,
+        which may be any iterable, e.g. a generator yielding ECLIs as soon as they are downloaded
+
+        When all cases are parsed, they are ordered by ECLI, so the result does not depend
+        on the order of the store, e.g. when merging the stores of a sharded crawl (see src.shards)
+        sort        order the cases by ECLI also when parsing `ECLIds`, e.g. when they are streamed
+                    in the order their downloads finish; None only sorts when all cases are parsed
+
+        data_dir    directory where the csv with parsed cases is written to; defaults to the store root
+        workers     number of processes to parse the cases with; None or 1 parses them in this process
+        cache       ParseCache (see src.parse_cache) to take the records of unchanged cases from
+        '''
+        data_dir = Path(data_dir) if data_dir is not None else store.root
+
+        def documents():
+            for ECLI, content in store.items(ECLIds):
+                if self.engine != 'lxml':
+                    content = content.decode('utf-8')
+                yield data_dir / (ECLI.replace(':', '-') + '.txt'), content
+
+        return self._parse_documents(documents(), data_dir, write_to_csv=write_to_csv, write_case_text=write_case_text,
+                                     include_inhoudsindicatie=include_inhoudsindicatie,
+                                     sort=ECLIds is None if sort is None else sort,
+                                     workers=workers, cache=cache)
+
+    def _parse_documents(self, documents, data_dir, write_to_csv=True, write_case_text=False, include_inhoudsindicatie=True,
+                         sort=False, workers=None, cache=None):
+        '''
+        Parses (text path, case xml) pairs into a single dataframe
+        The text path is where the case text is written to if `write_case_text`
+        sort    order the cases by ECLI instead of by the order of `documents`
+        workers number of processes to parse the cases with, see `_parse_in_processes`;
+                the result is the same as when parsing in this process
+        cache   ParseCache to take the records of cases from by the hash of their xml, and to add new records to;
+                when writing the case texts, all cases are parsed
+        '''
 
         data_dir = Path(data_dir)
 
-        # Collect all data as a dictionary with ECLI as key, section data as value
-        data = defaultdict(dict)
+        # Collect the section records of all cases in a list per column,
+        # with the ECLI and the range of rows of each case
+        columns = {column: [] for column in self.columns}
+        cases = []
+        n_cached = 0
+
+        # Cases found in the cache are passed on as None, with their records in the key of the document
+        if cache is not None:
+            fingerprint = self.fingerprint()
+            documents = self._lookup_cached(documents, cache, fingerprint, use_cached=not write_case_text)
+        else:
+            documents = (((text_path, None, None), uitspraak) for text_path, uitspraak in documents)
 
-        ECLIds = []
-        dataframes = []
-        for source in glob.glob(f'{data_dir}/*.xml'):
-            with open(source, mode='r', encoding='utf-8') as f:
-                uitspraak = f.read()
-                ECLI, case_raw, inhoudsindicatie, section_data = self.parse_case(uitspraak)
+        if workers is not None and workers > 1:
+            parsed = self._parse_in_processes(documents, workers, keep_text=write_case_text)
+        else:
+            parsed = ((key, *(self.parse_case(uitspraak) if uitspraak is not None else (None, None, None, None)))
+                      for key, uitspraak in documents)
+
+        for (text_path, sha256, cached), ECLI, case_raw, inhoudsindicatie, section_data in parsed:
+            if cached is not None:
+                ECLI, section_data = cached
+                n_cached += 1
+            elif cache is not None:
+                cache.put(sha256, fingerprint, ECLI, section_data)
             if ECLI is None:
                 continue
 
-            # data[ECLI] = section_data
-            ECLIds.append(ECLI)
-            frames = []
+            start = len(columns['ECLI'])
             for section_dict in section_data:
-                # orient='columns' is more intuitive to me
-                # but results in jagged arrays; index + transpose instead
-                df = pd.DataFrame.from_dict(section_dict, orient='index').T
-                frames.append(df)
-
-            # Stack horizontally
-            df = pd.concat(frames)
-            dataframes.append(df)
+                for column, values in columns.items():
+                    values.append(section_dict[column])
+            cases.append((ECLI, start, len(columns['ECLI'])))
 
             if write_case_text:
-                outfile = source.replace('.xml', '.txt')
-                with open(outfile, mode='w', encoding='utf-8') as f:
+                with open(text_path, mode='w', encoding='utf-8') as f:
                     if include_inhoudsindicatie:
                         f.write(inhoudsindicatie + case_raw)
                     else:
                         f.write(case_raw)
 
-        if len(dataframes) == 0:
+        if cache is not None:
+            cache.flush()
+            log.info(f"Took the records of {n_cached} cases from the parse cache")
+
+        if len(cases) == 0:
             log.error("Dataframe is empty! No xml files parsed.")
             return
 
-        df = pd.concat(dataframes, axis=0)
-
-        # Strip all control characters from the data
-        # TODO do I want this?
-        df[self.data_key] = [regex.sub(r'\p{C}', ' ', dp[self.data_key]) for _, dp in df.iterrows()]
-
-        # Set simple integer index
-        df["id"] = list(range(len(df)))
-        df.set_index("id", inplace=True)
-
-        # Drop rows with no associated text data
-        df[self.data_key].replace('', np.nan, inplace=True)
-        log.warning(f"Dropping {np.sum(df[self.data_key].isna())} sections without text")
-        df.dropna(subset=[self.data_key], inplace=True)
+        df = self._frame_from_columns(columns, cases, sort=sort)
 
         # df = pd.concat(dataframes, keys=ECLIds)
 
@@ -717,6 +967,80 @@ class CaseParser:
 
         return df
 
+    @staticmethod
+    def _lookup_cached(documents, cache, fingerprint, use_cached=True):
+        '''
+        Yields ((text path, sha256 hash, cached records), case xml) for each (text path, case xml) in `documents`
+        The case xml is None if its (ECLI, section records) are found in the cache
+        use_cached  only hash the cases, e.g. to parse them all but update the cache
+        '''
+        for text_path, case in documents:
+            content = case.encode('utf-8') if isinstance(case, str) else case
+            sha256 = hashlib.sha256(content).hexdigest()
+            cached = cache.get(sha256, fingerprint) if use_cached else None
+            yield (text_path, sha256, cached), (case if cached is None else None)
+
+    def _frame_from_columns(self, columns, cases, sort=False):
+        '''
+        Builds the dataframe of the parsed data from the lists of values per column,
+        with an integer id per section; sections without text are dropped but keep their id
+
+        cases   (ECLI, first row, last row + 1) of each case
+        sort    order the cases by ECLI instead of by the order of `cases`
+
+        The number of rows of each case before dropping is kept in `df.attrs['case_rows']`,
+        which src.shards needs to number the rows of merged shards like those of a single run
+        '''
+        df = pd.DataFrame(columns)
+        df['section_id'] = df['section_id'].astype(np.int64)
+        if sort:
+            # Sorting is stable, so cases with the same ECLI keep their order
+            cases = sorted(cases, key=lambda case: case[0])
+            order = [row for _, start, stop in cases for row in range(start, stop)]
+            df = df.take(order)
+
+        # Set simple integer index
+        df.index = pd.RangeIndex(len(df), name='id')
+
+        # Drop rows with no associated text data
+        empty = (df[self.data_key] == '').to_numpy()
+        log.warning(f"Dropping {np.sum(empty)} sections without text")
+        df = df[~empty]
+        df.attrs['case_rows'] = [(ECLI, stop - start) for ECLI, start, stop in cases]
+        return df
+
+    def _parse_in_processes(self, documents, workers, keep_text=False, chunk_size=16):
+        '''
+        Parses (key, case xml) pairs in a pool of `workers` processes, e.g. with the text path as key
+        Yields the key and the results of `parse_case` in the order of `documents`;
+        a case xml that is None gives four times None
+
+        Each process gets a copy of this parser when it starts and returns plain section records.
+        Cases are sent in chunks, and only a few chunks per process are in flight,
+        so that `documents` may be a generator of any size, e.g. of streamed downloads.
+        keep_text   also return the raw text and inhoudsindicatie of the cases, which are otherwise dropped
+        '''
+        # Spawn rather than fork, since download threads may be running while parsing streamed cases
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_parse_worker, initargs=(self,)) as executor:
+            pending = deque()
+            documents = iter(documents)
+            while True:
+                while len(pending) < 2 * workers:
+                    chunk = list(itertools.islice(documents, chunk_size))
+                    if not chunk:
+                        break
+                    keys = [key for key, _ in chunk]
+                    cases = [case for _, case in chunk]
+                    pending.append((keys, executor.submit(_parse_chunk, cases, keep_text)))
+                if not pending:
+                    break
+
+                keys, future = pending.popleft()
+                for key, result in zip(keys, future.result()):
+                    yield (key, *result)
+
     def check_section_labels(self, case, get_raw_text=False):
         '''
         Function to test whether a case xml has labeled sections
@@ -724,6 +1048,69 @@ class CaseParser:
         case            case xml
         get_raw_text    return section text without markup
         '''
+        return self.section_label_reason(case) is None
+
+    def section_label_reason(self, case):
+        '''
+        Returns the reason why a case xml fails the test of `check_section_labels`,
+        or None if the case has labeled sections
+
+        case    case xml as bytes or str, or a path or file object to read it from
+
+        Instead of building a tree of the whole document, the xml is streamed
+        and parsing stops as soon as the labels we look for have been seen.
+        The decision is the same as that of `_section_label_reason_soup`.
+        '''
+        if isinstance(case, str):
+            case = case.encode('utf-8')
+        if isinstance(case, bytes):
+            case = io.BytesIO(case)
+
+        # For now only check presence of "overwegingen" and "beslissing"
+        roles = ['overwegingen', 'beslissing']
+        found = set()
+
+        # The first section must have content (cf. `len(soup.find('section'))`)
+        first_section = None
+        has_sections = None
+
+        try:
+            for event, element in etree.iterparse(case, events=('start', 'end'), recover=True, huge_tree=True):
+                if event == 'start':
+                    if element.get('role') in roles:
+                        found.add(element.get('role'))
+                    if has_sections is None and first_section is None and element.tag.rpartition('}')[2] == 'section':
+                        first_section = element
+                else:
+                    if element is first_section:
+                        # Text and child elements both count as content
+                        has_sections = len(element) > 0 or bool(element.text)
+                        first_section = None
+                        if not has_sections:
+                            break
+                    # Free the memory of elements we are done with
+                    element.clear()
+
+                if has_sections and len(found) == len(roles):
+                    break
+        except etree.XMLSyntaxError:
+            # Not even an xml root element, e.g. an empty response
+            pass
+
+        if not has_sections:
+            log.warning("Case xml contains no sections.")
+            return 'no sections'
+
+        missing = [role for role in roles if role not in found]
+        if missing:
+            return f"no {' and '.join(missing)} role"
+        return None
+
+    def _section_label_reason_soup(self, case):
+        '''
+        Reference implementation of `section_label_reason` that builds a BeautifulSoup tree
+        of the whole document; kept to test and benchmark the streaming implementation against
+        '''
 
         soup = BeautifulSoup(case, features='xml')
 
@@ -732,7 +1119,7 @@ class CaseParser:
         sections = soup.find('section')  # returns None is not present
         if sections is None or len(sections) == 0:  # This catches both scenarios
             log.warning("Case xml contains no sections.")
-            return False
+            return 'no sections'
 
         # Formele opmerkingen over procesverloop
         # Momenteel niet gebruikt, minder belangrijk dan overwegingen en beslissingen
@@ -748,7 +1135,11 @@ class CaseParser:
         beslissingen = soup.find_all(role='beslissing')
 
         # For now only check presence of "overwegingen" and "beslissing"
-        return True if len(overwegingen) > 0 and len(beslissingen) > 0 else False
+        missing = [role for role, found in [('overwegingen', overwegingen), ('beslissing', beslissingen)]
+                   if len(found) == 0]
+        if missing:
+            return f"no {' and '.join(missing)} role"
+        return None
 
     def inspect_overig_labels(self, df):
         # Print type labels
@@ -0,0 +1,71 @@
+import regex
+from collections import Counter
+
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+class FeedFilter:
+    '''
+    Excludes ECLIs from downloading based on the ECLI and the title of its entry in the result feed,
+    e.g. the cases of courts of appeal ('GH.*'), the Hoge Raad ('HR') and its Procureur-Generaal ('PHR')
+
+    The court code is the third part of the ECLI, e.g. 'RBOVE' in 'ECLI:NL:RBOVE:2021:5'.
+    Titles look like 'ECLI:NL:RBOVE:2021:5, Rechtbank Overijssel, 04-01-2021, 08.206498.20'.
+    '''
+
+    def __init__(self, include_courts=(), exclude_courts=(), exclude_titles=()):
+        '''
+        include_courts  regexes of court codes to keep; empty keeps all courts
+        exclude_courts  regexes of court codes to skip, e.g. 'GH.*'
+        exclude_titles  regexes that skip an ECLI if they occur in its title, e.g. 'Gerechtshof'
+        '''
+        self.include_courts = [regex.compile(pattern) for pattern in include_courts]
+        self.exclude_courts = [regex.compile(pattern) for pattern in exclude_courts]
+        self.exclude_titles = [regex.compile(pattern) for pattern in exclude_titles]
+
+    def __bool__(self):
+        return bool(self.include_courts or self.exclude_courts or self.exclude_titles)
+
+    @staticmethod
+    def court(ECLI):
+        parts = ECLI.split(':')
+        return parts[2] if len(parts) > 2 else ''
+
+    def reason(self, ECLI, title=''):
+        '''
+        Returns why the ECLI is excluded, or None if it is kept
+        '''
+        court = self.court(ECLI)
+        if self.include_courts and not any(pattern.fullmatch(court) for pattern in self.include_courts):
+            return f"court {court} not included"
+        for pattern in self.exclude_courts:
+            if pattern.fullmatch(court):
+                return f"court {court} excluded"
+        for pattern in self.exclude_titles:
+            if pattern.search(title):
+                return f"title matches '{pattern.pattern}'"
+        return None
+
+    def apply(self, ECLIds, titles=None):
+        '''
+        Returns the kept ECLIs and a list of (ECLI, reason) pairs of the excluded ones
+        titles  feed titles of the ECLIs, in the same order
+        '''
+        if titles is None:
+            titles = [''] * len(ECLIds)
+
+        kept, excluded = [], []
+        for ECLI, title in zip(ECLIds, titles):
+            reason = self.reason(ECLI, title)
+            if reason is None:
+                kept.append(ECLI)
+            else:
+                excluded.append((ECLI, reason))
+
+        if excluded:
+            reasons = Counter(reason for _, reason in excluded)
+            log.info(f"Feed filter skips {len(excluded)} of {len(ECLIds)} ECLIs before downloading: "
+                     + ', '.join(f"{n} {reason}" for reason, n in reasons.most_common()))
+        return kept, excluded
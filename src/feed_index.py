@@ -0,0 +1,196 @@
+import io
+import os
+import glob
+import json
+import threading
+from pathlib import Path
+
+import regex
+import pandas as pd
+from lxml import etree
+
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+# The subtitle of a result feed looks like "Aantal gevonden ECLI's: 1234"
+MATCH_NR = regex.compile(r'\d+')
+
+
+def iter_feed(source):
+    '''
+    Streams an atom result feed of the ECLI index, without building the whole tree
+    source  path, file or bytes of the feed
+
+    Yields ('hits', n) for the total amount of hits of the query and ('entry', entry) for each entry,
+    with the 'id', 'title', 'summary' and 'updated' texts of the entry in a dict
+    '''
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    elif isinstance(source, Path):
+        source = str(source)
+
+    for _, element in etree.iterparse(source, events=('end',), tag=('{*}entry', '{*}subtitle'), huge_tree=True):
+        if element.tag.rpartition('}')[2] == 'subtitle':
+            yield 'hits', int(MATCH_NR.search(element.text or '0').group(0))
+        else:
+            ECLI = element.findtext('{*}id')
+            if ECLI is not None:
+                yield 'entry', {field: (element.findtext('{*}' + field) or '').strip()
+                                for field in ('id', 'title', 'summary', 'updated')}
+            # Free the entries that are already read
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def iter_feed_entries(source):
+    '''
+    Yields the entries of a result feed, see `iter_feed`
+    '''
+    for kind, value in iter_feed(source):
+        if kind == 'entry':
+            yield value
+
+
+def feed_offset(path):
+    '''
+    Returns the offset of the results in a result feed, i.e. x in 'results_from_{x}.atom'
+    '''
+    return int(regex.search(r'_from_(\d+)', Path(path).stem).group(1))
+
+
+def result_feeds(feed_dir):
+    '''
+    Returns the paths of the result feeds of a query in `feed_dir`, in the order of the results
+    '''
+    return sorted(glob.iglob(str(Path(feed_dir) / 'results_from*atom')), key=feed_offset)
+
+
+def read_feed(source):
+    '''
+    Returns the total amount of hits of the query, the list of ECLIs in the feed and their titles,
+    e.g. 'ECLI:NL:RBOVE:2021:5, Rechtbank Overijssel, 04-01-2021, 08.206498.20'
+    '''
+    n_hits, ECLIds, titles = None, [], []
+    for kind, value in iter_feed(source):
+        if kind == 'hits':
+            n_hits = value
+        else:
+            ECLIds.append(value['id'])
+            titles.append(value['title'])
+    return n_hits, ECLIds, titles
+
+
+# Titles look like 'ECLI:NL:RBOVE:2021:5, Rechtbank Overijssel, 04-01-2021, 08.206498.20'
+# with optionally more case numbers at the end
+MATCH_TITLE = regex.compile(r'(?P<ECLI>[^,]+),\s*(?P<court>[^,]+?),\s*(?P<date>\d{2}-\d{2}-\d{4})\s*(?:,\s*(?P<numbers>.*))?')
+SPLIT_NUMBERS = regex.compile(r'\s*[,;]\s*|\s+(?:en|\+)\s+')
+
+
+def parse_title(title):
+    '''
+    Returns the court name, the decision date (dd-mm-yyyy) and the list of case numbers in the title of a feed entry;
+    fields that are missing from the title are None
+    '''
+    match = MATCH_TITLE.match(title)
+    if match is None:
+        return None, None, []
+    numbers = [number for number in SPLIT_NUMBERS.split(match['numbers'] or '') if number]
+    return match['court'], match['date'], numbers
+
+
+def feed_metadata(sources):
+    '''
+    Builds a table of the entries of result feeds, with a row per ECLI and the columns
+    ECLI, court_code (e.g. 'RBOVE'), court (e.g. 'Rechtbank Overijssel'), date of the decision,
+    case_numbers (list), summary and the time the entry was last updated
+
+    The court columns are categoricals and the dates datetime64,
+    so the table is small and fast to filter and group, e.g. to select cases before downloading them.
+    sources     paths, files or bytes of the feeds, in the order of their results
+    '''
+    columns = {'ECLI': [], 'court_code': [], 'court': [], 'date': [], 'case_numbers': [], 'summary': [], 'updated': []}
+    for source in sources:
+        for entry in iter_feed_entries(source):
+            court, date, numbers = parse_title(entry['title'])
+            columns['ECLI'].append(entry['id'])
+            parts = entry['id'].split(':')
+            columns['court_code'].append(parts[2] if len(parts) > 2 else None)
+            columns['court'].append(court)
+            columns['date'].append(date)
+            columns['case_numbers'].append(numbers)
+            columns['summary'].append(entry['summary'])
+            columns['updated'].append(entry['updated'] or None)
+
+    df = pd.DataFrame(columns)
+    # Pages of the results may overlap when the index changes while querying
+    df = df.drop_duplicates('ECLI').reset_index(drop=True)
+    df['court_code'] = df['court_code'].astype('category')
+    df['court'] = df['court'].astype('category')
+    df['date'] = pd.to_datetime(df['date'], format='%d-%m-%Y', errors='coerce')
+    df['updated'] = pd.to_datetime(df['updated'], utc=True, errors='coerce')
+    return df
+
+
+class FeedIndex:
+    '''
+    Cache of the hits and ECLIs of the result feeds in a directory, stored as json
+
+    Each feed is keyed by its file name, size and modification time,
+    so a feed is only read again when it changes.
+    '''
+
+    def __init__(self, path):
+        '''
+        path    json file of the index, e.g. 'query_ECLIds.json' next to the feeds
+        '''
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.feeds = {}
+        self.changed = False
+        if self.path.is_file():
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self.feeds = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning(f"Ignoring unreadable feed index {self.path}: {e}")
+
+    @staticmethod
+    def _signature(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def read(self, path):
+        '''
+        Returns the amount of hits, the ECLIs and their titles of a feed,
+        from the index if the feed did not change
+        '''
+        path = Path(path)
+        signature = self._signature(path)
+        with self.lock:
+            entry = self.feeds.get(path.name)
+        if entry is not None and entry['signature'] == signature and 'titles' in entry:
+            return entry['n_hits'], entry['ECLIds'], entry['titles']
+
+        n_hits, ECLIds, titles = read_feed(path)
+        with self.lock:
+            self.feeds[path.name] = {'signature': signature, 'n_hits': n_hits, 'ECLIds': ECLIds, 'titles': titles}
+            self.changed = True
+        return n_hits, ECLIds, titles
+
+    def save(self):
+        '''
+        Writes the index if any feed was read again; feeds that no longer exist are dropped
+        '''
+        with self.lock:
+            feeds = {name: entry for name, entry in self.feeds.items() if (self.path.parent / name).is_file()}
+            if not self.changed and len(feeds) == len(self.feeds):
+                return
+            self.feeds = feeds
+            tmp = self.path.with_suffix('.tmp')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.feeds, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+            self.changed = False
@@ -0,0 +1,285 @@
+import time
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from tenacity import Retrying, stop_after_attempt, wait_exponential, retry_if_exception_type, before_sleep_log
+
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+class RetryableHTTPError(requests.HTTPError):
+    '''
+    Raised for responses that are worth retrying, i.e. server errors and throttling
+    '''
+
+    def __init__(self, response, retry_after=None):
+        super().__init__(f"{response.status_code} response for {response.url}", response=response)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket that limits the amount of requests per second
+
+    The rate is lowered when the server throttles us and slowly recovers
+    to the configured rate when requests succeed again.
+    '''
+
+    def __init__(self, rate=None, capacity=None, min_rate=0.5):
+        '''
+        rate        maximum amount of requests per second; None or 0 disables rate limiting
+        capacity    maximum burst of requests; defaults to one second worth of requests
+        min_rate    the rate is never lowered below this amount of requests per second
+        '''
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate) if rate else min_rate
+        self.capacity = capacity if capacity else max(rate or 1, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        '''
+        Blocks until a request may be sent
+        '''
+        if not self.max_rate:
+            return
+
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def try_acquire(self):
+        '''
+        Takes a token without waiting; returns False if there is none
+        '''
+        if not self.max_rate:
+            return True
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def throttle(self):
+        '''
+        Halves the rate, e.g. after a 429 response
+        '''
+        if not self.max_rate:
+            return
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            log.warning(f"Throttled by server; lowering rate to {self.rate:.2f} requests per second")
+
+    def recover(self):
+        '''
+        Slowly increases the rate back to the maximum after a successful request
+        '''
+        if not self.max_rate or self.rate >= self.max_rate:
+            return
+        with self.lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + 0.01 * self.max_rate)
+
+
+class CircuitBreaker:
+    '''
+    Thread-safe circuit breaker
+
+    After `failure_threshold` consecutive failures the circuit opens and all requests
+    wait for `reset_timeout` seconds. Then a single probe request is let through;
+    if it succeeds the circuit closes again, otherwise it stays open for another period.
+    '''
+
+    def __init__(self, failure_threshold=10, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.condition = threading.Condition()
+
+    def before_request(self):
+        '''
+        Blocks while the circuit is open
+        '''
+        with self.condition:
+            while True:
+                if self.state == 'closed':
+                    return
+                if self.state == 'open':
+                    remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                    if remaining <= 0:
+                        self.state = 'half-open'
+                        log.info("Circuit half-open; sending a probe request")
+                    else:
+                        self.condition.wait(remaining)
+                        continue
+                # Half-open: only one probe request at a time
+                if not self.probing:
+                    self.probing = True
+                    return
+                self.condition.wait()
+
+    def record_success(self):
+        with self.condition:
+            self.failures = 0
+            if self.state != 'closed':
+                log.info("Circuit closed; resuming requests")
+                self.state = 'closed'
+                self.probing = False
+                self.condition.notify_all()
+
+    def record_failure(self):
+        with self.condition:
+            self.failures += 1
+            if self.state == 'half-open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                log.warning(f"Circuit open after {self.failures} consecutive failures; "
+                            f"pausing requests for {self.reset_timeout} seconds")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probing = False
+                self.condition.notify_all()
+
+
+class HttpClient:
+    '''
+    HTTP client shared by all requests to rechtspraak.nl
+
+    Adds connection pooling, timeouts, retries with exponential backoff,
+    rate limiting with a token bucket and a circuit breaker to requests.get
+    '''
+
+    # Responses with these status codes are retried
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout=30, max_retries=5, backoff=1, max_backoff=60,
+                 requests_per_second=None, burst=None, failure_threshold=10, reset_timeout=60,
+                 pool_size=10, metrics=None):
+        '''
+        timeout                 seconds to wait for the server to connect and send data
+        max_retries             amount of retries after a failed request
+        backoff                 base of the exponential backoff between retries in seconds
+        max_backoff             maximum waiting time between retries in seconds
+        requests_per_second     maximum request rate; null disables rate limiting
+        burst                   maximum amount of requests sent at once without waiting
+        failure_threshold       consecutive failures after which all requests are paused
+        reset_timeout           seconds to pause all requests when the circuit opens
+        pool_size               amount of pooled connections per host, e.g. the amount of download threads
+        metrics                 DownloadMetrics that counts the retries, see src.telemetry
+        '''
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self._backoff = wait_exponential(multiplier=backoff, max=max_backoff)
+        self.metrics = metrics
+        self._log_retry = before_sleep_log(log, logging.WARNING)
+
+    def _wait(self, retry_state):
+        # Respect the Retry-After header of a throttled response
+        retry_after = getattr(retry_state.outcome.exception(), 'retry_after', None)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return self._backoff(retry_state)
+
+    def _before_retry(self, retry_state):
+        if self.metrics is not None:
+            exception = retry_state.outcome.exception()
+            response = getattr(exception, 'response', None)
+            self.metrics.record_retry(str(response.status_code) if response is not None else type(exception).__name__)
+        self._log_retry(retry_state)
+
+    def _send(self, url, **kwargs):
+        self.breaker.before_request()
+
+        # Every way out records a success or a failure, which also releases the probe of a half-open circuit
+        succeeded = False
+        try:
+            self.bucket.acquire()
+            r = self.session.get(url, timeout=self.timeout, **kwargs)
+
+            if r.status_code in self.RETRY_STATUS_CODES:
+                retry_after = None
+                if r.status_code == 429:
+                    self.bucket.throttle()
+                    try:
+                        retry_after = float(r.headers.get('Retry-After'))
+                    except (TypeError, ValueError):
+                        pass
+                if kwargs.get('stream'):
+                    # Release the connection of the unread body to the pool
+                    r.close()
+                raise RetryableHTTPError(r, retry_after)
+
+            succeeded = True
+        finally:
+            if succeeded:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+        self.bucket.recover()
+        return r
+
+    def _retrying(self):
+        return Retrying(stop=stop_after_attempt(self.max_retries + 1),
+                        wait=self._wait,
+                        retry=retry_if_exception_type((requests.ConnectionError, requests.Timeout,
+                                                       requests.exceptions.ChunkedEncodingError,
+                                                       RetryableHTTPError)),
+                        before_sleep=self._before_retry,
+                        reraise=True)
+
+    def get(self, url, **kwargs):
+        '''
+        Sends a GET request, retrying on connection errors, timeouts, broken responses, server errors and throttling
+        Raises a requests.RequestException if the request still fails after `max_retries` retries
+        '''
+        kwargs.setdefault('allow_redirects', True)
+        return self._retrying()(self._send, url, **kwargs)
+
+    def _send_and_read(self, url, read, **kwargs):
+        r = self._send(url, stream=True, **kwargs)
+        try:
+            return r, read(r)
+        finally:
+            r.close()
+
+    def download(self, url, read, **kwargs):
+        '''
+        Sends a streamed GET request and reads its response with `read`, e.g. to write the body to a file
+
+        Unlike with `get(url, stream=True)` a body that breaks off while it is read is retried as well:
+        the request is sent again and `read` is called on the new response, so it must start afresh.
+        Returns the closed response and the result of `read`
+        '''
+        kwargs.setdefault('allow_redirects', True)
+        return self._retrying()(self._send_and_read, url, read, **kwargs)
@@ -0,0 +1,151 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from collections import Counter
+from datetime import datetime, timezone
+
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+class DownloadLedger:
+    '''
+    Persistent record of the outcome of each case request, keyed by ECLI
+
+    The status of a case is one of
+    'saved'     the case is downloaded and written to disk
+    'rejected'  the case is downloaded but not saved, e.g. due to missing section labels
+    'excluded'  the case is not downloaded because its metadata is excluded, see CaseLoader.metadata_filter
+    'failed'    the case could not be downloaded
+
+    Rejected cases are not requested again on later runs (a negative cache),
+    failed cases are.
+
+    The ETag and Last-Modified validators of the responses, also those of the result feeds,
+    are kept to revalidate cases and feeds on disk with conditional requests.
+    The sha256 hash of each downloaded case tells whether its content changed without reading it.
+    The procedure and subjects of excluded cases are kept to apply a changed metadata filter without requesting them again.
+    '''
+
+    # Columns added after the first version of the ledger; older ledgers are migrated
+    ADDED_COLUMNS = ('etag', 'last_modified', 'sha256', 'metadata')
+
+    def __init__(self, path):
+        '''
+        path    sqlite database file; created if it does not exist
+        '''
+        self.path = Path(path)
+
+        # The ledger is shared by all download threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS cases (
+                    ECLI TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    http_status INTEGER,
+                    n_bytes INTEGER,
+                    fetched_at TEXT,
+                    reason TEXT,
+                    etag TEXT,
+                    last_modified TEXT,
+                    sha256 TEXT,
+                    metadata TEXT
+                )""")
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(cases)")}
+            for column in self.ADDED_COLUMNS:
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE cases ADD COLUMN {column} TEXT")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS feeds (
+                    path TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched_at TEXT
+                )""")
+
+    def _select(self, table, key, value):
+        with self.lock:
+            cursor = self.connection.execute(f"SELECT * FROM {table} WHERE {key} = ?", (value,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column[0] for column in cursor.description], row))
+
+    def get(self, ECLI):
+        '''
+        Returns the ledger entry of an ECLI as a dict, or None if it was never requested
+        '''
+        return self._select('cases', 'ECLI', ECLI)
+
+    def status(self, ECLI):
+        entry = self.get(ECLI)
+        return entry['status'] if entry is not None else None
+
+    def metadata(self, ECLI):
+        '''
+        Returns the (procedure, subjects) recorded for an ECLI, or None if they were not recorded
+        '''
+        entry = self.get(ECLI)
+        if entry is None or entry['metadata'] is None:
+            return None
+        metadata = json.loads(entry['metadata'])
+        return metadata['procedure'], metadata['subjects']
+
+    def record(self, ECLI, status, http_status=None, n_bytes=None, reason=None, etag=None, last_modified=None,
+               sha256=None, metadata=None):
+        '''
+        Records the outcome of a request; replaces the previous entry of the ECLI
+
+        metadata    (procedure, subjects) of the case, see `metadata`
+        '''
+        if metadata is not None:
+            procedure, subjects = metadata
+            metadata = json.dumps({'procedure': procedure, 'subjects': list(subjects)}, ensure_ascii=False)
+        fetched_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cases "
+                "(ECLI, status, http_status, n_bytes, fetched_at, reason, etag, last_modified, sha256, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (ECLI, status, http_status, n_bytes, fetched_at, reason, etag, last_modified, sha256, metadata))
+
+    def feed(self, path):
+        '''
+        Returns the validators of a result feed as a dict, or None if the feed was never downloaded
+        '''
+        return self._select('feeds', 'path', self._feed_key(path))
+
+    def record_feed(self, path, etag=None, last_modified=None):
+        '''
+        Records the validators of a downloaded result feed
+        '''
+        fetched_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO feeds (path, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?)",
+                (self._feed_key(path), etag, last_modified, fetched_at))
+
+    def _feed_key(self, path):
+        # Feeds are keyed relative to the ledger, so the data directory can be moved
+        path = Path(path).resolve()
+        try:
+            return str(path.relative_to(self.path.parent.resolve()))
+        except ValueError:
+            return str(path)
+
+    def counts(self):
+        '''
+        Returns a Counter with the amount of ECLIs per status
+        '''
+        with self.lock:
+            return Counter(dict(self.connection.execute("SELECT status, COUNT(*) FROM cases GROUP BY status")))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,68 @@
+import io
+
+import regex
+from lxml import etree
+
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+def read_metadata(case):
+    '''
+    Returns the procedure and the list of subjects ('rechtsgebieden') in the metadata of a case xml,
+    either the complete case or only its metadata representation (return=META)
+
+    Like CaseParser.parse_case these are read from the first rdf:Description;
+    fields that are missing are None and an empty list
+    '''
+    if isinstance(case, str):
+        case = case.encode('utf-8')
+    if isinstance(case, bytes):
+        case = io.BytesIO(case)
+
+    try:
+        for _, element in etree.iterparse(case, events=('end',), tag='{*}Description', recover=True, huge_tree=True):
+            procedure = element.findtext('{*}procedure')
+            subject = element.findtext('{*}subject')
+            subjects = [x.strip() for x in regex.split(';|,', subject)] if subject is not None else []
+            return (procedure.strip() if procedure is not None else None), subjects
+    except etree.XMLSyntaxError:
+        pass
+    return None, []
+
+
+class MetadataFilter:
+    '''
+    Excludes cases from downloading based on their metadata, which CaseLoader requests first
+    in a two-phase fetch: e.g. cases of procedures CaseParser would skip anyway
+
+    Procedures must match exactly, as in CaseParser.parse_case; a case is kept if any of its subjects is included.
+    '''
+
+    def __init__(self, include_procedures=(), include_subjects=()):
+        '''
+        include_procedures  procedures to download, e.g. 'Eerste aanleg - meervoudig'; empty keeps all procedures
+        include_subjects    subjects to download, e.g. 'Strafrecht'; empty keeps all subjects
+        '''
+        self.include_procedures = set(include_procedures)
+        self.include_subjects = set(include_subjects)
+
+    def __bool__(self):
+        return bool(self.include_procedures or self.include_subjects)
+
+    def reason(self, metadata):
+        '''
+        Returns why the case with the metadata xml is excluded, or None if it is kept
+        '''
+        return self.reason_for(*read_metadata(metadata))
+
+    def reason_for(self, procedure, subjects):
+        '''
+        Returns why a case with the procedure and subjects is excluded, or None if it is kept
+        '''
+        if self.include_procedures and procedure not in self.include_procedures:
+            return f"procedure {procedure} not included"
+        if self.include_subjects and not self.include_subjects.intersection(subjects):
+            return f"subject {', '.join(subjects) or None} not included"
+        return None
@@ -0,0 +1,80 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+class ParseCache:
+    '''
+    Persistent cache of the section records CaseParser.parse_case returns for each case,
+    so that re-running the parser stage only parses new and changed cases
+
+    Records are keyed by the sha256 hash of the case xml and the fingerprint of the parser settings
+    (see CaseParser.fingerprint): a changed case gets a new hash and other settings a new fingerprint.
+    Cases that the parser skips, e.g. for their procedure, are cached as well, with ECLI None.
+    '''
+
+    def __init__(self, path, batch_size=500):
+        '''
+        path        sqlite database file; created if it does not exist
+        batch_size  number of new records that are written in a single transaction
+        '''
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.pending = []
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS records (
+                    sha256 TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    ECLI TEXT,
+                    section_data TEXT NOT NULL,
+                    PRIMARY KEY (sha256, fingerprint)
+                )""")
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def get(self, sha256, fingerprint):
+        '''
+        Returns the (ECLI, section records) of a case, or None if it is not cached
+        '''
+        with self.lock:
+            row = self.connection.execute("SELECT ECLI, section_data FROM records WHERE sha256 = ? AND fingerprint = ?",
+                                          (sha256, fingerprint)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def put(self, sha256, fingerprint, ECLI, section_data):
+        '''
+        Caches the section records of a case; they are written in batches, see `flush`
+        '''
+        with self.lock:
+            self.pending.append((sha256, fingerprint, ECLI, json.dumps(section_data, ensure_ascii=False)))
+            if len(self.pending) < self.batch_size:
+                return
+        self.flush()
+
+    def flush(self):
+        '''
+        Writes the pending records to the database
+        '''
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)", self.pending)
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
@@ -1,13 +1,24 @@
 from pathlib import Path
 import os
+import time
 
+import pandas as pd
 from omegaconf import DictConfig
+from hydra.core.hydra_config import HydraConfig
 
 from src.caseloader import CaseLoader
+from src.http_client import HttpClient
+from src.case_store import open_case_store
+from src.shards import shard_dir, write_case_rows, replace_cases, CASE_ROWS_FN
+from src.feed_filter import FeedFilter
+from src.metadata_filter import MetadataFilter
+from src.telemetry import DownloadMetrics
 from src.dataloader import DataLoader
 from src.caseparser import CaseParser
+from src.parse_cache import ParseCache
 from src.utils import get_logger, construct_ECLI_query
 from src.extract_punishments import extract_all_punishment_vectors, PunishmentPattern
+from src.preview import preview_punishments
 
 
 def run_pipeline(config: DictConfig, **kwargs) -> None:
@@ -32,19 +43,95 @@ def run_pipeline(config: DictConfig, **kwargs) -> None:
     # Where to store the cases
     query_dir = Path(data_dir) / 'query'
 
-    # Initialize classes for retrieving cases from rechtspraak.nl
-    caseloader = CaseLoader(query_dir)
+    # In a sharded crawl every worker downloads and parses its own slice of the ECLIs
+    # into its own directory; merge them afterwards with src.shards
+    shard_index = config.query.download.shard_index
+    num_shards = config.query.download.num_shards
+    if num_shards > 1:
+        query_dir = shard_dir(query_dir, shard_index, num_shards)
+
+    # Metrics of the requests are summarised periodically in the Hydra output directory
+    if HydraConfig.initialized():
+        hydra_config = HydraConfig.get()
+        metrics_dir = Path(hydra_config.runtime.output_dir) / (hydra_config.output_subdir or '')
+    else:
+        metrics_dir = query_dir
+    metrics = DownloadMetrics(metrics_dir / 'download_metrics.json', interval=config.query.download.metrics_interval)
 
-    if not config.skip_query:
+    # Initialize classes for retrieving cases from rechtspraak.nl
+    max_workers = config.query.download.max_workers
+    http = HttpClient(timeout=config.query.http.timeout,
+                      max_retries=config.query.http.max_retries,
+                      backoff=config.query.http.backoff,
+                      max_backoff=config.query.http.max_backoff,
+                      requests_per_second=config.query.http.requests_per_second,
+                      burst=config.query.http.burst,
+                      failure_threshold=config.query.http.failure_threshold,
+                      reset_timeout=config.query.http.reset_timeout,
+                      pool_size=max_workers,
+                      metrics=metrics)
+
+    # Where to save the case xmls: loose files under 'cases', compressed shards under 'archive',
+    # or in the store shared by all queries, where the query directory references its cases
+    store_type = config.query.download.store
+    store = open_case_store(store_type, query_dir / ('cases' if store_type == 'directory' else 'archive'),
+                            compression=config.query.download.compression,
+                            max_shard_size=config.query.download.max_shard_size,
+                            global_dir=config.query.download.global_dir,
+                            namespace=query_dir.resolve())
+    # In a two-phase fetch, cases the parser would skip by their procedure are not downloaded
+    metadata_filter = None
+    if config.query.download.two_phase.enabled:
+        metadata_filter = MetadataFilter(include_procedures=config.caseparser.include_procedures,
+                                         include_subjects=config.query.download.two_phase.include_subjects)
+    caseloader = CaseLoader(query_dir, max_workers=max_workers, http=http, store=store,
+                            base_url=config.query.download.base_url,
+                            revalidate=config.query.download.revalidate,
+                            shard_index=shard_index, num_shards=num_shards,
+                            feed_filter=FeedFilter(include_courts=config.query.download.filter.include_courts,
+                                                   exclude_courts=config.query.download.filter.exclude_courts,
+                                                   exclude_titles=config.query.download.filter.exclude_titles),
+                            metrics=metrics,
+                            metadata_filter=metadata_filter)
+
+    # Parse the cases while they are downloading instead of after all downloads are finished
+    stream = config.query.download.stream and not config.skip_query and not config.caseparser.skip
+
+    # ECLIs of the cases downloaded in streaming mode, parsed as soon as they are stored, or of a sample
+    cases = None
+
+    # ECLIs flagged as new, updated or removed by a sync; only these are parsed again
+    delta = None
+
+    if config.preview:
+        # Only label the summaries in the result feeds; no cases are downloaded or parsed
+        if not config.skip_query:
+            caseloader.query_ECLI_index(query, retrieve_all=True)
+        preview_punishments(caseloader.feed_dir_of(query))
+        return
+
+    if not config.skip_query and config.query.download.sync:
+        # Only download the cases modified since the previous sync
+        delta = caseloader.sync(query, check_section_labels=True)
+    elif not config.skip_query:
         # Submit query that returns an atom feed with results
-        # `retrieve_all` flag recurses the request if there are more than `max` results
+        # `retrieve_all` flag requests all pages of results if there are more than `max` results
         caseloader.query_ECLI_index(query, retrieve_all=True)
 
-        # Request the returned cases from the atom feed
-        # For convenience this function also returns the path where the cases are stored
-        case_dir = caseloader.request_cases_from_feed(check_section_labels=True)
-    else:
-        case_dir = query_dir / 'cases'
+        # Table of the metadata of the results, for analyses before downloading the cases
+        if config.query.download.metadata:
+            caseloader.feed_metadata()
+
+        # Request the returned cases from the atom feed, all of them or a sample within a budget
+        sample = config.query.download.sample
+        if sample.size is not None or sample.time_budget is not None:
+            cases = caseloader.request_sample_from_feed(size=sample.size, time_budget=sample.time_budget,
+                                                        seed=sample.seed, check_section_labels=True)
+        elif stream:
+            cases = caseloader.stream_cases_from_feed(check_section_labels=True,
+                                                      queue_size=config.query.download.queue_size)
+        else:
+            caseloader.request_cases_from_feed(check_section_labels=True)
 
     if not config.caseparser.skip:
         # Config for parsing the xml of the downloaded cases
@@ -59,17 +146,50 @@ def run_pipeline(config: DictConfig, **kwargs) -> None:
         parser = CaseParser(data_key=data_to_key,
                             level=level,
                             include_section_titles=include_section_titles,
-                            include_procedures=include_procedures)
+                            include_procedures=include_procedures,
+                            engine=config.caseparser.engine)
+
+        # Records of cases parsed by earlier runs with the same parser settings
+        cache = ParseCache(query_dir / 'parse_cache.sqlite') if config.caseparser.cache else None
 
         # Parse all the returned cases
-        df = parser.parse_all_cases(case_dir, write_case_text=False)
+        parsed_data = query_dir / 'parsed_data.csv'
+        if delta is not None and parsed_data.is_file() and cache is None:
+            # Replace the rows of the flagged cases in the earlier parsed data, ordered and numbered like a full run;
+            # with a parse cache the full run below only parses the flagged cases anyway
+            log.info("Parsing %d new and updated cases", sum(flag != 'removed' for _, flag in delta))
+            ECLIds = [ECLI for ECLI, flag in delta if flag != 'removed']
+            df_delta = parser.parse_store(store, ECLIds, write_to_csv=False, write_case_text=False,
+                                          workers=config.caseparser.workers, sort=True)
+            case_rows = query_dir / CASE_ROWS_FN
+            df = replace_cases(pd.read_csv(parsed_data, index_col=0),
+                               pd.read_csv(case_rows) if case_rows.is_file() else None,
+                               df_delta, [ECLI for ECLI, _ in delta])
+        else:
+            # `cases` is None unless streaming or sampling, in which case all stored cases are parsed;
+            # streamed cases arrive in the order their downloads finish, so they are ordered by ECLI as well
+            start = time.perf_counter()
+            df = parser.parse_store(store, cases, write_to_csv=False, write_case_text=False,
+                                    workers=config.caseparser.workers, cache=cache, sort=True)
+
+            # Cases excluded by a two-phase fetch are neither downloaded nor parsed;
+            # when streaming, the parse time includes waiting for downloads
+            n_excluded = metrics.summary()['outcomes'].get('excluded', 0)
+            if n_excluded and not stream and df is not None and len(df):
+                per_case = (time.perf_counter() - start) / df['ECLI'].nunique()
+                log.info(f"Parsing took {per_case * 1000:.1f} ms per case; not parsing the {n_excluded} cases "
+                         f"excluded by their metadata saved about {per_case * n_excluded:.1f} s")
+
+        if cache is not None:
+            cache.close()
 
         # Inspect unlabeled sections ('other' / 'overig')
         # parser.inspect_overig_labels(df)  # NOTE Do this with level='section'!
 
         # Write to csv
-        with open(query_dir / 'parsed_data.csv', encoding='utf-8', mode='w') as f:
+        with open(parsed_data, encoding='utf-8', mode='w') as f:
             df.to_csv(f)
+        write_case_rows(df, query_dir)
 
 
     # For each case decision extract all punishment and their heights as a vector
@@ -0,0 +1,80 @@
+'''
+Quick preview of the punishments of a query, extracted from the summaries in its result feeds
+
+Every entry of a result feed has a short summary of the case, e.g.
+"veroordeelt een 28-jarige man tot een gevangenisstraf van 2 maanden".
+Labelling these summaries takes seconds and requires no case downloads,
+which gives a first look at a new query before committing to a full crawl:
+
+    python main.py preview=true
+
+or, with the feeds of an earlier query on disk:
+
+    python -m src.preview --feed-dir data/query/feeds/<fingerprint>
+
+Summaries are much shorter than the decisions of the cases, so the preview
+misses many punishments; it is not a replacement for `extract_all_punishment_vectors`.
+'''
+from pathlib import Path
+from argparse import ArgumentParser
+
+import pandas as pd
+
+from src.feed_index import iter_feed_entries, result_feeds
+from src.extract_punishments import PunishmentPattern, label_hoofdstraf, pick_highest_from_vector
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+PUNISHMENTS = ['TBS', 'gevangenisstraf', 'hechtenis', 'taakstraf', 'geldboete', 'vrijspraak']
+
+
+def preview_punishments(feed_dir, pp=None, out_fn='preview_punishments.csv'):
+    '''
+    Labels the summaries of the entries in the result feeds of `feed_dir`
+
+    pp      compiled PunishmentPattern; compiled here if None
+    out_fn  name of the csv in `feed_dir` the table is written to; None does not write it
+    Returns a dataframe with a row per ECLI: its title, summary, punishment vector and highest punishment,
+    or None if there are no feeds
+    '''
+    feed_dir = Path(feed_dir)
+    results = result_feeds(feed_dir)
+    if len(results) == 0:
+        log.info("Submit a query first. Results not available.")
+        return None
+
+    if pp is None:
+        pp = PunishmentPattern()
+
+    rows = []
+    for result in results:
+        for entry in iter_feed_entries(result):
+            straf_vector = label_hoofdstraf(pp, entry['summary'])
+            straf, hoogte = pick_highest_from_vector(straf_vector)
+            rows.append((entry['id'], entry['title'], entry['summary'], *straf_vector, straf, hoogte))
+
+    df = pd.DataFrame(rows, columns=['ECLI', 'title', 'summary', *PUNISHMENTS, 'hoofdstraf', 'straf_hoogte'])
+    # Feeds of overlapping pages may list an ECLI twice
+    df = df.drop_duplicates('ECLI').reset_index(drop=True)
+
+    n_labelled = int((df['hoofdstraf'] != 'nan').sum())
+    log.info(f"Preview: a punishment was found in {n_labelled} of {len(df)} feed summaries")
+    if n_labelled:
+        log.info("Preview of the highest punishments: " + ', '.join(
+            f"{n} {straf}" for straf, n in df.loc[df['hoofdstraf'] != 'nan', 'hoofdstraf'].value_counts().items()))
+
+    if out_fn is not None:
+        df.to_csv(feed_dir / out_fn, index=False)
+        log.info(f"Preview written to {feed_dir / out_fn}")
+    return df
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Extracts punishments from the summaries in the result feeds of a query")
+    parser.add_argument("--feed-dir", dest="feed_dir", required=True, help="e.g. data/query/feeds/<fingerprint>")
+    parser.add_argument("--out-fn", dest="out_fn", default='preview_punishments.csv')
+    args = parser.parse_args()
+
+    preview_punishments(args.feed_dir, out_fn=args.out_fn)
@@ -0,0 +1,69 @@
+'''
+Stratified sampling of the ECLIs of a query, to crawl a representative working corpus
+within a budget instead of all cases, e.g. to tune the punishment patterns on a new year
+
+The ECLIs are put in a fixed order in which every prefix is a stratified sample by court and
+month of the decision: strata are interleaved in proportion to their size and the cases within
+a stratum are shuffled by a seeded hash of their ECLI. A larger sample therefore contains a
+smaller one, so a sample can be extended later without downloading its cases again.
+'''
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+def _random_key(ECLI, seed):
+    '''
+    Uniform number in [0, 1) determined by the ECLI and the seed only,
+    so the order of an ECLI does not change when other ECLIs are added to the query results
+    '''
+    digest = hashlib.sha1(f'{seed}:{ECLI}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+
+def strata(metadata):
+    '''
+    Returns the stratum of every row of a feed metadata table (see feed_index.feed_metadata):
+    the court code and the month of the decision, e.g. 'RBOVE 2021-01'
+    '''
+    months = metadata['date'].dt.strftime('%Y-%m').fillna('unknown')
+    return metadata['court_code'].astype(str) + ' ' + months
+
+
+def stratified_order(metadata, seed=2021):
+    '''
+    Returns the ECLIs of a feed metadata table in an order in which the first n ECLIs
+    are a stratified sample of size n, for any n
+
+    Within its stratum of size N, the i-th ECLI of the shuffled stratum gets the position (i + u) / N,
+    with u the random key of the stratum; sorting all ECLIs on their position interleaves the strata
+    in proportion to their sizes.
+    '''
+    if len(metadata) == 0:
+        return []
+
+    df = pd.DataFrame({'ECLI': metadata['ECLI'].values, 'stratum': strata(metadata).values})
+    df['key'] = [_random_key(ECLI, seed) for ECLI in df['ECLI']]
+    df = df.sort_values(['stratum', 'key'], kind='stable')
+
+    rank = df.groupby('stratum').cumcount().to_numpy()
+    size = df.groupby('stratum')['ECLI'].transform('size').to_numpy()
+    offset = np.array([_random_key(stratum, seed) for stratum in df['stratum']])
+    df['position'] = (rank + offset) / size
+
+    return df.sort_values(['position', 'key'], kind='stable')['ECLI'].tolist()
+
+
+def log_coverage(metadata, sample):
+    '''
+    Logs how many strata and cases of the population the sample covers
+    '''
+    population = strata(metadata)
+    sampled = population[metadata['ECLI'].isin(set(sample)).values]
+    log.info(f"Sample of {len(sample)} of {len(metadata)} ECLIs covers {sampled.nunique()} "
+             f"of {population.nunique()} strata (court x month)")
@@ -0,0 +1,172 @@
+'''
+Partitions a crawl over several independent workers and merges their outputs
+
+Every ECLI belongs to exactly one of `num_shards` shards, determined by a hash of the ECLI,
+so workers that run the same query each download and parse a disjoint slice of the cases:
+
+    python main.py query.download.shard_index=0 query.download.num_shards=4
+    ...
+    python main.py query.download.shard_index=3 query.download.num_shards=4
+
+Each worker writes to 'query/shard-{index}-of-{num_shards}' in its data directory.
+Afterwards the shard directories are merged into a single corpus:
+
+    python -m src.shards data/query/shard-*-of-4 --out-dir data/query
+'''
+import hashlib
+from pathlib import Path
+from argparse import ArgumentParser
+
+import pandas as pd
+
+from src.case_store import open_case_store
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+def shard_of(ECLI, num_shards):
+    '''
+    Returns the shard of an ECLI; the same on every machine and Python process, unlike hash()
+    '''
+    digest = hashlib.md5(ECLI.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards
+
+
+def select_shard(ECLIds, shard_index, num_shards):
+    '''
+    Returns the ECLIs that belong to shard `shard_index`, in their original order
+    '''
+    return [ECLI for ECLI in ECLIds if shard_of(ECLI, num_shards) == shard_index]
+
+
+def shard_dir(query_dir, shard_index, num_shards):
+    return Path(query_dir) / f'shard-{shard_index}-of-{num_shards}'
+
+
+# Rows of each case in the parsed data of a shard, see write_case_rows
+CASE_ROWS_FN = 'parsed_rows.csv'
+
+
+def write_case_rows(df, out_dir):
+    '''
+    Writes the number of rows of each case in parsed data `df` before its sections without text were dropped
+    (see CaseParser._frame_from_columns), with which merge_shards numbers the rows like a single-node run
+    Removes an earlier file if `df` does not have these numbers, e.g. after replacing the rows of some cases
+    '''
+    path = Path(out_dir) / CASE_ROWS_FN
+    case_rows = df.attrs.get('case_rows') if df is not None else None
+    if case_rows is None:
+        path.unlink(missing_ok=True)
+        return
+    pd.DataFrame(case_rows, columns=['ECLI', 'n_rows']).to_csv(path, index=False)
+
+
+def _starts(rows):
+    # Id of the first row of each case when the cases in `rows` are numbered in order
+    return pd.Series((rows['n_rows'].cumsum() - rows['n_rows']).to_numpy(), index=rows['ECLI'])
+
+
+def _renumber(frame, local_start, global_start):
+    ids = (frame.index.to_numpy() - frame['ECLI'].map(local_start).to_numpy()
+           + frame['ECLI'].map(global_start).to_numpy())
+    return frame.set_axis(pd.Index(ids, name='id'))
+
+
+def _number_like_single_node(frames, case_rows):
+    '''
+    Gives the rows of the parsed data of the shards the ids of a single-node run:
+    the position of the row among the rows of all cases, ordered by ECLI, before empty sections were dropped
+    '''
+    global_start = _starts(pd.concat(case_rows).sort_values('ECLI', kind='stable'))
+    numbered = [_renumber(frame, _starts(rows), global_start) for frame, rows in zip(frames, case_rows)]
+    return pd.concat(numbered).sort_index()
+
+
+def replace_cases(df, case_rows, df_new, ECLIds):
+    '''
+    Replaces the rows of the cases `ECLIds` in parsed data `df` by those in `df_new`, e.g. after a sync
+    (see CaseLoader.sync); cases in `ECLIds` without rows in `df_new` are removed
+
+    case_rows   rows per case of `df` as written by `write_case_rows`; with these the result is ordered
+                and numbered like parsing all cases at once, otherwise the rows are ordered by ECLI and numbered anew
+    df_new      parsed data of the new and updated cases, e.g. from CaseParser.parse_store; may be None
+    Returns the parsed data, with the rows per case in `attrs['case_rows']` if they are known
+    '''
+    kept = df[~df['ECLI'].isin(ECLIds)]
+    if df_new is None:
+        df_new = kept.iloc[:0]
+        df_new.attrs['case_rows'] = []
+
+    new_rows = df_new.attrs.get('case_rows')
+    if case_rows is None or new_rows is None:
+        log.warning("The rows per case are not known; the parsed data are numbered anew")
+        # A stable sort keeps the order of the sections within a case
+        df = pd.concat([kept, df_new]).sort_values('ECLI', kind='stable')
+        df.index = pd.RangeIndex(len(df), name='id')
+        return df
+
+    new_rows = pd.DataFrame(new_rows, columns=['ECLI', 'n_rows'])
+    rows = pd.concat([case_rows[~case_rows['ECLI'].isin(ECLIds)], new_rows]).sort_values('ECLI', kind='stable')
+    global_start = _starts(rows)
+    df = pd.concat([_renumber(kept, _starts(case_rows), global_start),
+                    _renumber(df_new, _starts(new_rows), global_start)]).sort_index()
+    df.attrs['case_rows'] = list(rows.itertuples(index=False, name=None))
+    return df
+
+
+def merge_shards(shard_dirs, out_dir, data_fn='parsed_data.csv', store='directory', compression='gzip',
+                 max_shard_size=256):
+    '''
+    Combines the cases and parsed data of shard directories into `out_dir`
+
+    The parsed data are ordered by ECLI and numbered like those of a single-node run (see CaseParser.parse_store),
+    using the rows per case each shard writes with `write_case_rows`; without these the rows are numbered anew.
+
+    store       type of the case stores of the shards and the merged store, see case_store.open_case_store
+    Returns the merged dataframe, or None if none of the shards holds parsed data
+    '''
+    out_dir = Path(out_dir)
+    case_dir = 'cases' if store == 'directory' else 'archive'
+    merged = open_case_store(store, out_dir / case_dir, compression=compression, max_shard_size=max_shard_size)
+
+    frames = []
+    case_rows = []
+    for directory in sorted(Path(d) for d in shard_dirs):
+        shard = open_case_store(store, directory / case_dir, compression=compression, max_shard_size=max_shard_size)
+        merged.update(shard)
+        log.info(f"Merged {len(shard)} cases of {directory}")
+
+        parsed_data = directory / data_fn
+        if parsed_data.is_file():
+            frames.append(pd.read_csv(parsed_data, index_col=0))
+            rows = directory / CASE_ROWS_FN
+            case_rows.append(pd.read_csv(rows) if rows.is_file() else None)
+        else:
+            log.warning(f"No {data_fn} in {directory}")
+
+    if len(frames) == 0:
+        return None
+
+    if all(rows is not None for rows in case_rows):
+        df = _number_like_single_node(frames, case_rows)
+    else:
+        log.warning(f"Not all shards have a {CASE_ROWS_FN}; the merged rows are numbered anew")
+        # The shards are disjoint; a stable sort keeps the order of the sections within a case
+        df = pd.concat(frames).sort_values('ECLI', kind='stable')
+        df.index = pd.RangeIndex(len(df), name='id')
+    df.to_csv(out_dir / data_fn)
+    log.info(f"Merged {len(df)} rows of {len(frames)} shards into {out_dir / data_fn}")
+    return df
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Merges the outputs of a sharded crawl")
+    parser.add_argument("shard_dirs", nargs='+', help="e.g. data/query/shard-*-of-4")
+    parser.add_argument("--out-dir", dest="out_dir", required=True, help="e.g. data/query")
+    parser.add_argument("--data-fn", dest="data_fn", default='parsed_data.csv')
+    parser.add_argument("--store", dest="store", default='directory', choices=['directory', 'sharded'])
+    parser.add_argument("--compression", dest="compression", default='gzip', choices=['gzip', 'zstd'])
+    args = parser.parse_args()
+
+    merge_shards(args.shard_dirs, args.out_dir, data_fn=args.data_fn, store=args.store, compression=args.compression)
@@ -0,0 +1,327 @@
+'''
+Local stand-in for the rechtspraak.nl open data API, for offline tests and benchmarks
+
+Serves the ECLI index ('/uitspraken/zoeken') and case contents ('/uitspraken/content')
+under the same paths as data.rechtspraak.nl, so CaseLoader only needs another base URL:
+
+    python -m src.standin_server --feed-dir data/query/feeds/<fingerprint> --latency 0.05
+
+Feeds are served from `feed_dir` (the 'results_from_{x}.atom' files of an earlier query)
+if available, otherwise an index of `n_cases` synthetic ECLIs is generated.
+Cases are served from `case_dir` if available, e.g. tests/fixtures/cases; otherwise a synthetic labelled case
+is generated for every ECLI of the served feeds, or of the synthetic index.
+With 'return=META' only the metadata of a case is served, like the real API does.
+Responses carry ETag and Last-Modified validators and conditional requests get 304 Not Modified.
+'''
+import time
+import random
+import hashlib
+import threading
+from pathlib import Path
+from argparse import ArgumentParser
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import regex
+
+from src.http_client import TokenBucket
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+SYNTHETIC_CASE = '''<?xml version="1.0" encoding="utf-8"?>
+<open-rechtspraak>
+  <rdf:RDF xmlns:dcterms="http://purl.org/dc/terms/" xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#" xmlns:psi="http://psi.rechtspraak.nl/">
+    <rdf:Description>
+      <dcterms:identifier>{ECLI}</dcterms:identifier>
+      <dcterms:modified>{date}T12:00:00</dcterms:modified>
+      <dcterms:creator rdfs:label="Instantie">Rechtbank Overijssel</dcterms:creator>
+      <dcterms:date rdfs:label="Uitspraakdatum">{date}</dcterms:date>
+      <psi:zaaknummer rdfs:label="Zaaknr">08/{number:06d}-21</psi:zaaknummer>
+      <dcterms:type rdfs:label="Uitspraak/Conclusie">Uitspraak</dcterms:type>
+      <psi:procedure rdfs:label="Procedure">{procedure}</psi:procedure>
+      <dcterms:subject rdfs:label="Rechtsgebied">Strafrecht</dcterms:subject>
+    </rdf:Description>
+  </rdf:RDF>
+  <inhoudsindicatie id="{ECLI}:INH"><para>Synthetische uitspraak.</para></inhoudsindicatie>
+  <uitspraak id="{ECLI}:DOC">
+    <section role="procesverloop"><title><nr>1</nr>Het onderzoek ter terechtzitting</title>{paragraphs}</section>
+    <section role="overwegingen"><title><nr>2</nr>Overwegingen</title>{paragraphs}</section>
+    <section role="beslissing"><title><nr>3</nr>De beslissing</title>
+      <parablock><para>Veroordeelt verdachte tot een gevangenisstraf voor de duur van {number} dagen.</para></parablock>
+    </section>
+  </uitspraak>
+</open-rechtspraak>
+'''
+
+PARAGRAPH = '<parablock><para>De rechtbank heeft kennisgenomen van de vordering van de officier van justitie.</para></parablock>'
+
+
+# ECLIs of Dutch decisions, e.g. 'ECLI:NL:RBOVE:2021:5' or 'ECLI:NL:HR:2012:BX0146'
+MATCH_ECLI = regex.compile(r'ECLI:NL:[A-Z0-9]{1,7}:\d{4}:[A-Z0-9.]{1,25}')
+
+
+def synthetic_ECLIds(n_cases):
+    return [f'ECLI:NL:RBOVE:2021:{number}' for number in range(1, n_cases + 1)]
+
+
+def synthetic_case(ECLI, paragraphs=20, procedures=('Eerste aanleg - meervoudig',)):
+    '''
+    procedures  the procedure of the case is drawn from these in turn, by the number of the ECLI
+    '''
+    number = ECLI.rsplit(':', 1)[-1]
+    # Older ECLIs have letters in their number, e.g. 'BX0146'
+    number = int(number) if number.isdigit() else int(hashlib.sha1(number.encode('utf-8')).hexdigest()[:6], 16)
+    date = f'2021-{number % 12 + 1:02d}-{number % 28 + 1:02d}'
+    return SYNTHETIC_CASE.format(ECLI=ECLI, date=date, number=number, paragraphs=PARAGRAPH * paragraphs,
+                                 procedure=procedures[number % len(procedures)]).encode('utf-8')
+
+
+def case_metadata(content):
+    '''
+    Returns the metadata representation of a case xml (return=META): the document without its contents
+    '''
+    end = content.find(b'</rdf:RDF>')
+    if end == -1:
+        return content
+    return content[:end + len(b'</rdf:RDF>')] + b'\n</open-rechtspraak>\n'
+
+
+def atom_feed(n_hits, ECLIds, summaries=None):
+    '''
+    summaries   optional summary text per ECLI
+    '''
+    summaries = summaries or {}
+    entries = ''.join(f'<entry><id>{ECLI}</id><title type="text">{ECLI}, Rechtbank Overijssel, 01-01-2021, 08/000000-21</title>'
+                      f'<summary type="text">{escape(summaries.get(ECLI, "Synthetische uitspraak"))}</summary>'
+                      f'<updated>2021-01-01T12:00:00Z</updated>'
+                      f'<link rel="alternate" type="text/html" href="https://uitspraken.rechtspraak.nl/inziendocument?id={ECLI}"/></entry>'
+                      for ECLI in ECLIds)
+    return (f'<?xml version="1.0" encoding="utf-8"?><feed xmlns="http://www.w3.org/2005/Atom">'
+            f'<title type="text">Rechtspraak Open Data (Uitspraken)</title>'
+            f'<subtitle type="text">Aantal gevonden ECLI\'s: {n_hits}</subtitle>{entries}</feed>').encode('utf-8')
+
+
+class _ThreadingHTTPServer(ThreadingHTTPServer):
+    # The default backlog of 5 connections drops connections of many concurrent downloads
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class StandinServer:
+    '''
+    Threaded HTTP server that behaves like data.rechtspraak.nl
+
+    Usable as a context manager; `base_url` is the URL to pass to CaseLoader.
+    '''
+
+    def __init__(self, feed_dir=None, case_dir=None, n_cases=1000, case_paragraphs=20,
+                 latency=0.0, error_rate=0.0, rate_limit=None, seed=0, host='127.0.0.1', port=0,
+                 procedures=('Eerste aanleg - meervoudig',)):
+        '''
+        feed_dir        directory with 'results_from_{x}.atom' feeds to serve; None generates an index
+        case_dir        directory with case xmls ('ECLI-NL-...xml') to serve; None generates a case for every ECLI
+                        of the served feeds, or of the generated index
+        n_cases         amount of ECLIs in the generated index
+        case_paragraphs paragraphs per section of a generated case, which sets its size
+        latency         mean response time in seconds; drawn from an exponential distribution
+        error_rate      fraction of requests that get a 503 response
+        rate_limit      requests per second after which requests get a 429 response; None disables throttling
+        seed            seed of the random latency and errors
+        port            port to listen on; 0 picks a free port
+        procedures      procedures of the generated cases, assigned in turn
+        '''
+        self.feed_dir = Path(feed_dir) if feed_dir is not None else None
+        self.case_dir = Path(case_dir) if case_dir is not None else None
+        self.ECLIds = synthetic_ECLIds(n_cases)
+        self.known_ECLIds = set(self.ECLIds)
+        self.case_paragraphs = case_paragraphs
+        self.procedures = tuple(procedures)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # Amount of responses per path and status code, e.g. {('content', 200): 10}
+        self.counts = {}
+        self.bytes_sent = 0
+
+        # Cases changed with `update_case`, with the time they changed
+        self.updated_cases = {}
+        self.started_at = time.time()
+
+        self.httpd = _ThreadingHTTPServer((host, port), self._handler())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/uitspraken'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        log.info(f"Stand-in server listening on {self.base_url}")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _draw(self):
+        # Random numbers are drawn under a lock to keep runs with the same seed comparable
+        with self.lock:
+            delay = self.random.expovariate(1 / self.latency) if self.latency > 0 else 0
+            failed = self.random.random() < self.error_rate
+        return delay, failed
+
+    def _throttled(self):
+        return self.bucket is not None and not self.bucket.try_acquire()
+
+    def _count(self, endpoint, status, n_bytes):
+        with self.lock:
+            self.counts[(endpoint, status)] = self.counts.get((endpoint, status), 0) + 1
+            self.bytes_sent += n_bytes
+
+    def update_case(self, ECLI, content):
+        '''
+        Changes the content of a case, e.g. to test revalidation
+        '''
+        with self.lock:
+            self.updated_cases[ECLI] = (content, time.time())
+
+    def feed(self, params):
+        '''
+        Returns the feed of the ECLI index for the query parameters and the time it was last modified,
+        or None if it is not available
+        '''
+        idx_from = int(params.get('from', ['0'])[0])
+        if self.feed_dir is not None:
+            path = self.feed_dir / f'results_from_{idx_from if idx_from else 1}.atom'
+            return (path.read_bytes(), path.stat().st_mtime) if path.is_file() else None
+
+        page_size = int(params.get('max', ['1000'])[0])
+        return atom_feed(len(self.ECLIds), self.ECLIds[idx_from:idx_from + page_size]), self.started_at
+
+    def case(self, ECLI):
+        '''
+        Returns the xml of a case and the time it was last modified, or None if it is not available
+        '''
+        with self.lock:
+            if ECLI in self.updated_cases:
+                return self.updated_cases[ECLI]
+        if self.case_dir is not None:
+            path = self.case_dir / (ECLI.replace(':', '-') + '.xml')
+            return (path.read_bytes(), path.stat().st_mtime) if path.is_file() else None
+        # Served feeds list real ECLIs, for which synthetic cases stand in
+        known = MATCH_ECLI.fullmatch(ECLI) if self.feed_dir is not None else ECLI in self.known_ECLIds
+        if not known:
+            return None
+        return synthetic_case(ECLI, self.case_paragraphs, self.procedures), self.started_at
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                params = parse_qs(url.query)
+                endpoint = url.path.rstrip('/').rsplit('/', 1)[-1]
+
+                delay, failed = server._draw()
+                if delay:
+                    time.sleep(delay)
+
+                if server._throttled():
+                    self.respond(endpoint, 429, headers={'Retry-After': '1'})
+                elif failed:
+                    self.respond(endpoint, 503)
+                elif endpoint == 'zoeken':
+                    self.respond_document(endpoint, server.feed(params), 'application/atom+xml')
+                elif endpoint == 'content' and params.get('return', [''])[0].upper() == 'META':
+                    # Counted separately from the complete cases
+                    case = server.case(params.get('id', [''])[0])
+                    self.respond_document('meta', case and (case_metadata(case[0]), case[1]), 'application/xml')
+                elif endpoint == 'content':
+                    self.respond_document(endpoint, server.case(params.get('id', [''])[0]), 'application/xml')
+                else:
+                    self.respond(endpoint, 404)
+
+            def not_modified(self, etag, modified_at):
+                # If-None-Match takes precedence over If-Modified-Since
+                if_none_match = self.headers.get('If-None-Match')
+                if if_none_match is not None:
+                    return etag in [tag.strip() for tag in if_none_match.split(',')]
+                if_modified_since = self.headers.get('If-Modified-Since')
+                if if_modified_since is not None:
+                    try:
+                        return int(modified_at) <= parsedate_to_datetime(if_modified_since).timestamp()
+                    except (TypeError, ValueError):
+                        return False
+                return False
+
+            def respond_document(self, endpoint, document, content_type):
+                if document is None:
+                    self.respond(endpoint, 404)
+                    return
+                body, modified_at = document
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                headers = {'ETag': etag, 'Last-Modified': formatdate(modified_at, usegmt=True)}
+                if self.not_modified(etag, modified_at):
+                    self.respond(endpoint, 304, headers=headers)
+                else:
+                    self.respond(endpoint, 200, body, content_type, headers)
+
+            def respond(self, endpoint, status, body=b'', content_type='text/plain', headers={}):
+                server._count(endpoint, status, len(body))
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Requests are counted instead of logged
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Serves a local stand-in of the rechtspraak.nl open data API")
+    parser.add_argument("--feed-dir", dest="feed_dir", default=None, help="e.g. data/query/feeds/<fingerprint>")
+    parser.add_argument("--case-dir", dest="case_dir", default=None,
+                        help="e.g. tests/fixtures/cases; by default synthetic cases are generated")
+    parser.add_argument("--n-cases", dest="n_cases", type=int, default=1000)
+    parser.add_argument("--latency", dest="latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", dest="rate_limit", type=float, default=None)
+    parser.add_argument("--port", dest="port", type=int, default=8000)
+    parser.add_argument("--procedures", dest="procedures", nargs='+', default=['Eerste aanleg - meervoudig'],
+                        help="procedures of the generated cases")
+    args = parser.parse_args()
+
+    server = StandinServer(feed_dir=args.feed_dir, case_dir=args.case_dir, n_cases=args.n_cases,
+                           latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit,
+                           port=args.port, procedures=args.procedures)
+    log.info(f"Serving on {server.base_url}; run the pipeline with query.download.base_url={server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
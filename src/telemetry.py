@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import bisect
+import threading
+from pathlib import Path
+from collections import Counter, defaultdict
+
+from src.utils import get_logger
+
+log = get_logger(__name__)
+
+
+class Histogram:
+    '''
+    Counts observations in fixed buckets, so that its size does not grow with the crawl
+    Percentiles are interpolated within the bucket they fall in.
+    '''
+
+    def __init__(self, bounds):
+        '''
+        bounds  upper bounds of the buckets in increasing order; larger values go in an overflow bucket
+        '''
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.n = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.n += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        if self.n == 0:
+            return None
+        rank = q / 100 * self.n
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        return {
+            'n': self.n,
+            'mean': self.total / self.n if self.n else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'buckets': {(f'<={bound}' if i < len(self.bounds) else f'>{self.bounds[-1]}'): count
+                        for i, (bound, count) in enumerate(zip(self.bounds + [None], self.counts))},
+        }
+
+
+# Latencies in milliseconds and response sizes in KB
+LATENCY_BOUNDS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+SIZE_BOUNDS = [1, 4, 16, 32, 64, 128, 256, 512, 1024, 4096]
+
+
+class DownloadMetrics:
+    '''
+    Thread-safe metrics of the requests of a crawl, per kind of request ('feed' or 'case'):
+    latency and size histograms, status codes, retries and the outcomes of case requests,
+    including the reasons cases are rejected
+
+    Every `interval` seconds a summary is logged and written as json to `path`
+    '''
+
+    def __init__(self, path=None, interval=60):
+        '''
+        path        json file the summaries are written to; None only logs them
+        interval    seconds between summaries
+        '''
+        self.path = Path(path) if path is not None else None
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+        self.started_at = time.time()
+        self.last_report = time.monotonic()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BOUNDS))
+        self.size = defaultdict(lambda: Histogram(SIZE_BOUNDS))
+        self.status_codes = defaultdict(Counter)
+        self.retries = Counter()
+        self.outcomes = Counter()
+        self.rejection_reasons = Counter()
+
+    def record_request(self, kind, latency, status_code=None, n_bytes=0):
+        '''
+        Records a finished request, including its retries
+        latency         seconds
+        status_code     HTTP status code of the final response, or None if there was no response
+        '''
+        with self.lock:
+            self.latency[kind].add(latency * 1000)
+            self.size[kind].add(n_bytes / 1024)
+            self.status_codes[kind][str(status_code) if status_code is not None else 'error'] += 1
+        self._maybe_report()
+
+    def record_retry(self, reason):
+        '''
+        reason  e.g. the status code or the exception of the failed attempt
+        '''
+        with self.lock:
+            self.retries[reason] += 1
+
+    def record_outcome(self, status, reason=None):
+        '''
+        Records the status of a case request (see CaseLoader._request_case) and why it was rejected
+        '''
+        with self.lock:
+            self.outcomes[status] += 1
+            if reason is not None:
+                self.rejection_reasons[reason] += 1
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.started_at
+            n_bytes = sum(histogram.total * 1024 for histogram in self.size.values())
+            n_cases = self.latency['case'].n if 'case' in self.latency else 0
+            return {
+                'started_at': self.started_at,
+                'elapsed': elapsed,
+                'cases_per_second': n_cases / elapsed if elapsed else None,
+                'bytes_per_second': n_bytes / elapsed if elapsed else None,
+                'latency_ms': {kind: histogram.summary() for kind, histogram in self.latency.items()},
+                'size_kb': {kind: histogram.summary() for kind, histogram in self.size.items()},
+                'status_codes': {kind: dict(counts) for kind, counts in self.status_codes.items()},
+                'retries': dict(self.retries),
+                'outcomes': dict(self.outcomes),
+                'rejection_reasons': dict(self.rejection_reasons),
+            }
+
+    def _maybe_report(self):
+        with self.lock:
+            if time.monotonic() - self.last_report < self.interval:
+                return
+            self.last_report = time.monotonic()
+        self.report()
+
+    def report(self):
+        '''
+        Logs a summary and writes it to `path`
+        '''
+        summary = self.summary()
+        case_latency = summary['latency_ms'].get('case')
+        if case_latency is not None and case_latency['n']:
+            log.info(f"{case_latency['n']} cases requested, {summary['cases_per_second']:.1f} cases/s, "
+                     f"{summary['bytes_per_second'] / 1024:.1f} KB/s, latency p50 {case_latency['p50']:.0f} ms "
+                     f"p99 {case_latency['p99']:.0f} ms, {sum(summary['retries'].values())} retries")
+
+        if self.path is not None:
+            with self.write_lock:
+                os.makedirs(self.path.parent, exist_ok=True)
+                tmp = self.path.with_suffix('.tmp')
+                with open(tmp, 'w') as f:
+                    json.dump(summary, f, indent=2)
+                os.replace(tmp, self.path)
+        return summary
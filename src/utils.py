@@ -2,7 +2,10 @@ import logging
 import warnings
 import functools
 import difflib
+import hashlib
+from urllib.parse import unquote_plus
 from typing import Sequence, Callable, Tuple
+from collections.abc import Mapping
 from ast import literal_eval
 
 import numpy as np
@@ -55,6 +58,9 @@ def construct_ECLI_query(params: dict):
     # Construct query
     components = []
     for key, value in params.items():
+        # Nested groups (e.g. 'download') configure the CaseLoader and are not part of the query
+        if isinstance(value, Mapping):
+            continue
         # The ECLI query processing two identically names 'data' keys
         # We can't use duplicate keys in dicts, so we stored them as
         # date_from and date_until and then postprocessing the key here
@@ -69,6 +75,23 @@ def construct_ECLI_query(params: dict):
     return query
 
 
+def query_fingerprint(query: str) -> str:
+    '''
+    Returns a short hash that identifies the results of an ECLI-index query,
+    e.g. to keep the result feeds of different queries apart
+
+    The order of the parameters, their URL encoding and the 'from' offset of a page
+    do not change the fingerprint. Repeated keys such as the two 'date' parameters keep their order.
+    '''
+    params = []
+    for component in query.split('&'):
+        key, _, value = component.partition('=')
+        if key and key != 'from':
+            params.append((unquote_plus(key), unquote_plus(value)))
+    normalised = '&'.join(f"{key}={value}" for key, value in sorted(params, key=lambda param: param[0]))
+    return hashlib.sha1(normalised.encode('utf-8')).hexdigest()[:12]
+
+
 def extras(config: DictConfig) -> None:
     """A couple of optional utilities for OmegaConf
     These extras are controlled by the main config file:
@@ -0,0 +1,111 @@
+"""
+Test cases for the module `case_store`.
+"""
+
+from pathlib import Path
+
+import pytest
+
+from src.case_store import DirectoryCaseStore, GlobalCaseStore, ShardedCaseStore
+from src.caseparser import CaseParser
+
+
+FIXTURE_DIR = Path(__file__).parent / 'fixtures' / 'cases'
+
+
+def fixture_cases():
+    return {path.stem.replace('-', ':'): path.read_bytes() for path in sorted(FIXTURE_DIR.glob('*.xml'))}
+
+
+def test_sharded_store_round_trip(tmp_path):
+    cases = fixture_cases()
+    store = ShardedCaseStore(tmp_path)
+    for ECLI, content in cases.items():
+        store.put(ECLI, content)
+
+    assert len(store) == len(cases)
+    for ECLI, content in cases.items():
+        assert ECLI in store
+        assert store.get(ECLI) == content
+    with pytest.raises(KeyError):
+        store.get('ECLI:NL:RBOVE:2021:0')
+
+    # The index survives reopening the store
+    reopened = ShardedCaseStore(tmp_path)
+    assert sorted(reopened.keys()) == sorted(cases)
+
+
+def test_sharded_store_rotates_shards(tmp_path):
+    cases = fixture_cases()
+    # Shards of ~4 KB hold only one or two compressed cases
+    store = ShardedCaseStore(tmp_path, max_shard_size=4 / 1024)
+    for ECLI, content in cases.items():
+        store.put(ECLI, content)
+
+    assert len(list(tmp_path.glob('shard-*.gz'))) > 1
+    assert dict(store.items()) == cases
+
+
+def test_sharded_store_replace_and_remove(tmp_path):
+    store = ShardedCaseStore(tmp_path)
+    store.put('ECLI:NL:RBOVE:2021:1', b'<old/>')
+    store.put('ECLI:NL:RBOVE:2021:1', b'<new/>')
+    store.put('ECLI:NL:RBOVE:2021:2', b'<other/>')
+    assert store.get('ECLI:NL:RBOVE:2021:1') == b'<new/>'
+    assert len(store) == 2
+
+    store.remove('ECLI:NL:RBOVE:2021:1')
+    assert 'ECLI:NL:RBOVE:2021:1' not in store
+    assert list(store.items()) == [('ECLI:NL:RBOVE:2021:2', b'<other/>')]
+
+
+def test_parse_store_matches_parse_all_cases(tmp_path):
+    parser = CaseParser(include_procedures=['Eerste aanleg - meervoudig', 'Eerste aanleg - enkelvoudig'])
+    # The empty first section of RBROT:2021:1932 is not supported by parse_case
+    sources = [path for path in sorted(FIXTURE_DIR.glob('*.xml')) if 'RBROT' not in path.name]
+
+    directory = DirectoryCaseStore(tmp_path / 'cases')
+    sharded = ShardedCaseStore(tmp_path / 'archive')
+    for path in sources:
+        ECLI = path.stem.replace('-', ':')
+        directory.put(ECLI, path.read_bytes())
+        sharded.put(ECLI, path.read_bytes())
+
+    expected = parser.parse_all_cases(tmp_path / 'cases', write_to_csv=False)
+    ECLIds = [path.stem.replace('-', ':') for path in sources]
+    for store in (directory, sharded):
+        df = parser.parse_store(store, ECLIds, write_to_csv=False)
+        assert df.equals(expected)
+
+        # Streamed ECLIs arrive in any order, the sorted result is that of parsing the whole store
+        streamed = parser.parse_store(store, iter(ECLIds[::-1]), write_to_csv=False, sort=True)
+        assert streamed.to_csv() == parser.parse_store(store, write_to_csv=False).to_csv()
+
+
+def test_global_store_deduplicates_and_counts_references(tmp_path):
+    cases = fixture_cases()
+    ECLI, content = next(iter(cases.items()))
+    first = GlobalCaseStore(tmp_path, 'query_2020')
+    second = first.namespaced('query_2021')
+
+    first.put(ECLI, content)
+    assert ECLI not in second
+    assert second.link(ECLI) is not None
+    assert second.get(ECLI) == content
+    assert second.link('ECLI:NL:RBOVE:2021:0') is None
+    assert first.stats()['objects'] == 1 and first.stats()['references'] == 2
+
+    # The object is kept until the last reference to it is removed
+    first.remove(ECLI)
+    assert second.get(ECLI) == content
+    second.put(ECLI, b'<updated/>')
+    assert first.stats() == {'references': 1, 'objects': 1, 'bytes': len(b'<updated/>')}
+    assert len(list((tmp_path / 'objects').rglob('*.xml'))) == 1
+
+    # Identical content of different ECLIs is stored once
+    for other, other_content in cases.items():
+        first.put(other, other_content)
+        first.put(other + '0', other_content)
+    assert first.stats()['objects'] == len(cases) + 1
+    assert len(first) == 2 * len(cases)
+    assert GlobalCaseStore(tmp_path, 'query_2021').keys() == [ECLI]
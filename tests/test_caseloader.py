@@ -0,0 +1,463 @@
+"""
+Test cases for the module `caseloader`.
+"""
+
+import os
+import hashlib
+
+import pytest
+import regex
+import pandas as pd
+import requests
+
+from src.caseloader import CaseLoader
+from src.caseparser import CaseParser
+from src.case_store import GlobalCaseStore, ShardedCaseStore
+from src.feed_filter import FeedFilter
+from src.metadata_filter import MetadataFilter
+from src.http_client import HttpClient
+from src.standin_server import StandinServer, atom_feed, synthetic_case
+from src.utils import query_fingerprint
+
+
+LABELLED_CASE = (b'<?xml version="1.0" encoding="utf-8"?><open-rechtspraak><uitspraak>'
+                 b'<section role="overwegingen"><title>Overwegingen</title><para>Tekst</para></section>'
+                 b'<section role="beslissing"><title>Beslissing</title><para>Veroordeelt</para></section>'
+                 b'</uitspraak></open-rechtspraak>')
+
+UNLABELLED_CASE = (b'<?xml version="1.0" encoding="utf-8"?><open-rechtspraak><uitspraak>'
+                   b'<para>Geen secties</para></uitspraak></open-rechtspraak>')
+
+
+class FakeResponse:
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    '''
+    Stands in for requests.Session; cases with an even number lack section labels
+    '''
+
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        number = int(url.rsplit(':', 1)[-1])
+        return FakeResponse(UNLABELLED_CASE if number % 2 == 0 else LABELLED_CASE)
+
+
+ECLIds = [f'ECLI:NL:RBOVE:2021:{i}' for i in range(1, 21)]
+
+
+def request_cases(tmp_path, max_workers):
+    caseloader = CaseLoader(tmp_path / f'workers_{max_workers}', max_workers=max_workers)
+    caseloader.http.session = FakeSession()
+    counts = caseloader._request_cases(ECLIds, caseloader.out_dir / 'cases')
+    return caseloader, counts
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_request_counts(tmp_path, max_workers):
+    caseloader, counts = request_cases(tmp_path, max_workers)
+    assert counts['saved'] == 10
+    assert counts['rejected'] == 10
+
+    # A second run finds everything that was saved on disk
+    counts = caseloader._request_cases(ECLIds, caseloader.out_dir / 'cases')
+    assert counts['exists'] == 10
+    assert counts['saved'] == 0
+
+
+def test_concurrent_downloads_match_sequential(tmp_path):
+    sequential, _ = request_cases(tmp_path, max_workers=1)
+    concurrent, _ = request_cases(tmp_path, max_workers=4)
+
+    sequential_files = sorted(os.listdir(sequential.out_dir / 'cases'))
+    concurrent_files = sorted(os.listdir(concurrent.out_dir / 'cases'))
+    assert sequential_files == concurrent_files
+    for fn in sequential_files:
+        assert (sequential.out_dir / 'cases' / fn).read_bytes() == (concurrent.out_dir / 'cases' / fn).read_bytes()
+
+    # Every ECLI is only requested once
+    assert sorted(concurrent.http.session.urls) == sorted(set(concurrent.http.session.urls))
+
+
+def test_stream_cases_yields_stored_cases(tmp_path):
+    caseloader = CaseLoader(tmp_path, max_workers=4)
+    caseloader.http.session = FakeSession()
+
+    streamed = sorted(caseloader.stream_cases(ECLIds, queue_size=4))
+    assert streamed == sorted(caseloader.store.keys())
+    assert len(streamed) == 10
+
+
+def test_request_cases_into_sharded_store(tmp_path):
+    store = ShardedCaseStore(tmp_path / 'archive')
+    caseloader = CaseLoader(tmp_path, max_workers=4, store=store)
+    caseloader.http.session = FakeSession()
+    counts = caseloader._request_cases(ECLIds)
+    assert counts == {'saved': 10, 'rejected': 10}
+    assert len(store) == 10
+    assert store.get('ECLI:NL:RBOVE:2021:1') == LABELLED_CASE
+    assert not (tmp_path / 'cases').exists()
+
+
+def test_stream_cases_applies_backpressure(tmp_path):
+    caseloader = CaseLoader(tmp_path, max_workers=4)
+    caseloader.http.session = FakeSession()
+    queue_size = 3
+
+    # Cases are only requested when earlier cases are consumed
+    for n_consumed, _ in enumerate(caseloader.stream_cases(ECLIds, tmp_path / 'cases', queue_size=queue_size), start=1):
+        n_rejected = sum(1 for url in caseloader.http.session.urls if int(url.rsplit(':', 1)[-1]) % 2 == 0)
+        assert len(caseloader.http.session.urls) <= n_consumed + n_rejected + queue_size
+
+
+class FakeIndex:
+    '''
+    Stands in for requests.Session when querying an ECLI index with `n_hits` results
+    '''
+
+    def __init__(self, n_hits, page_size):
+        self.ECLIds = [f'ECLI:NL:RBOVE:2021:{i}' for i in range(1, n_hits + 1)]
+        self.page_size = page_size
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        match = regex.search(r'from=(\d+)', url)
+        idx_from = int(match.group(1)) if match else 0
+        page = self.ECLIds[idx_from:idx_from + self.page_size]
+        return FakeResponse(atom_feed(len(self.ECLIds), page))
+
+
+def test_query_retrieves_all_pages(tmp_path):
+    caseloader = CaseLoader(tmp_path, max_workers=4)
+    caseloader.http.session = FakeIndex(n_hits=45, page_size=10)
+    caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+
+    feeds = sorted(path.name for path in caseloader.feed_dir.glob('results_from_*.atom'))
+    assert feeds == sorted(f'results_from_{i}.atom' for i in [1, 10, 20, 30, 40])
+    assert len(caseloader._ECLIds_from_feeds()) == 45
+    assert (caseloader.feed_dir / 'query_ECLIds.json').is_file()
+
+
+def test_feed_metadata_written_as_parquet(tmp_path):
+    caseloader = CaseLoader(tmp_path, max_workers=4)
+    caseloader.http.session = FakeIndex(n_hits=45, page_size=10)
+    caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+
+    df = caseloader.feed_metadata()
+    assert len(df) == 45
+    written = pd.read_parquet(caseloader.feed_dir / 'feed_metadata.parquet')
+    # Lists are read back as arrays
+    assert [list(numbers) for numbers in written['case_numbers']] == df['case_numbers'].tolist()
+    pd.testing.assert_frame_equal(written.drop(columns='case_numbers'), df.drop(columns='case_numbers'))
+
+
+def test_query_resumes_from_pages_on_disk(tmp_path):
+    caseloader = CaseLoader(tmp_path, max_workers=4)
+    caseloader.http.session = FakeIndex(n_hits=45, page_size=10)
+    caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+
+    # Only the missing page is requested again
+    (caseloader.feed_dir / 'results_from_20.atom').unlink()
+    caseloader.http.session = FakeIndex(n_hits=45, page_size=10)
+    caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+    assert len(caseloader.http.session.urls) == 1
+    assert 'from=20' in caseloader.http.session.urls[0]
+
+
+def test_feeds_of_different_queries_are_kept_apart(tmp_path):
+    caseloader = CaseLoader(tmp_path, max_workers=4)
+    caseloader.http.session = FakeIndex(n_hits=45, page_size=10)
+    caseloader.query_ECLI_index('type=uitspraak&date=2020-01-01&date=2021-01-01&max=10', retrieve_all=True)
+    first = caseloader.feed_dir
+
+    caseloader.http.session = FakeIndex(n_hits=25, page_size=10)
+    caseloader.query_ECLI_index('type=uitspraak&date=2021-01-01&date=2022-01-01&max=10', retrieve_all=True)
+    assert caseloader.feed_dir != first
+    assert len(caseloader._ECLIds_from_feeds()) == 25
+
+    # Switching back to the first query uses its cached feeds, whatever the order of its parameters
+    caseloader.http.session = FakeIndex(n_hits=45, page_size=10)
+    caseloader.query_ECLI_index('max=10&type=uitspraak&date=2020-01-01&date=2021-01-01', retrieve_all=True)
+    assert caseloader.feed_dir == first
+    assert caseloader.http.session.urls == []
+    assert len(caseloader._ECLIds_from_feeds()) == 45
+
+
+def test_feeds_of_earlier_versions_are_reused(tmp_path):
+    caseloader = CaseLoader(tmp_path, max_workers=4)
+    caseloader.http.session = FakeIndex(n_hits=45, page_size=10)
+    caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True, feed_dir=tmp_path)
+
+    caseloader = CaseLoader(tmp_path, max_workers=4)
+    caseloader.http.session = FakeIndex(n_hits=45, page_size=10)
+    caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+    assert caseloader.feed_dir == tmp_path
+    assert caseloader.http.session.urls == []
+
+    # Another query does not use them
+    caseloader.query_ECLI_index('type=uitspraak&max=20', retrieve_all=True)
+    assert caseloader.feed_dir == tmp_path / 'feeds' / query_fingerprint('type=uitspraak&max=20')
+
+
+def test_rerun_makes_no_requests(tmp_path):
+    caseloader, _ = request_cases(tmp_path, max_workers=4)
+    assert caseloader.ledger.counts() == {'saved': 10, 'rejected': 10}
+    assert caseloader.ledger.get('ECLI:NL:RBOVE:2021:2')['reason'] == 'no sections'
+    assert caseloader.metrics.rejection_reasons == {'no sections': 10}
+
+    # Both the saved and the rejected cases are known on the next run
+    caseloader = CaseLoader(caseloader.out_dir, max_workers=4)
+    caseloader.http.session = FakeSession()
+    counts = caseloader._request_cases(ECLIds, caseloader.out_dir / 'cases')
+    assert counts == {'exists': 10, 'rejected': 10}
+    assert caseloader.http.session.urls == []
+
+
+class FakeRechtspraak:
+    '''
+    Stands in for requests.Session with both the ECLI index and the case contents;
+    queries with a 'modified' parameter only return the `modified` ECLIs
+    '''
+
+    def __init__(self, ECLIds, modified=()):
+        self.ECLIds = ECLIds
+        self.modified = list(modified)
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        if 'zoeken' in url:
+            ECLIds = self.modified if 'modified=' in url else self.ECLIds
+            return FakeResponse(atom_feed(len(ECLIds), ECLIds))
+        return FakeResponse(LABELLED_CASE)
+
+
+def test_sample_is_extended_without_downloading_it_again(tmp_path):
+    caseloader = CaseLoader(tmp_path, max_workers=4)
+    caseloader.http.session = FakeRechtspraak(ECLIds)
+    caseloader.query_ECLI_index('type=uitspraak', retrieve_all=True)
+    sample = caseloader.request_sample_from_feed(size=5, seed=1)
+    assert len(sample) == 5
+
+    # The same seed draws the same sample; a larger one contains it
+    caseloader.http.session.urls = []
+    extended = caseloader.request_sample_from_feed(size=8, seed=1)
+    assert extended[:5] == sample
+    case_requests = [url.rsplit('=', 1)[-1] for url in caseloader.http.session.urls if 'content' in url]
+    assert sorted(case_requests) == sorted(extended[5:])
+    assert (tmp_path / 'sample_ECLIds.txt').read_text().split() == extended
+
+
+def test_sync_downloads_only_modified_cases(tmp_path):
+    caseloader = CaseLoader(tmp_path, max_workers=4)
+    caseloader.http.session = FakeRechtspraak(ECLIds[:5])
+    delta = caseloader.sync('type=uitspraak')
+    assert sorted(delta) == sorted((ECLI, 'new') for ECLI in ECLIds[:5])
+
+    # The second sync only requests the modified ECLIs
+    caseloader.http.session = FakeRechtspraak(ECLIds[:6], modified=[ECLIds[0], ECLIds[5]])
+    delta = caseloader.sync('type=uitspraak')
+    assert sorted(delta) == sorted([(ECLIds[0], 'updated'), (ECLIds[5], 'new')])
+    case_requests = [url for url in caseloader.http.session.urls if 'content' in url]
+    assert len(case_requests) == 2
+    assert (tmp_path / 'delta_ECLIds.txt').read_text().count('\n') == 2
+
+
+def test_download_from_standin_server(tmp_path):
+    http = HttpClient(backoff=0.01, max_backoff=0.05, failure_threshold=1000, pool_size=4)
+    with StandinServer(n_cases=45, case_paragraphs=1, error_rate=0.1, rate_limit=200) as server:
+        caseloader = CaseLoader(tmp_path, max_workers=4, http=http, base_url=server.base_url)
+        caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+        caseloader.request_cases_from_feed()
+
+    # Failed and throttled requests are retried until every case is downloaded
+    assert sorted(caseloader.store.keys()) == sorted(server.ECLIds)
+    assert server.counts[('content', 200)] == 45
+    assert caseloader.store.get(server.ECLIds[0]) == synthetic_case(server.ECLIds[0], paragraphs=1)
+
+
+def test_standin_server_serves_cases_of_served_feeds(tmp_path):
+    # Feeds of an earlier query list real ECLIs, outside the synthetic index
+    feed_dir = tmp_path / 'feeds'
+    feed_dir.mkdir()
+    real_ECLIds = ['ECLI:NL:RBAMS:2021:765', 'ECLI:NL:GHAMS:2021:100', 'ECLI:NL:HR:2012:BX0146']
+    (feed_dir / 'results_from_1.atom').write_bytes(atom_feed(len(real_ECLIds), real_ECLIds))
+
+    with StandinServer(feed_dir=feed_dir, case_paragraphs=1) as server:
+        caseloader = CaseLoader(tmp_path / 'query', max_workers=4, base_url=server.base_url)
+        caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+        assert caseloader._ECLIds_from_feeds() == real_ECLIds
+        assert caseloader._request_cases(real_ECLIds) == {'saved': 3}
+        assert server.case('not an ECLI') is None
+
+    assert caseloader.store.get(real_ECLIds[0]) == synthetic_case(real_ECLIds[0], paragraphs=1)
+
+
+def test_revalidate_only_downloads_changed_cases(tmp_path):
+    with StandinServer(n_cases=20, case_paragraphs=1) as server:
+        caseloader = CaseLoader(tmp_path, max_workers=4, base_url=server.base_url)
+        caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+        caseloader.request_cases_from_feed()
+        assert caseloader.ledger.get(server.ECLIds[0])['etag'] is not None
+
+        changed = server.ECLIds[3]
+        server.update_case(changed, synthetic_case(changed, paragraphs=2))
+        bytes_sent = server.bytes_sent
+
+        # Unchanged feeds and cases are not sent again
+        caseloader = CaseLoader(tmp_path, max_workers=4, base_url=server.base_url, revalidate=True)
+        caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+        counts = caseloader._request_cases(server.ECLIds)
+
+    assert counts == {'exists': 19, 'updated': 1}
+    assert server.counts[('zoeken', 304)] == 2
+    assert server.counts[('content', 304)] == 19
+    assert server.bytes_sent - bytes_sent == len(synthetic_case(changed, paragraphs=2))
+    assert caseloader.store.get(changed) == synthetic_case(changed, paragraphs=2)
+
+
+def test_overlapping_queries_share_global_store(tmp_path):
+    with StandinServer(n_cases=20, case_paragraphs=1) as server:
+        first = CaseLoader(tmp_path / 'query_2020', max_workers=4, base_url=server.base_url,
+                           store=GlobalCaseStore(tmp_path / 'store', tmp_path / 'query_2020'))
+        assert first._request_cases(server.ECLIds[:12]) == {'saved': 12}
+
+        # Only the ECLIs the first query did not download are requested
+        second = CaseLoader(tmp_path / 'query_2021', max_workers=4, base_url=server.base_url,
+                            store=GlobalCaseStore(tmp_path / 'store', tmp_path / 'query_2021'))
+        assert second._request_cases(server.ECLIds[6:]) == {'linked': 6, 'saved': 8}
+
+    assert server.counts[('content', 200)] == 20
+    assert sorted(second.store.keys()) == sorted(server.ECLIds[6:])
+    assert second.store.stats()['objects'] == 20
+    assert second.ledger.get(server.ECLIds[6])['sha256'] == first.ledger.get(server.ECLIds[6])['sha256']
+
+
+def test_two_phase_fetch_skips_excluded_procedures(tmp_path):
+    procedures = ('Eerste aanleg - meervoudig', 'Hoger beroep')
+    parser = CaseParser(include_procedures=['Eerste aanleg - meervoudig'])
+    with StandinServer(n_cases=20, case_paragraphs=20, procedures=procedures) as server:
+        full = CaseLoader(tmp_path / 'full', max_workers=4, base_url=server.base_url)
+        assert full._request_cases(server.ECLIds) == {'saved': 20}
+        full_bytes = server.bytes_sent
+
+        two_phase = CaseLoader(tmp_path / 'two_phase', max_workers=4, base_url=server.base_url,
+                               metadata_filter=MetadataFilter(include_procedures=parser.include_procedures))
+        assert two_phase._request_cases(server.ECLIds) == {'saved': 10, 'excluded': 10}
+
+        # A rerun sends no requests, also not for the metadata of excluded cases
+        n_requests = sum(server.counts.values())
+        assert two_phase._request_cases(server.ECLIds) == {'exists': 10, 'excluded': 10}
+        assert sum(server.counts.values()) == n_requests
+
+    assert server.counts[('meta', 200)] == 20
+    assert server.counts[('content', 200)] == 30
+    assert server.bytes_sent - full_bytes < full_bytes
+    assert two_phase.ledger.counts() == {'saved': 10, 'excluded': 10}
+    assert parser.parse_store(two_phase.store, write_to_csv=False).equals(
+        parser.parse_store(full.store, write_to_csv=False))
+
+
+def test_two_phase_fetch_applies_changed_filter_to_excluded_cases(tmp_path):
+    procedures = ('Eerste aanleg - meervoudig', 'Hoger beroep')
+    with StandinServer(n_cases=10, case_paragraphs=2, procedures=procedures) as server:
+        caseloader = CaseLoader(tmp_path, max_workers=4, base_url=server.base_url,
+                                metadata_filter=MetadataFilter(include_procedures=procedures[:1]))
+        assert caseloader._request_cases(server.ECLIds) == {'saved': 5, 'excluded': 5}
+        assert caseloader.ledger.metadata(server.ECLIds[0]) == ('Hoger beroep', ['Strafrecht'])
+
+        # A filter that excludes the cases for another reason reports that reason
+        caseloader.metadata_filter = MetadataFilter(include_subjects=['Civiel recht'])
+        assert caseloader._fetch_case(server.ECLIds[0], None, True, False, False) == \
+            ('excluded', 'subject Strafrecht not included')
+
+        # Cases the new filter includes are downloaded, without requesting their metadata again
+        caseloader.metadata_filter = MetadataFilter(include_procedures=procedures)
+        assert caseloader._request_cases(server.ECLIds) == {'exists': 5, 'saved': 5}
+
+    assert server.counts[('meta', 200)] == 10
+    assert caseloader.ledger.counts() == {'saved': 10}
+
+
+def test_feed_filter_skips_requests(tmp_path):
+    court_ECLIds = ECLIds[:5] + [f'ECLI:NL:GHAMS:2021:{i}' for i in range(1, 4)] + ['ECLI:NL:HR:2021:1']
+    caseloader = CaseLoader(tmp_path, max_workers=4, feed_filter=FeedFilter(exclude_courts=['GH.*', 'HR']))
+    caseloader.http.session = FakeRechtspraak(court_ECLIds)
+    caseloader.query_ECLI_index('type=uitspraak', retrieve_all=True)
+    caseloader.request_cases_from_feed()
+
+    case_requests = [url.rsplit('=', 1)[-1] for url in caseloader.http.session.urls if 'content' in url]
+    assert sorted(case_requests) == sorted(ECLIds[:5])
+    assert (caseloader.feed_dir / 'filtered_ECLIds.txt').read_text().count('\n') == 4
+    assert (caseloader.feed_dir / 'query_ECLIds.txt').read_text().count('\n') == 9
+
+
+class BrokenResponse(FakeResponse):
+    '''
+    Breaks off after the first chunk, like a dropped connection
+    '''
+
+    def iter_content(self, chunk_size=1):
+        yield self.content[:chunk_size]
+        raise requests.exceptions.ChunkedEncodingError("Connection broken")
+
+
+class BrokenSession(FakeSession):
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return BrokenResponse(LABELLED_CASE)
+
+
+class BreakingSession(FakeSession):
+    '''
+    Breaks off the first response to each URL
+    '''
+
+    def get(self, url, **kwargs):
+        broken = url not in self.urls
+        response = super().get(url, **kwargs)
+        return BrokenResponse(response.content) if broken else response
+
+
+def test_interrupted_download_leaves_no_case(tmp_path):
+    caseloader = CaseLoader(tmp_path, http=HttpClient(backoff=0, max_retries=2))
+    caseloader.http.session = BrokenSession()
+    assert caseloader._request_case(ECLIds[0]) == 'failed'
+    assert len(caseloader.http.session.urls) == 3
+    assert list((tmp_path / 'cases').iterdir()) == []
+
+    # The next run downloads the case again and records its hash
+    caseloader.http.session = FakeSession()
+    assert caseloader._request_case(ECLIds[0]) == 'saved'
+    assert caseloader.ledger.get(ECLIds[0])['sha256'] == hashlib.sha256(LABELLED_CASE).hexdigest()
+    assert [path.name for path in (tmp_path / 'cases').iterdir()] == ['ECLI-NL-RBOVE-2021-1.xml']
+
+
+def test_interrupted_download_is_retried(tmp_path):
+    caseloader = CaseLoader(tmp_path, http=HttpClient(backoff=0, max_retries=1))
+    caseloader.http.session = BreakingSession()
+    assert caseloader._request_case(ECLIds[0]) == 'saved'
+    assert len(caseloader.http.session.urls) == 2
+    assert caseloader.store.get(ECLIds[0]) == LABELLED_CASE
+    assert caseloader.ledger.get(ECLIds[0])['n_bytes'] == len(LABELLED_CASE)
+    assert [path.name for path in (tmp_path / 'cases').iterdir()] == ['ECLI-NL-RBOVE-2021-1.xml']
@@ -0,0 +1,134 @@
+"""
+Test cases for the module `caseparser`.
+"""
+
+from pathlib import Path
+
+import pytest
+
+from src.caseparser import CaseParser
+
+
+FIXTURE_DIR = Path(__file__).parent / 'fixtures' / 'cases'
+fixture_cases = sorted(FIXTURE_DIR.glob('*.xml'))
+
+
+@pytest.fixture(scope='module')
+def parser() -> CaseParser:
+    return CaseParser()
+
+
+@pytest.mark.parametrize('source', fixture_cases, ids=lambda path: path.stem)
+def test_section_label_precheck_matches_soup(parser, source):
+    case = source.read_bytes()
+    assert parser.section_label_reason(case) == parser._section_label_reason_soup(case)
+
+    # Interrupted downloads give the same decision as well
+    for cut in range(0, len(case), 101):
+        assert parser.section_label_reason(case[:cut]) == parser._section_label_reason_soup(case[:cut])
+
+
+@pytest.mark.parametrize('case, reason', [
+    (b'', 'no sections'),
+    (b'<html><body>Not found</body></html>', 'no sections'),
+    (b'<uitspraak><section role="overwegingen"/><section role="beslissing">x</section></uitspraak>', 'no sections'),
+    (b'<uitspraak><section role="overwegingen">x</section></uitspraak>', 'no beslissing role'),
+    (b'<uitspraak><section role="overwegingen">x</section><parablock role="beslissing"/></uitspraak>', None),
+])
+def test_section_label_reason(parser, case, reason):
+    assert parser.section_label_reason(case) == reason
+    assert parser.check_section_labels(case) == (reason is None)
+
+
+PROCEDURES = ['Eerste aanleg - enkelvoudig', 'Eerste aanleg - meervoudig', 'Hoger beroep', 'Cassatie',
+              'Op tegenspraak']
+
+
+def parse_with(engine, case, **kwargs):
+    parser = CaseParser(include_procedures=PROCEDURES, engine=engine, **kwargs)
+    try:
+        return parser.parse_case(case)
+    except AttributeError:
+        # The empty first section of RBROT:2021:1932 is not supported by either engine
+        return AttributeError
+
+
+@pytest.mark.parametrize('level', ['section', 'paragraph'])
+@pytest.mark.parametrize('include_section_titles', [True, False])
+@pytest.mark.parametrize('source', fixture_cases, ids=lambda path: path.stem)
+def test_lxml_engine_matches_soup(source, level, include_section_titles):
+    kwargs = dict(level=level, include_section_titles=include_section_titles)
+    expected = parse_with('bs4', source.read_text(encoding='utf-8'), **kwargs)
+    assert parse_with('lxml', source.read_text(encoding='utf-8'), **kwargs) == expected
+    assert parse_with('lxml', source.read_bytes(), **kwargs) == expected
+
+
+def synthetic_case(uitspraak):
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<open-rechtspraak xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+            'xmlns:dcterms="http://purl.org/dc/terms/" xmlns:psi="http://psi.rechtspraak.nl/">'
+            '<rdf:RDF><rdf:Description><dcterms:identifier>ECLI:NL:RBTEST:2021:1</dcterms:identifier>'
+            '<dcterms:date>2021-01-01</dcterms:date><psi:procedure>Hoger beroep</psi:procedure>'
+            '<dcterms:subject>Strafrecht; Materieel strafrecht</dcterms:subject></rdf:Description></rdf:RDF>'
+            f'{uitspraak}</open-rechtspraak>')
+
+
+@pytest.mark.parametrize('uitspraak', [
+    # <nr> fix, also when the number is nested or missing
+    '<uitspraak><section><title><nr>1</nr>Tenlastelegging</title><para>De verdachte</para></section></uitspraak>',
+    '<uitspraak><section><title><nr><emphasis>2</emphasis></nr>Straf</title><para>Een taakstraf</para></section>'
+    '</uitspraak>',
+    '<uitspraak><section><title><nr/>Straf</title><para>Een <nr>3</nr> geldboete</para></section></uitspraak>',
+    # Whitespace between and inside tags
+    '<uitspraak>\n  <section role="beslissing">\n\t<title> Beslissing </title>\n  <para>  </para>\n'
+    '  <para>\n Veroordeelt\n</para> <para>1.</para>\n</section>\n</uitspraak>',
+    # Nested sections, a section without paragraphs and comments
+    '<uitspraak><section><title>Feiten</title><!-- comment --><section><title>Bewijs</title>'
+    '<para>bewezen <![CDATA[verklaard]]></para></section></section>'
+    '<section role="procesverloop"><title>Procesverloop</title></section></uitspraak>',
+    # No uitspraak or inhoudsindicatie
+    '<conclusie><section><title>Conclusie</title><para>Cassatie</para></section></conclusie>',
+    '<inhoudsindicatie id="ECLI:NL:RBTEST:2021:1">Straf</inhoudsindicatie>'
+    '<conclusie><section><title>Conclusie</title><para>Straf</para></section></conclusie>',
+])
+def test_lxml_engine_matches_soup_edge_cases(uitspraak):
+    case = synthetic_case(uitspraak)
+    for level in ['section', 'paragraph']:
+        assert parse_with('lxml', case, level=level) == parse_with('bs4', case, level=level)
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        CaseParser(engine='html.parser')
+
+
+@pytest.mark.parametrize('engine', ['bs4', 'lxml'])
+def test_parse_all_cases_in_processes(tmp_path, engine):
+    # The empty first section of RBROT:2021:1932 is not supported by parse_case
+    for source in fixture_cases:
+        if 'RBROT' not in source.name:
+            (tmp_path / source.name).write_bytes(source.read_bytes())
+
+    # Skip the PHR conclusion, which has no sections
+    parser = CaseParser(include_procedures=[p for p in PROCEDURES if p != 'Cassatie'], engine=engine)
+    serial = parser.parse_all_cases(tmp_path, write_to_csv=False)
+    parallel = parser.parse_all_cases(tmp_path, write_to_csv=False, workers=2)
+
+    assert serial['ECLI'].is_monotonic_increasing
+    assert parallel.to_csv() == serial.to_csv()
+
+
+def test_parsed_data_frame(tmp_path):
+    uitspraak = ('<uitspraak><section><title>Feiten</title><para>De\tverdachte\u200b</para></section>'
+                 '<section><title>1.</title></section>'
+                 '<section role="beslissing"><title>Beslissing</title><para>Veroordeelt</para></section></uitspraak>')
+    (tmp_path / 'case.xml').write_text(synthetic_case(uitspraak), encoding='utf-8')
+
+    parser = CaseParser(include_procedures=PROCEDURES, include_section_titles=False)
+    df = parser.parse_all_cases(tmp_path, write_to_csv=False)
+
+    # Control characters are replaced and the section without text is dropped, but keeps its id
+    assert list(df.columns) == parser.columns
+    assert df['data'].tolist() == ['De verdachte ', 'Veroordeelt']
+    assert df.index.tolist() == [0, 2]
+    assert df['section_id'].tolist() == [0, 2] and df['section_id'].dtype == 'int64'
@@ -0,0 +1,35 @@
+"""
+Test cases for the module `feed_filter`.
+"""
+
+import pytest
+
+from src.feed_filter import FeedFilter
+
+
+@pytest.mark.parametrize('ECLI, title, reason', [
+    ('ECLI:NL:RBOVE:2021:5', 'ECLI:NL:RBOVE:2021:5, Rechtbank Overijssel, 04-01-2021, 08.206498.20', None),
+    ('ECLI:NL:GHAMS:2021:100', 'ECLI:NL:GHAMS:2021:100, Gerechtshof Amsterdam, 15-01-2021, 23-001234-20',
+     'court GHAMS excluded'),
+    ('ECLI:NL:HR:2021:1', 'ECLI:NL:HR:2021:1, Hoge Raad, 08-01-2021, 19/01234', 'court HR excluded'),
+    ('ECLI:NL:PHR:2021:10', 'ECLI:NL:PHR:2021:10, Parket bij de Hoge Raad, 12-01-2021, 20/00123', 'court PHR excluded'),
+    # 'HR' must match the whole court code
+    ('ECLI:NL:RBNHO:2021:7', 'ECLI:NL:RBNHO:2021:7, Rechtbank Noord-Holland, 05-01-2021, 15/123456-20', None),
+    ('ECLI:NL:RBAMS:2021:1', 'ECLI:NL:RBAMS:2021:1, Rechtbank Amsterdam, 04-01-2021, Kort geding',
+     "title matches 'Kort geding'"),
+])
+def test_reason(ECLI, title, reason):
+    feed_filter = FeedFilter(exclude_courts=['GH.*', 'HR', 'PHR'], exclude_titles=['Kort geding'])
+    assert feed_filter.reason(ECLI, title) == reason
+
+
+def test_include_courts():
+    feed_filter = FeedFilter(include_courts=['RB.*'])
+    kept, excluded = feed_filter.apply(['ECLI:NL:RBOVE:2021:5', 'ECLI:NL:GHARL:2021:3'])
+    assert kept == ['ECLI:NL:RBOVE:2021:5']
+    assert excluded == [('ECLI:NL:GHARL:2021:3', 'court GHARL not included')]
+
+
+def test_empty_filter_keeps_everything():
+    assert not FeedFilter()
+    assert FeedFilter().apply(['ECLI:NL:HR:2021:1'])[0] == ['ECLI:NL:HR:2021:1']
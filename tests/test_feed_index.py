@@ -0,0 +1,88 @@
+"""
+Test cases for the module `feed_index`.
+"""
+
+import os
+
+import feedparser as fp
+import pandas as pd
+
+import src.feed_index
+from src.feed_index import FeedIndex, feed_metadata, parse_title, read_feed, result_feeds
+from src.standin_server import atom_feed
+
+
+ECLIds = [f'ECLI:NL:RBOVE:2021:{i}' for i in range(1, 101)]
+
+
+def test_read_feed_matches_feedparser(tmp_path):
+    feed = atom_feed(2500, ECLIds)
+    path = tmp_path / 'results_from_1.atom'
+    path.write_bytes(feed)
+
+    d = fp.parse(feed)
+    for source in (feed, path, str(path)):
+        n_hits, feed_ECLIds, titles = read_feed(source)
+        assert n_hits == 2500
+        assert feed_ECLIds == [entry.id for entry in d.entries]
+        assert titles == [entry.title for entry in d.entries]
+
+
+def test_index_only_reads_changed_feeds(tmp_path, monkeypatch):
+    calls = []
+
+    def counting_read_feed(source):
+        calls.append(source)
+        return read_feed(source)
+
+    monkeypatch.setattr(src.feed_index, 'read_feed', counting_read_feed)
+
+    path = tmp_path / 'results_from_1.atom'
+    path.write_bytes(atom_feed(100, ECLIds))
+    index = FeedIndex(tmp_path / 'query_ECLIds.json')
+    assert index.read(path)[:2] == (100, ECLIds)
+    index.save()
+
+    # A new run reads the cached ECLIs
+    index = FeedIndex(tmp_path / 'query_ECLIds.json')
+    assert index.read(path)[:2] == (100, ECLIds)
+    assert len(calls) == 1
+
+    # A changed feed is read again
+    path.write_bytes(atom_feed(2, ECLIds[:2]))
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert index.read(path)[:2] == (2, ECLIds[:2])
+    assert len(calls) == 2
+
+
+def test_result_feeds_in_order_of_results(tmp_path):
+    for offset in [0, 1000, 2000, 10000]:
+        (tmp_path / f'results_from_{offset}.atom').write_bytes(b'')
+    (tmp_path / 'query.info').write_text('')
+    assert [path.rsplit('/', 1)[-1] for path in result_feeds(tmp_path)] == \
+        ['results_from_0.atom', 'results_from_1000.atom', 'results_from_2000.atom', 'results_from_10000.atom']
+
+
+def test_parse_title():
+    assert parse_title('ECLI:NL:RBOVE:2021:5, Rechtbank Overijssel, 04-01-2021, 08.206498.20') == \
+        ('Rechtbank Overijssel', '04-01-2021', ['08.206498.20'])
+    assert parse_title('ECLI:NL:GHARL:2021:1, Gerechtshof Arnhem-Leeuwarden, 05-01-2021, 21-001234-20, 21-001235-20') == \
+        ('Gerechtshof Arnhem-Leeuwarden', '05-01-2021', ['21-001234-20', '21-001235-20'])
+    assert parse_title('ECLI:NL:HR:2021:1, Hoge Raad, 05-01-2021') == ('Hoge Raad', '05-01-2021', [])
+    assert parse_title('') == (None, None, [])
+
+
+def test_feed_metadata_is_typed(tmp_path):
+    df = feed_metadata([atom_feed(100, ECLIds[:60]), atom_feed(100, ECLIds[50:])])
+    assert df['ECLI'].tolist() == ECLIds
+    assert df['court_code'].dtype == 'category' and df['court'].dtype == 'category'
+    assert df['court'].cat.categories.tolist() == ['Rechtbank Overijssel']
+    assert (df['date'] == pd.Timestamp('2021-01-01')).all()
+    assert df['updated'].iloc[0] == pd.Timestamp('2021-01-01T12:00:00Z')
+    assert df['case_numbers'].iloc[0] == ['08/000000-21']
+    assert df['summary'].iloc[0] == 'Synthetische uitspraak'
+
+    # Requires pyarrow, see requirements.txt
+    df.to_parquet(tmp_path / 'feed_metadata.parquet', index=False)
+    assert pd.api.types.is_datetime64_dtype(pd.read_parquet(tmp_path / 'feed_metadata.parquet')['date'])
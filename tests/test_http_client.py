@@ -0,0 +1,149 @@
+"""
+Test cases for the module `http_client`.
+"""
+
+import time
+
+import pytest
+import requests
+
+from src.http_client import HttpClient, CircuitBreaker, TokenBucket, RetryableHTTPError
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.url = 'http://localhost/'
+        self.content = b''
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    '''
+    Returns the given status codes in order; the last one is repeated
+    None raises a connection error and an exception is raised as it is
+    '''
+
+    def __init__(self, status_codes):
+        self.status_codes = list(status_codes)
+        self.n_requests = 0
+        self.responses = []
+
+    def get(self, url, **kwargs):
+        self.n_requests += 1
+        status_code = self.status_codes.pop(0) if len(self.status_codes) > 1 else self.status_codes[0]
+        if status_code is None:
+            raise requests.ConnectionError("Connection refused")
+        if isinstance(status_code, Exception):
+            raise status_code
+        self.responses.append(FakeResponse(status_code))
+        return self.responses[-1]
+
+
+def client_with_responses(status_codes, **kwargs):
+    client = HttpClient(backoff=0, **kwargs)
+    client.session = FakeSession(status_codes)
+    return client
+
+
+def test_retries_until_success():
+    client = client_with_responses([503, None, 200], max_retries=3)
+    assert client.get('http://localhost/').status_code == 200
+    assert client.session.n_requests == 3
+
+
+def test_gives_up_after_max_retries():
+    client = client_with_responses([503], max_retries=2)
+    with pytest.raises(RetryableHTTPError):
+        client.get('http://localhost/')
+    assert client.session.n_requests == 3
+
+
+def test_broken_responses_are_retried():
+    client = client_with_responses([requests.exceptions.ChunkedEncodingError("Connection broken"), 200],
+                                   max_retries=1)
+    assert client.get('http://localhost/').status_code == 200
+    assert client.session.n_requests == 2
+
+
+def test_retried_streams_are_closed():
+    client = client_with_responses([503, 200], max_retries=1)
+    client.get('http://localhost/', stream=True)
+    assert [r.closed for r in client.session.responses] == [True, False]
+
+
+def test_broken_downloads_are_retried():
+    client = client_with_responses([200], max_retries=1)
+    reads = []
+
+    def read(r):
+        reads.append(r)
+        if len(reads) == 1:
+            raise requests.exceptions.ChunkedEncodingError("Connection broken")
+        return 'body'
+
+    r, body = client.download('http://localhost/', read)
+    assert body == 'body' and r is reads[-1]
+    assert client.session.n_requests == 2
+    assert [r.closed for r in client.session.responses] == [True, True]
+
+
+def test_failed_probe_releases_circuit():
+    # Errors that are not retried also count as a failed probe, so other requests do not wait forever
+    client = client_with_responses([requests.TooManyRedirects("Exceeded 30 redirects"), 200],
+                                   reset_timeout=0.05)
+    client.breaker.state = 'open'
+    client.breaker.opened_at = time.monotonic() - 1
+    with pytest.raises(requests.TooManyRedirects):
+        client.get('http://localhost/')
+    assert client.breaker.state == 'open' and not client.breaker.probing
+
+    assert client.get('http://localhost/').status_code == 200
+    assert client.breaker.state == 'closed'
+
+
+def test_client_errors_are_not_retried():
+    client = client_with_responses([404], max_retries=3)
+    assert client.get('http://localhost/').status_code == 404
+    assert client.session.n_requests == 1
+
+
+def test_throttling_lowers_rate():
+    client = client_with_responses([429, 200], max_retries=1, requests_per_second=100)
+    client.get('http://localhost/')
+    assert client.bucket.rate < 100
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    # The first token is available immediately, the next ten take 1/50 second each
+    assert time.monotonic() - start >= 0.18
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    # Requests wait until the circuit is half-open
+    start = time.monotonic()
+    breaker.before_request()
+    assert time.monotonic() - start >= 0.09
+    assert breaker.state == 'half-open'
+
+    # A failing probe opens the circuit again, a successful one closes it
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == 'closed'
@@ -0,0 +1,32 @@
+"""
+Test cases for the module `metadata_filter`.
+"""
+
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from src.metadata_filter import MetadataFilter, read_metadata
+from src.standin_server import case_metadata, synthetic_case
+
+
+FIXTURE_DIR = Path(__file__).parent / 'fixtures' / 'cases'
+
+
+def test_read_metadata_matches_caseparser():
+    for path in sorted(FIXTURE_DIR.glob('*.xml')):
+        case = path.read_bytes()
+        description = BeautifulSoup(case, features='xml').Description
+        procedure, subjects = read_metadata(case)
+        assert procedure == description.procedure.text.strip()
+        assert ', '.join(subjects) in description.subject.text.replace(';', ',')
+        assert read_metadata(case_metadata(case)) == (procedure, subjects)
+
+
+def test_metadata_filter():
+    case = case_metadata(synthetic_case('ECLI:NL:RBOVE:2021:1', paragraphs=1, procedures=['Hoger beroep']))
+    assert MetadataFilter(include_procedures=['Hoger beroep']).reason(case) is None
+    assert MetadataFilter(include_procedures=['Eerste aanleg - meervoudig']).reason(case) == \
+        "procedure Hoger beroep not included"
+    assert MetadataFilter(include_subjects=['Civiel recht']).reason(case) == "subject Strafrecht not included"
+    assert not MetadataFilter()
@@ -0,0 +1,81 @@
+"""
+Test cases for the module `parse_cache`.
+"""
+
+import shutil
+from pathlib import Path
+
+import pytest
+
+from src.caseparser import CaseParser
+from src.parse_cache import ParseCache
+
+
+FIXTURE_DIR = Path(__file__).parent / 'fixtures' / 'cases'
+
+# The PHR conclusion has no sections and the first section of RBROT:2021:1932 is not supported
+PROCEDURES = ['Eerste aanleg - enkelvoudig', 'Eerste aanleg - meervoudig', 'Hoger beroep']
+
+
+@pytest.fixture
+def case_dir(tmp_path):
+    case_dir = tmp_path / 'cases'
+    case_dir.mkdir()
+    for source in sorted(FIXTURE_DIR.glob('*.xml')):
+        if 'RBROT' not in source.name:
+            shutil.copy(source, case_dir)
+    return case_dir
+
+
+def count_parses(parser, monkeypatch):
+    parsed = []
+    parse_case = parser.parse_case
+
+    def counting_parse_case(case):
+        parsed.append(case)
+        return parse_case(case)
+
+    monkeypatch.setattr(parser, 'parse_case', counting_parse_case)
+    return parsed
+
+
+def test_parse_cache(tmp_path, case_dir, monkeypatch):
+    parser = CaseParser(include_procedures=PROCEDURES, engine='lxml')
+    expected = parser.parse_all_cases(case_dir, write_to_csv=False)
+
+    cache = ParseCache(tmp_path / 'parse_cache.sqlite')
+    parsed = count_parses(parser, monkeypatch)
+    first = parser.parse_all_cases(case_dir, write_to_csv=False, cache=cache)
+    assert len(parsed) == 6 and len(cache) == 6
+    assert first.to_csv() == expected.to_csv()
+
+    # Unchanged cases, including the skipped PHR conclusion, are not parsed again
+    parsed.clear()
+    second = parser.parse_all_cases(case_dir, write_to_csv=False, cache=cache)
+    assert len(parsed) == 0
+    assert second.to_csv() == expected.to_csv()
+
+    # Only a changed case is parsed again
+    path = case_dir / 'ECLI-NL-RBOVE-2021-5.xml'
+    path.write_bytes(path.read_bytes().replace(b'</open-rechtspraak>', b'<!-- changed --></open-rechtspraak>'))
+    parser.parse_all_cases(case_dir, write_to_csv=False, cache=cache)
+    assert len(parsed) == 1
+    cache.close()
+
+    # Other parser settings do not use the cached records
+    cache = ParseCache(tmp_path / 'parse_cache.sqlite')
+    other = CaseParser(include_procedures=PROCEDURES, level='paragraph')
+    assert other.fingerprint() != parser.fingerprint()
+    assert CaseParser(include_procedures=PROCEDURES).fingerprint() == parser.fingerprint()
+    parsed = count_parses(other, monkeypatch)
+    df = other.parse_all_cases(case_dir, write_to_csv=False, cache=cache)
+    assert len(parsed) == 6 and len(cache) == 13
+    assert df.to_csv() == other.parse_all_cases(case_dir, write_to_csv=False).to_csv()
+
+
+def test_parse_cache_in_processes(tmp_path, case_dir):
+    parser = CaseParser(include_procedures=PROCEDURES)
+    cache = ParseCache(tmp_path / 'parse_cache.sqlite')
+    first = parser.parse_all_cases(case_dir, write_to_csv=False, cache=cache, workers=2)
+    second = parser.parse_all_cases(case_dir, write_to_csv=False, cache=cache, workers=2)
+    assert second.to_csv() == first.to_csv() == parser.parse_all_cases(case_dir, write_to_csv=False).to_csv()
@@ -0,0 +1,33 @@
+"""
+Test cases for the module `preview`.
+"""
+
+from src.preview import preview_punishments
+from src.standin_server import atom_feed
+
+
+SUMMARIES = {
+    'ECLI:NL:RBOVE:2021:1': 'De rechtbank veroordeelt een 28-jarige man tot een gevangenisstraf van 2 maanden.',
+    'ECLI:NL:RBOVE:2021:2': 'Verdachte wordt veroordeeld tot een taakstraf van 120 uur.',
+    'ECLI:NL:RBOVE:2021:3': 'Vrijspraak van diefstal.',
+    'ECLI:NL:RBOVE:2021:4': 'Bewezenverklaring van oplichting.',
+}
+
+
+def test_preview_labels_feed_summaries(tmp_path):
+    ECLIds = list(SUMMARIES)
+    (tmp_path / 'results_from_1.atom').write_bytes(
+        atom_feed(len(ECLIds), ECLIds[:2], summaries=SUMMARIES))
+    (tmp_path / 'results_from_3.atom').write_bytes(
+        atom_feed(len(ECLIds), ECLIds[2:], summaries=SUMMARIES))
+
+    df = preview_punishments(tmp_path)
+    assert df['ECLI'].tolist() == ECLIds
+    assert df['hoofdstraf'].tolist() == ['gevangenisstraf', 'taakstraf', 'vrijspraak', 'nan']
+    assert df['gevangenisstraf'].tolist() == [60, 0, 0, 0]
+    assert df['taakstraf'].tolist() == [0, 5, 0, 0]
+    assert (tmp_path / 'preview_punishments.csv').is_file()
+
+
+def test_preview_without_feeds(tmp_path):
+    assert preview_punishments(tmp_path) is None
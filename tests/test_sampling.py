@@ -0,0 +1,39 @@
+"""
+Test cases for the module `sampling`.
+"""
+
+import numpy as np
+import pandas as pd
+
+from src.sampling import stratified_order, strata
+
+
+def metadata(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    courts = rng.choice(['RBOVE', 'RBAMS', 'RBGEL'], p=[0.5, 0.3, 0.2], size=n)
+    dates = pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 365, size=n), unit='D')
+    return pd.DataFrame({'ECLI': [f'ECLI:NL:{court}:2021:{i}' for i, court in enumerate(courts)],
+                         'court_code': pd.Categorical(courts),
+                         'date': dates})
+
+
+def test_prefixes_are_stratified():
+    df = metadata()
+    order = stratified_order(df, seed=1)
+    assert sorted(order) == sorted(df['ECLI'])
+
+    sample = df[df['ECLI'].isin(order[:200])]
+    shares = sample['court_code'].value_counts(normalize=True)
+    assert abs(shares['RBOVE'] - 0.5) < 0.03 and abs(shares['RBGEL'] - 0.2) < 0.03
+    assert strata(sample).nunique() == strata(df).nunique()
+
+
+def test_order_is_seeded_and_stable():
+    df = metadata()
+    order = stratified_order(df, seed=1)
+    assert stratified_order(df.sample(frac=1, random_state=3), seed=1) == order
+    assert stratified_order(df, seed=2) != order
+
+    # Adding results to the query hardly changes which ECLIs come first
+    extended = pd.concat([df, metadata(200, seed=1).assign(ECLI=lambda d: d['ECLI'].str.replace(':2021:', ':2022:'))])
+    assert len(set(stratified_order(extended, seed=1)[:100]) & set(order[:100])) > 80
@@ -0,0 +1,96 @@
+"""
+Test cases for the module `shards`.
+"""
+
+import pandas as pd
+
+from src.case_store import DirectoryCaseStore
+from src.caseloader import CaseLoader
+from src.caseparser import CaseParser
+from src.shards import (merge_shards, select_shard, shard_dir, shard_of, write_case_rows, replace_cases,
+                        _number_like_single_node)
+from src.standin_server import StandinServer, synthetic_ECLIds, synthetic_case
+
+
+def test_shards_partition_ECLIds():
+    ECLIds = synthetic_ECLIds(1000)
+    shards = [select_shard(ECLIds, i, 4) for i in range(4)]
+    assert sorted(ECLI for shard in shards for ECLI in shard) == sorted(ECLIds)
+    assert all(150 < len(shard) < 350 for shard in shards)
+
+    # The shard of an ECLI does not depend on the process, unlike hash()
+    assert [shard_of(ECLI, 4) for ECLI in ECLIds[:8]] == [2, 3, 1, 3, 2, 0, 1, 3]
+
+
+def crawl(server, out_dir, shard_index=0, num_shards=1):
+    caseloader = CaseLoader(out_dir, max_workers=4, base_url=server.base_url,
+                            shard_index=shard_index, num_shards=num_shards)
+    caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+    caseloader.request_cases_from_feed()
+
+    # Without paragraphs and titles, the first two sections of every case are empty and dropped
+    parser = CaseParser(include_procedures=['Eerste aanleg - meervoudig'], include_section_titles=False)
+    df = parser.parse_store(caseloader.store, write_to_csv=False)
+    df.to_csv(out_dir / 'parsed_data.csv')
+    write_case_rows(df, out_dir)
+    return caseloader
+
+
+def test_merged_shards_match_single_node(tmp_path):
+    with StandinServer(n_cases=30, case_paragraphs=0) as server:
+        single = crawl(server, tmp_path / 'single')
+        shard_dirs = [shard_dir(tmp_path / 'sharded', i, 3) for i in range(3)]
+        shards = [crawl(server, directory, i, 3) for i, directory in enumerate(shard_dirs)]
+
+    assert sum(len(shard.store) for shard in shards) == len(single.store)
+
+    merge_shards(shard_dirs, tmp_path / 'merged')
+    assert (tmp_path / 'merged' / 'parsed_data.csv').read_bytes() == (tmp_path / 'single' / 'parsed_data.csv').read_bytes()
+    assert sorted(path.name for path in (tmp_path / 'merged' / 'cases').iterdir()) == \
+        sorted(path.name for path in (tmp_path / 'single' / 'cases').iterdir())
+
+
+def test_number_like_single_node():
+    # Rows per case before dropping: A 2, B 3 (all dropped), C 2 (last dropped), D 1
+    shards = [
+        (pd.DataFrame({'ECLI': ['A', 'A', 'D']}, index=[0, 1, 2]), [('A', 2), ('D', 1)]),
+        (pd.DataFrame({'ECLI': ['C']}, index=[3]), [('B', 3), ('C', 2)]),
+    ]
+    df = _number_like_single_node([frame for frame, _ in shards],
+                                  [pd.DataFrame(rows, columns=['ECLI', 'n_rows']) for _, rows in shards])
+    assert df['ECLI'].tolist() == ['A', 'A', 'C', 'D']
+    assert df.index.tolist() == [0, 1, 5, 7]
+
+
+def test_replaced_cases_match_full_parse(tmp_path):
+    # Every other case is skipped for its procedure; the first two sections of every case are empty and dropped
+    procedures = ('Eerste aanleg - meervoudig', 'Hoger beroep')
+    parser = CaseParser(include_procedures=procedures[:1], include_section_titles=False)
+    store = DirectoryCaseStore(tmp_path / 'cases')
+    ECLIds = synthetic_ECLIds(12)
+    for ECLI in ECLIds[:10]:
+        store.put(ECLI, synthetic_case(ECLI, paragraphs=1, procedures=procedures))
+    df = parser.parse_store(store, write_to_csv=False)
+    case_rows = pd.DataFrame(df.attrs['case_rows'], columns=['ECLI', 'n_rows'])
+
+    # A sync updates a case, removes one and adds two, of which one sorts before the existing cases
+    delta = [(ECLIds[2], 'updated'), (ECLIds[4], 'removed'), (ECLIds[10], 'new'), ('ECLI:NL:GHAMS:2021:1', 'new')]
+    store.put(ECLIds[2], synthetic_case(ECLIds[2], paragraphs=3, procedures=procedures))
+    store.remove(ECLIds[4])
+    for ECLI in (ECLIds[10], 'ECLI:NL:GHAMS:2021:1'):
+        store.put(ECLI, synthetic_case(ECLI, paragraphs=2, procedures=procedures))
+    df_delta = parser.parse_store(store, [ECLI for ECLI, flag in delta if flag != 'removed'], write_to_csv=False,
+                                  sort=True)
+
+    # The earlier parsed data are read back from disk, like in the pipeline
+    df.to_csv(tmp_path / 'parsed_data.csv')
+    replaced = replace_cases(pd.read_csv(tmp_path / 'parsed_data.csv', index_col=0), case_rows, df_delta,
+                             [ECLI for ECLI, _ in delta])
+    full = parser.parse_store(store, write_to_csv=False)
+    assert replaced.to_csv() == full.to_csv()
+    assert replaced.attrs['case_rows'] == full.attrs['case_rows']
+
+    # Without the rows per case, the rows are still ordered by ECLI
+    renumbered = replace_cases(pd.read_csv(tmp_path / 'parsed_data.csv', index_col=0), None, df_delta,
+                               [ECLI for ECLI, _ in delta])
+    assert renumbered.reset_index(drop=True).to_csv() == full.reset_index(drop=True).to_csv()
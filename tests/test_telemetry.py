@@ -0,0 +1,41 @@
+"""
+Test cases for the module `telemetry`.
+"""
+
+import json
+
+import pytest
+
+from src.caseloader import CaseLoader
+from src.http_client import HttpClient
+from src.standin_server import StandinServer
+from src.telemetry import DownloadMetrics, Histogram
+
+
+def test_histogram_percentiles():
+    histogram = Histogram([10, 20, 50, 100])
+    for value in range(1, 101):
+        histogram.add(value)
+
+    assert histogram.n == 100
+    assert histogram.percentile(10) == pytest.approx(10)
+    assert histogram.percentile(50) == pytest.approx(50)
+    assert histogram.percentile(99) == pytest.approx(99)
+    assert histogram.summary()['buckets'] == {'<=10': 10, '<=20': 10, '<=50': 30, '<=100': 50, '>100': 0}
+
+
+def test_metrics_of_a_crawl(tmp_path):
+    metrics = DownloadMetrics(tmp_path / 'download_metrics.json', interval=0)
+    http = HttpClient(backoff=0.01, max_backoff=0.05, failure_threshold=1000, pool_size=4, metrics=metrics)
+    with StandinServer(n_cases=40, case_paragraphs=1, error_rate=0.2, seed=1) as server:
+        caseloader = CaseLoader(tmp_path, max_workers=4, http=http, base_url=server.base_url, metrics=metrics)
+        caseloader.query_ECLI_index('type=uitspraak&max=10', retrieve_all=True)
+        caseloader.request_cases_from_feed()
+
+    summary = json.loads((tmp_path / 'download_metrics.json').read_text())
+    assert summary['latency_ms']['case']['n'] == 40
+    assert summary['status_codes'] == {'feed': {'200': 4}, 'case': {'200': 40}}
+    assert summary['outcomes'] == {'saved': 40}
+    # Every 503 response was retried
+    assert summary['retries'] == {'503': server.counts[('content', 503)] + server.counts.get(('zoeken', 503), 0)}
+    assert summary['retries']['503'] > 0